@@ -1,9 +1,160 @@
 from django.contrib import admin
-from .models import *
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.admin import UserAdmin as AuthUserAdmin
+from django.contrib.auth.forms import UserChangeForm, UserCreationForm
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+from . import clinical
+from .models import (Appointment, AppointmentSeries, ArchivedAppointment,
+                     ClinicalCode, DoctorDailyUtilization, DoctorInformation, Hospital,
+                     Insurance, Insurer, User, WaitlistEntry)
 
-# Register your models here.
-admin.site.register(User)
-admin.site.register(Appointment)
-admin.site.register(Insurance)
+# Unfiltered changelists over tables at least this large show PostgreSQL's
+# row estimate instead of running COUNT(*).
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+
+def estimated_count(queryset):
+    """
+    :return: The planner's estimate of the number of rows in the
+             queryset's table, or None if the queryset is filtered or the
+             database is not PostgreSQL.
+    """
+    if not isinstance(queryset, QuerySet) or queryset.query.where:
+        return None
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class '
+                       'WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that counts huge unfiltered tables from table statistics.
+    Filtered changelists, and small tables, are still counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate >= ESTIMATED_COUNT_THRESHOLD:
+            return estimate
+        return super().count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    """
+    Defaults for changelists over large tables: the estimated-count
+    paginator, no second unfiltered COUNT(*) for the "x of y" summary,
+    a date hierarchy that does not scan the table for its periods, and
+    raw ID widgets instead of <select>s listing every related row.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/health/scalable_change_list.html'
+
+
+class HealthUserCreationForm(UserCreationForm):
+    class Meta(UserCreationForm.Meta):
+        model = User
+
+
+class HealthUserChangeForm(UserChangeForm):
+    class Meta(UserChangeForm.Meta):
+        model = User
+
+
+@admin.register(User)
+class UserAdmin(ScalableAdmin, AuthUserAdmin):
+    form = HealthUserChangeForm
+    add_form = HealthUserCreationForm
+    fieldsets = AuthUserAdmin.fieldsets + (
+        ('Health', {'fields': ('date_of_birth', 'phone_number', 'hospital',
+                               'medical_information', 'emergency_contact',
+                               'doctor_information')}),
+    )
+    list_display = ('username', 'email', 'first_name', 'last_name',
+                    'hospital', 'is_staff')
+    list_select_related = ('hospital',)
+    # Prefix searches, served by the UPPER(...) pattern indexes created in
+    # migration 0010 on PostgreSQL.
+    search_fields = ('^username', '^email', '^last_name')
+    raw_id_fields = ('hospital', 'medical_information', 'emergency_contact',
+                     'doctor_information')
+
+
+@admin.register(Appointment)
+class AppointmentAdmin(ScalableAdmin):
+    list_display = ('date', 'duration', 'patient', 'doctor')
+    list_select_related = ('patient', 'doctor')
+    date_hierarchy = 'date'
+    ordering = ('-date',)
+    search_fields = ('^patient__last_name', '^doctor__last_name')
+    raw_id_fields = ('patient', 'doctor')
+
+
+@admin.register(ArchivedAppointment)
+class ArchivedAppointmentAdmin(ScalableAdmin):
+    list_display = ('date', 'duration', 'patient', 'doctor', 'archived_at')
+    list_select_related = ('patient', 'doctor')
+    date_hierarchy = 'date'
+    ordering = ('-date',)
+    raw_id_fields = ('patient', 'doctor')
+
+
+@admin.register(LogEntry)
+class LogEntryAdmin(ScalableAdmin):
+    """
+    The audit log is append-only, so it is listed read-only.
+    """
+    list_display = ('action_time', 'user', 'content_type', 'object_repr',
+                    'action_flag')
+    list_select_related = ('user', 'content_type')
+    list_filter = ('action_flag',)
+    date_hierarchy = 'action_time'
+    raw_id_fields = ('user',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ClinicalCode)
+class ClinicalCodeAdmin(admin.ModelAdmin):
+    list_display = ('display', 'kind')
+    list_filter = ('kind',)
+    exclude = ('code_hash',)
+    # Codes are stored hashed, so a search finds the exact term only.
+    search_fields = ('code_hash',)
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        hashes = [clinical.code_hash(kind, clinical.normalize(kind, search_term))
+                  for kind in ClinicalCode.KINDS]
+        return queryset.filter(code_hash__in=hashes), False
+
+
+@admin.register(Insurance)
+class InsuranceAdmin(admin.ModelAdmin):
+    # Set from the company and policy number on save (see health.insurers).
+    exclude = ('policy',)
+
+
+admin.site.register(Insurer)
 admin.site.register(DoctorInformation)
 admin.site.register(Hospital)
+admin.site.register(AppointmentSeries)
+admin.site.register(DoctorDailyUtilization)
+admin.site.register(WaitlistEntry)
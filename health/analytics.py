@@ -0,0 +1,164 @@
+"""
+Vectorized analytics over the full appointment history.
+
+Appointment columns are read in primary-key-ordered chunks straight into
+NumPy arrays, and every aggregate is accumulated with bincount/searchsorted
+over whole chunks, so no per-appointment Python arithmetic is done after the
+rows are fetched. Live and archived appointments are both included.
+
+NumPy is an optional dependency and is only needed by this module.
+"""
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.functions import ExtractHour, ExtractWeekDay
+from .models import Appointment, ArchivedAppointment, DoctorInformation, User
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HOURS_PER_WEEK = 7 * 24
+DURATION_BIN_MINUTES = 15
+DURATION_BINS = 17  # 0-15, 15-30, ... and a final bin for 4 hours or more.
+LEAD_TIME_EDGES_HOURS = (0, 1, 6, 24, 72, 168, 336, 672)
+LEAD_TIME_LABELS = ('<0h', '0-1h', '1-6h', '6-24h', '1-3d', '3-7d', '1-2w',
+                    '2-4w', '>4w')
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def _chunks(queryset, key, fields, chunk_size):
+    """
+    Yields lists of (key, *fields) tuples from the queryset, keyset-paginated
+    on `key` so every chunk is an index range scan.
+    """
+    last = None
+    while True:
+        rows = queryset.order_by(key)
+        if last is not None:
+            rows = rows.filter(**{key + '__gt': last})
+        rows = list(rows.values_list(key, *fields)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def _appointment_chunks(chunk_size):
+    """
+    Yields (ids, doctor ids, durations, start epochs, hour-of-week) arrays
+    for live and then archived appointments. Hour and weekday are
+    extracted by the database in the current timezone.
+    """
+    for model, key in ((Appointment, 'id'), (ArchivedAppointment, 'original_id')):
+        appointments = model.objects.annotate(hour=ExtractHour('date'),
+                                              weekday=ExtractWeekDay('date'))
+        fields = ('doctor_id', 'duration', 'date', 'hour', 'weekday')
+        for rows in _chunks(appointments, key, fields, chunk_size):
+            ids, doctors, durations, dates, hours, weekdays = zip(*rows)
+            # ExtractWeekDay counts from Sunday = 1; rebase to Monday = 0.
+            weekday = (np.array(weekdays, dtype=np.int64) + 5) % 7
+            yield (np.array(ids, dtype=np.int64),
+                   np.array(doctors, dtype=np.int64),
+                   np.array(durations, dtype=np.int64),
+                   np.fromiter((d.timestamp() for d in dates), dtype=np.float64,
+                               count=len(dates)),
+                   weekday * 24 + np.array(hours, dtype=np.int64))
+
+
+def _booking_times(chunk_size):
+    """
+    :return: A tuple of (appointment ids, epoch seconds) holding the first
+             time each appointment id appears in the audit log, sorted by id.
+    """
+    content_type = ContentType.objects.get_for_model(Appointment)
+    entries = LogEntry.objects.filter(content_type=content_type)
+    ids = []
+    times = []
+    for rows in _chunks(entries, 'id', ('object_id', 'action_time'), chunk_size):
+        _, object_ids, action_times = zip(*rows)
+        ids.append(np.array([int(i) if i and i.isdigit() else -1
+                             for i in object_ids], dtype=np.int64))
+        times.append(np.fromiter((t.timestamp() for t in action_times),
+                                 dtype=np.float64, count=len(action_times)))
+    if not ids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    ids = np.concatenate(ids)
+    times = np.concatenate(times)
+    order = np.lexsort((times, ids))
+    ids, times = ids[order], times[order]
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    return ids[first], times[first]
+
+
+def compute(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Computes the monthly analytics aggregates.
+    :return: A dict of NumPy arrays:
+             doctor_ids, specialisations: the row labels of the heatmaps;
+             doctor_heatmap: appointments per doctor per hour of the week;
+             specialisation_heatmap: the same per specialisation;
+             doctor_minutes: booked minutes per doctor per hour of the week;
+             duration_histogram: appointments per 15 minute duration bin;
+             lead_time_histogram: appointments per booking lead time bin.
+    """
+    if np is None:
+        raise ImportError('NumPy is required for appointment analytics.')
+    doctors = sorted(User.objects.filter(groups__name='Doctor')
+                                 .values_list('id', 'doctor_information__specialisation'))
+    doctor_ids = np.array([pk for pk, _ in doctors], dtype=np.int64)
+    specialisations = list(DoctorInformation.SPECIALISATION)
+    for _, specialisation in doctors:
+        if specialisation and specialisation not in specialisations:
+            specialisations.append(specialisation)
+    specialisations.append('Unknown')
+    # The final doctor row collects appointments with users that are no
+    # longer in the Doctor group; its specialisation is 'Unknown'.
+    doctor_specialisation = np.array(
+        [specialisations.index(s) if s else len(specialisations) - 1
+         for _, s in doctors] + [len(specialisations) - 1], dtype=np.int64)
+    padded_ids = np.append(doctor_ids, -1)
+    n_doctors = len(doctor_ids) + 1
+    n_specialisations = len(specialisations)
+    doctor_heatmap = np.zeros(n_doctors * HOURS_PER_WEEK, dtype=np.int64)
+    doctor_minutes = np.zeros(n_doctors * HOURS_PER_WEEK, dtype=np.int64)
+    specialisation_heatmap = np.zeros(n_specialisations * HOURS_PER_WEEK,
+                                      dtype=np.int64)
+    duration_histogram = np.zeros(DURATION_BINS, dtype=np.int64)
+    lead_time_histogram = np.zeros(len(LEAD_TIME_LABELS), dtype=np.int64)
+    booked_ids, booked_at = _booking_times(chunk_size)
+    lead_edges = np.array(LEAD_TIME_EDGES_HOURS, dtype=np.float64) * 3600
+
+    for ids, doctor, duration, start, hour_of_week in _appointment_chunks(chunk_size):
+        row = np.searchsorted(doctor_ids, doctor)
+        row = np.where(padded_ids[row] == doctor, row, n_doctors - 1)
+        cell = row * HOURS_PER_WEEK + hour_of_week
+        doctor_heatmap += np.bincount(cell, minlength=doctor_heatmap.size)
+        doctor_minutes += np.bincount(cell, weights=duration,
+                                      minlength=doctor_minutes.size).astype(np.int64)
+        specialisation_heatmap += np.bincount(
+            doctor_specialisation[row] * HOURS_PER_WEEK + hour_of_week,
+            minlength=specialisation_heatmap.size)
+        duration_histogram += np.bincount(
+            np.clip(duration // DURATION_BIN_MINUTES, 0, DURATION_BINS - 1),
+            minlength=DURATION_BINS)
+        if len(booked_ids):
+            position = np.searchsorted(booked_ids, ids)
+            position = np.minimum(position, len(booked_ids) - 1)
+            logged = booked_ids[position] == ids
+            lead = start[logged] - booked_at[position[logged]]
+            lead_time_histogram += np.bincount(
+                np.searchsorted(lead_edges, lead, side='right'),
+                minlength=len(LEAD_TIME_LABELS))
+
+    return {
+        'doctor_ids': padded_ids,
+        'specialisations': np.array(specialisations),
+        'doctor_heatmap': doctor_heatmap.reshape(n_doctors, HOURS_PER_WEEK),
+        'doctor_minutes': doctor_minutes.reshape(n_doctors, HOURS_PER_WEEK),
+        'specialisation_heatmap': specialisation_heatmap.reshape(
+            n_specialisations, HOURS_PER_WEEK),
+        'duration_histogram': duration_histogram,
+        'lead_time_histogram': lead_time_histogram,
+    }
@@ -0,0 +1,437 @@
+"""
+Version 1 of the JSON API, under /api/v1/.
+
+Reads support sparse field selection (`?fields=id,date,doctor`) and carry
+strong ETags built from the per-object version counters, those of embedded
+users included, so a client that sends If-None-Match gets a 304 without
+anything being serialized. The ETag of a single object starts with its
+version. Writes accept JSON or form bodies, honour If-Match by comparing
+that version, whatever fields the client read, under a lock on the rows
+being written (412 when it is stale), and go through
+handle_appointment_form and handle_user_form, the same validation as the
+HTML forms. Appointments are changed in place, keeping their id. Lists use keyset pagination on (date, id):
+each page returns an opaque `next` cursor to pass back as `after`.
+
+Requests are authenticated by the session, as for the HTML views, and
+unsafe methods need the CSRF token.
+"""
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db.models import Q
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import dateparse, timezone
+from functools import wraps
+import base64
+import binascii
+import hashlib
+import json
+from . import booking, encryption, events, ratelimit, sharding, waitlist
+from .form_utilities import deletion
+from .models import Appointment, DoctorInformation, MedicalInformation, User
+from .views import handle_appointment_form, handle_user_form
+
+API_VERSION = 1
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def _person(user):
+    return {'id': user.pk, 'name': user.get_full_name()}
+
+
+APPOINTMENT_FIELDS = {
+    'id': lambda a: a.pk,
+    'version': lambda a: a.version,
+    'date': lambda a: a.date.isoformat(),
+    'end': lambda a: a.end().isoformat(),
+    'duration': lambda a: a.duration,
+    'patient': lambda a: _person(a.patient),
+    'doctor': lambda a: _person(a.doctor),
+}
+
+MEDICAL_INFORMATION_FIELDS = (
+    'sex', 'medications', 'allergies', 'medical_conditions', 'family_history',
+    'additional_info', 'version',
+)
+
+DOCTOR_INFORMATION_FIELDS = (
+    'specialisation', 'years_of_experience', 'fee', 'degree', 'visit_days',
+    'two_shift', 'first_shift_start', 'first_shift_end', 'second_shift_start',
+    'second_shift_end', 'version',
+)
+
+
+def _section(obj, names):
+    return None if obj is None else {name: getattr(obj, name) for name in names}
+
+
+USER_FIELDS = {
+    'id': lambda u: u.pk,
+    'version': lambda u: u.version,
+    'email': lambda u: u.email,
+    'first_name': lambda u: u.first_name,
+    'last_name': lambda u: u.last_name,
+    'phone_number': lambda u: u.phone_number,
+    'date_of_birth': lambda u: u.date_of_birth and u.date_of_birth.isoformat(),
+    'hospital': lambda u: u.hospital_id,
+    'roles': lambda u: sorted(u.role_names()),
+    'medical_information': lambda u: _section(u.medical_information,
+                                              MEDICAL_INFORMATION_FIELDS),
+    'doctor_information': lambda u: _section(u.doctor_information,
+                                             DOCTOR_INFORMATION_FIELDS),
+}
+
+
+class ApiError(Exception):
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def api_view(*methods):
+    """
+    Wraps an API view: answers 401 for anonymous requests and 405 for other
+    methods, and turns ApiError, PermissionDenied and Http404 into JSON
+    error responses.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return JsonResponse({'error': 'Authentication required.'}, status=401)
+            if request.method not in methods:
+                response = JsonResponse({'error': 'Method not allowed.'}, status=405)
+                response['Allow'] = ', '.join(methods)
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            except ApiError as e:
+                return JsonResponse({'error': e.message}, status=e.status)
+            except PermissionDenied:
+                return JsonResponse({'error': 'Permission denied.'}, status=403)
+            except Http404:
+                return JsonResponse({'error': 'Not found.'}, status=404)
+        return wrapper
+    return decorator
+
+
+def selected_fields(request, available):
+    """
+    :return: The field names requested with `fields`, or all of them.
+    """
+    requested = request.GET.get('fields')
+    if not requested:
+        return list(available)
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ApiError('Unknown fields: {0}.'.format(', '.join(unknown)))
+    return names
+
+
+def serialize(obj, fields, available):
+    return {name: available[name](obj) for name in fields}
+
+
+def make_etag(*parts):
+    """
+    :return: A strong ETag over the given parts, which must identify the
+             representation exactly (object ids, versions and fields).
+    """
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+    return '"{0}"'.format(digest)
+
+
+def versioned_etag(version, *parts):
+    """
+    :return: A strong ETag over the parts that starts with the version of
+             the object, for If-Match to be checked against.
+    """
+    return '"{0}.{1}"'.format(version, make_etag(version, *parts).strip('"'))
+
+
+def _matches(header, etag):
+    return header is not None and (
+        header.strip() == '*' or etag in [tag.strip() for tag in header.split(',')])
+
+
+def not_modified(request, etag):
+    """
+    :return: A 304 response if the client's If-None-Match matches, else None.
+    """
+    if _matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+    return None
+
+
+def check_precondition(request, version):
+    """
+    Raises a 412 ApiError if the client sent an If-Match whose tags were
+    all read at another version of the object (see versioned_etag()).
+    Callers hold a lock on the object while checking and writing.
+    :return: Whether the request was conditional.
+    """
+    header = request.META.get('HTTP_IF_MATCH')
+    if header is None or header.strip() == '*':
+        return False
+    # Weak tags never match under If-Match.
+    versions = [tag.strip()[1:].split('.', 1)[0] for tag in header.split(',')
+                if tag.strip().startswith('"')]
+    if str(version) not in versions:
+        raise ApiError('The resource has changed.', status=412)
+    return True
+
+
+def respond(data, etag=None, status=200):
+    response = JsonResponse(data, status=status)
+    if etag:
+        response['ETag'] = etag
+    return response
+
+
+def request_body(request):
+    """
+    :return: The request body as a dict of strings, parsed from JSON or
+             from form data.
+    """
+    if request.content_type == 'application/json':
+        try:
+            body = json.loads(request.body.decode('utf-8') or '{}')
+        except (UnicodeDecodeError, ValueError):
+            raise ApiError('Invalid JSON.')
+        if not isinstance(body, dict):
+            raise ApiError('Expected a JSON object.')
+        return {key: value if value is None else str(value)
+                for key, value in body.items()}
+    return request.POST.dict()
+
+
+def submit(handler, *args, **kwargs):
+    """
+    Calls a form handler, reporting malformed input (which the handlers
+    let escape as conversion errors) as a 400.
+    :return: The handler's (object, message) tuple.
+    """
+    try:
+        return handler(*args, **kwargs)
+    except (KeyError, ObjectDoesNotExist, TypeError, ValueError):
+        raise ApiError('Missing or invalid fields.')
+
+
+def encode_cursor(appointment):
+    raw = json.dumps([appointment.date.isoformat(), appointment.pk])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :return: The (date, id) an `after` cursor points past.
+    """
+    try:
+        date, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        parsed = dateparse.parse_datetime(date)
+        if parsed is None:
+            raise ValueError(date)
+        return parsed, int(pk)
+    except (binascii.Error, TypeError, ValueError, UnicodeError):
+        raise ApiError('Invalid cursor.')
+
+
+def _parse_bound(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    parsed = dateparse.parse_datetime(value)
+    if parsed is None:
+        raise ApiError('Invalid {0}.'.format(name))
+    return parsed if timezone.is_aware(parsed) else \
+        timezone.make_aware(parsed, timezone.get_current_timezone())
+
+
+def _related(fields):
+    return [name for name in ('patient', 'doctor') if name in fields]
+
+
+def _appointment_queryset(fields, queryset):
+    related = _related(fields)
+    return queryset.select_related(*related) if related else queryset
+
+
+def _appointment_etag(appointment, fields):
+    """
+    The body embeds the patient's and doctor's names when those fields are
+    selected, so their versions are part of the tag as well.
+    """
+    return versioned_etag(appointment.version, 'appointment', appointment.pk,
+                          [getattr(appointment, name).version
+                           for name in _related(fields)],
+                          fields)
+
+
+@api_view('GET', 'POST')
+@ratelimit.limit('booking', json=True)
+def appointments(request):
+    """
+    GET: the logged-in user's schedule, ordered by date. Accepts `start`
+    and `end` bounds, `limit`, `after` and `fields`.
+    POST: books an appointment with the fields of the appointment form
+    (`date`, `duration`, `doctor`, `patient`).
+    """
+    if request.method == 'POST':
+        appointment, message = submit(handle_appointment_form, request,
+                                      request_body(request), request.user)
+        if message:
+            raise ApiError(message, status=409 if 'not free' in message else 400)
+        fields = list(APPOINTMENT_FIELDS)
+        return respond(serialize(appointment, fields, APPOINTMENT_FIELDS),
+                       _appointment_etag(appointment, fields), status=201)
+
+    fields = selected_fields(request, APPOINTMENT_FIELDS)
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_PAGE_SIZE)), 1),
+                    MAX_PAGE_SIZE)
+    except ValueError:
+        raise ApiError('Invalid limit.')
+    schedule = request.user.schedule().order_by('date', 'pk')
+    start = _parse_bound(request, 'start')
+    end = _parse_bound(request, 'end')
+    if start:
+        schedule = schedule.filter(date__gte=start)
+    if end:
+        schedule = schedule.filter(date__lt=end)
+    cursor = request.GET.get('after')
+    if cursor:
+        date, pk = decode_cursor(cursor)
+        schedule = schedule.filter(Q(date__gt=date) | Q(date=date, pk__gt=pk))
+
+    # The ETag is computed from ids and versions alone, those of the
+    # embedded patients and doctors included, so revalidating an unchanged
+    # page costs one narrow query and no serialization.
+    keys = list(schedule.values_list(
+        'pk', 'version',
+        *[name + '__version' for name in _related(fields)])[:limit + 1])
+    etag = make_etag('appointments', API_VERSION, fields, cursor, keys)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+    page = list(_appointment_queryset(fields, schedule)[:limit + 1])
+    has_next = len(page) > limit
+    page = page[:limit]
+    return respond({
+        'results': [serialize(a, fields, APPOINTMENT_FIELDS) for a in page],
+        'next': encode_cursor(page[-1]) if has_next else None,
+    }, etag)
+
+
+@api_view('GET', 'PUT', 'DELETE')
+@ratelimit.limit('booking', methods=('PUT',), json=True)
+def appointment(request, appointment_id):
+    """
+    GET: one appointment from the user's schedule.
+    PUT: changes it in place, with the same fields as POSTing to the list.
+    DELETE: cancels it, offering the slot to the waitlist.
+    """
+    fields = selected_fields(request, APPOINTMENT_FIELDS) \
+        if request.method == 'GET' else list(APPOINTMENT_FIELDS)
+    found = get_object_or_404(_appointment_queryset(fields, request.user.schedule()),
+                              pk=appointment_id)
+    if request.method == 'GET':
+        etag = _appointment_etag(found, fields)
+        return not_modified(request, etag) or \
+            respond(serialize(found, fields, APPOINTMENT_FIELDS), etag)
+    if request.method == 'DELETE':
+        with sharding.atomic():
+            found = get_object_or_404(Appointment.objects.select_for_update()
+                                      .select_related('patient', 'doctor'),
+                                      pk=found.pk)
+            check_precondition(request, found.version)
+            deletion(request, found)
+            events.appointment_changed(found, 'removed')
+            found.delete()
+        waitlist.backfill(request, found)
+        return HttpResponse(status=204)
+    # Fails fast on a stale If-Match; booking.move() checks the version
+    # again under the row lock it writes with.
+    conditional = check_precondition(request, found.version)
+    updated, message = submit(handle_appointment_form, request,
+                              request_body(request), request.user,
+                              appointment=found,
+                              version=found.version if conditional else None)
+    if message == booking.APPOINTMENT_CHANGED:
+        raise ApiError('The resource has changed.', status=412)
+    if message:
+        raise ApiError(message, status=409 if 'not free' in message else 400)
+    updated = _appointment_queryset(fields, Appointment.objects).get(pk=updated.pk)
+    return respond(serialize(updated, fields, APPOINTMENT_FIELDS),
+                   _appointment_etag(updated, fields))
+
+
+def _profile_version(user, medical_information, doctor_information):
+    """
+    :return: The version of a profile, made of the versions of the user and
+             of their medical and doctor information. Group changes
+             increment the user's version (see
+             models.bump_membership_version), so it covers the roles too.
+    """
+    return '{0}-{1}-{2}'.format(
+        user.version, medical_information and medical_information.version,
+        doctor_information and doctor_information.version)
+
+
+def _profile_etag(user, fields):
+    return versioned_etag(
+        _profile_version(user, user.medical_information, user.doctor_information),
+        'user', user.pk, fields)
+
+
+def _lock_profile(user):
+    """
+    Locks a user's row and their medical and doctor information rows until
+    the surrounding transaction ends.
+    :return: The profile's current version.
+    """
+    user = User.objects.select_for_update().get(pk=user.pk)
+    return _profile_version(
+        user,
+        MedicalInformation.objects.select_for_update()
+                                  .filter(pk=user.medical_information_id).first(),
+        DoctorInformation.objects.select_for_update()
+                                 .filter(pk=user.doctor_information_id).first())
+
+
+@api_view('GET', 'PUT')
+def user_profile(request, user_id=None):
+    """
+    GET: a user's profile with their medical and doctor information.
+    PUT: updates it with the fields of the medical information form.
+    Users may read and edit the profiles they can edit in the HTML views.
+    """
+    if user_id is None:
+        user_id = request.user.pk
+    requested = get_object_or_404(
+        User.objects.select_related('medical_information', 'doctor_information'),
+        pk=user_id)
+    if requested != request.user and not request.user.can_edit_user(requested):
+        raise PermissionDenied
+    encryption.decrypt_all([requested.medical_information])
+    fields = selected_fields(request, USER_FIELDS) \
+        if request.method == 'GET' else list(USER_FIELDS)
+    if request.method == 'GET':
+        etag = _profile_etag(requested, fields)
+        return not_modified(request, etag) or \
+            respond(serialize(requested, fields, USER_FIELDS), etag)
+    with sharding.atomic():
+        check_precondition(request, _lock_profile(requested))
+        updated, message = submit(handle_user_form, request,
+                                  request_body(request), user=requested)
+    if message:
+        raise ApiError(message)
+    updated = User.objects.select_related(
+        'medical_information', 'doctor_information').get(pk=updated.pk)
+    encryption.decrypt_all([updated.medical_information])
+    return respond(serialize(updated, fields, USER_FIELDS),
+                   _profile_etag(updated, fields))
@@ -3,3 +3,39 @@ from django.apps import AppConfig
 
 class HealthConfig(AppConfig):
     name = 'health'
+
+    def ready(self):
+        from django.contrib.auth.models import Group
+        from django.contrib.auth.signals import user_logged_in
+        from django.core import checks
+        from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                              pre_delete, pre_save)
+        from . import (clinical, encryption, geo, insurers, models, sharding,
+                       shifts, user_snapshot, utilization)
+        checks.register(encryption.check_revoked_keys, checks.Tags.security)
+        user_snapshot.connect_signals()
+        post_save.connect(models.clear_role_groups, sender=Group)
+        post_delete.connect(models.clear_role_groups, sender=Group)
+        post_save.connect(models.bump_group_members, sender=Group)
+        pre_delete.connect(models.bump_group_members, sender=Group)
+        m2m_changed.connect(models.bump_membership_version,
+                            sender=models.User.groups.through)
+        post_save.connect(geo.clear_hospital_index, sender=models.Hospital)
+        post_delete.connect(geo.clear_hospital_index, sender=models.Hospital)
+        post_save.connect(sharding.mirror_hospital, sender=models.Hospital)
+        post_delete.connect(sharding.unmirror_hospital, sender=models.Hospital)
+        user_logged_in.connect(sharding.remember_database)
+        pre_save.connect(utilization.remember_appointment,
+                         sender=models.Appointment)
+        post_save.connect(utilization.appointment_saved,
+                          sender=models.Appointment)
+        post_delete.connect(utilization.appointment_deleted,
+                            sender=models.Appointment)
+        pre_save.connect(insurers.index_policy, sender=models.Insurance)
+        post_save.connect(shifts.revalidate_shifts, sender=models.DoctorInformation)
+        post_save.connect(clinical.medical_information_saved,
+                          sender=models.MedicalInformation)
+        for name in models.VERSIONED_MODELS:
+            model = self.get_model(name)
+            pre_save.connect(models.bump_version, sender=model)
+            post_save.connect(models.refresh_version, sender=model)
@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+from . import sharding, utilization
+from .models import Appointment, ArchivedAppointment
+
+DEFAULT_HORIZON_DAYS = 365
+DEFAULT_BATCH_SIZE = 500
+
+
+def archive_horizon(now=None, days=None):
+    """
+    :param now: The reference time; defaults to the current time.
+    :param days: The horizon in days; defaults to
+                 settings.APPOINTMENT_ARCHIVE_DAYS.
+    :return: The datetime before which appointments belong in the archive.
+    """
+    if days is None:
+        days = getattr(settings, 'APPOINTMENT_ARCHIVE_DAYS',
+                       DEFAULT_HORIZON_DAYS)
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def archive_batch(before, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Moves one batch of the oldest appointments starting before `before`
+    into the archive. The copy and the delete share a transaction, so a
+    batch is either fully moved or not moved at all.
+    :param before: Appointments starting before this datetime are moved.
+    :param batch_size: The maximum number of appointments to move.
+    :return: The number of appointments moved.
+    """
+    with sharding.atomic():
+        batch = list(Appointment.objects.select_for_update()
+                                        .filter(date__lt=before)
+                                        .order_by('date', 'pk')[:batch_size])
+        if not batch:
+            return 0
+        ArchivedAppointment.objects.bulk_create(
+            [ArchivedAppointment.from_appointment(a) for a in batch])
+        # Archived appointments stay in the utilization summary.
+        with utilization.paused():
+            Appointment.objects.filter(pk__in=[a.pk for a in batch]).delete()
+    return len(batch)
+
+
+def archive_appointments(before=None, batch_size=DEFAULT_BATCH_SIZE,
+                         max_batches=None):
+    """
+    Moves appointments older than the archive horizon out of the live table,
+    one batch per transaction. Every committed batch is durable, so an
+    interrupted run is resumed simply by running it again.
+    :param before: The cutoff; defaults to archive_horizon().
+    :param batch_size: The number of appointments moved per transaction.
+    :param max_batches: Stop after this many batches; None runs to completion.
+    :return: The total number of appointments moved.
+    """
+    before = before or archive_horizon()
+    moved = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        count = archive_batch(before, batch_size)
+        if not count:
+            break
+        moved += count
+        batches += 1
+    return moved
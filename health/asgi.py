@@ -0,0 +1,185 @@
+"""
+An ASGI front for the WSGI application.
+
+Django 2.1 has no ASGI handler, so mediTech.asgi serves the WSGI
+application through this adapter. The event loop does the connection
+work: it holds keep-alive and slow connections and reads request bodies
+and writes responses without a thread. Only the Django handler itself
+runs on a bounded thread pool. An ASGI server with W workers can therefore
+keep far more connections open than W sync WSGI workers, whose threads
+stay busy for the whole life of every request, slow clients included.
+
+Streaming responses are pulled from the pool one chunk at a time, so a
+slow consumer delays only its own next chunk. Responses with an
+`async_stream` (see health.events.EventStreamResponse) are instead
+streamed on the event loop, taking no pool thread however long they stay
+open, and are cancelled when the client disconnects.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import sys
+
+DEFAULT_THREADS = 10
+
+
+class WsgiToAsgi(object):
+    """
+    An ASGI 3 application that runs a WSGI application on a thread pool.
+    """
+
+    def __init__(self, wsgi_application, threads=DEFAULT_THREADS):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix='asgi-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {0}.'.format(scope['type']))
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_event_loop()
+        status, headers, content, streaming = await loop.run_in_executor(
+            self.executor, self.run, self.environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        if not streaming:
+            await send({'type': 'http.response.body', 'body': content})
+            return
+        if getattr(content, 'async_stream', None) is not None:
+            try:
+                await self.stream_async(content.async_stream(), receive, send)
+            finally:
+                await loop.run_in_executor(self.executor, self.close, content)
+            return
+        chunks = iter(content)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await loop.run_in_executor(self.executor, self.close, content)
+
+    async def stream_async(self, chunks, receive, send):
+        """
+        Sends the chunks of an async generator until it ends or the client
+        disconnects.
+        """
+        async def pump():
+            async for chunk in chunks:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        pumping = asyncio.ensure_future(pump())
+        watching = asyncio.ensure_future(disconnected())
+        try:
+            await asyncio.wait([pumping, watching],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if pumping.done():
+                pumping.result()
+        finally:
+            pumping.cancel()
+            watching.cancel()
+            # The generator can only be closed once the pump has let go.
+            await asyncio.wait([pumping, watching])
+            await chunks.aclose()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        """
+        :return: The whole request body, or None if the client went away.
+        """
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def environ(scope, body):
+        """
+        :return: The WSGI environ for an ASGI HTTP scope.
+        """
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # WSGI carries the path as UTF-8 bytes decoded as Latin-1.
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version', '1.1')),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') \
+                else 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    def run(self, environ):
+        """
+        Calls the WSGI application on a pool thread.
+        :return: A tuple of (status code, headers, content, streaming):
+                 the whole body as bytes, or the streaming response itself.
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'),
+                                    value.encode('latin-1'))
+                                   for name, value in headers]
+
+        result = self.wsgi_application(environ, start_response)
+        if getattr(result, 'streaming', False):
+            return response['status'], response['headers'], result, True
+        try:
+            content = b''.join(result)
+        finally:
+            self.close(result)
+        return response['status'], response['headers'], content, False
+
+    @staticmethod
+    def close(result):
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
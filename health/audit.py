@@ -0,0 +1,150 @@
+"""
+Retention for the audit log (django_admin_log), applied by
+`manage.py purge_audit`.
+
+AUDIT_RETENTION maps content types ('app_label.model') to the number of
+days their entries are kept, or None to keep them forever; 'default'
+applies to every other content type and to entries without one.
+
+Each content type's entries are walked in primary key order, a batch at a
+time, on the (content_type_id, id) index, and each batch is deleted by
+primary key in its own short statement, so no lock is held for longer
+than one batch takes. Entries are appended in time order, so the walk
+stops at the first entry still inside the retention period instead of
+scanning the newer ones. Between batches the job sleeps in proportion to
+the time the batch took, which keeps it to a fraction of the database's
+time while the clinic is open.
+
+With an archive file, each batch is written to it as gzip-compressed
+NDJSON and flushed before the batch is deleted. An interrupted run can
+therefore leave a batch both in the archive and in the table, to be
+archived again by the next run; entry ids tell the copies apart.
+"""
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from datetime import timedelta
+import gzip
+import json
+import time
+
+DEFAULT_RETENTION = {'default': None}
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_DUTY_CYCLE = 0.5
+
+
+def retention_policies(retention=None):
+    """
+    :param retention: Overrides settings.AUDIT_RETENTION.
+    :return: A list of (content type or None, days or None) pairs covering
+             every content type, and entries without one.
+    """
+    retention = dict(retention if retention is not None else
+                     getattr(settings, 'AUDIT_RETENTION', DEFAULT_RETENTION))
+    default = retention.pop('default', None)
+    policies = []
+    for content_type in ContentType.objects.order_by('pk'):
+        label = '{0}.{1}'.format(content_type.app_label, content_type.model)
+        policies.append((content_type, retention.get(label, default)))
+    policies.append((None, default))
+    return policies
+
+
+def serialize(entry):
+    return {
+        'id': entry.pk,
+        'action_time': entry.action_time.isoformat(),
+        'user_id': entry.user_id,
+        'content_type': entry.content_type_id and '{0}.{1}'.format(
+            entry.content_type.app_label, entry.content_type.model),
+        'object_id': entry.object_id,
+        'object_repr': entry.object_repr,
+        'action_flag': entry.action_flag,
+        'change_message': entry.change_message,
+    }
+
+
+class Archive(object):
+    """
+    A gzip-compressed NDJSON file that audit entries are appended to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+
+    def write(self, entries):
+        for entry in entries:
+            self.file.write(json.dumps(serialize(entry), sort_keys=True))
+            self.file.write('\n')
+        # Flushed before the batch is deleted, so a crash cannot lose it.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def expired_batch(content_type, cutoff, after, batch_size):
+    """
+    :return: The next entries of a content type after the primary key
+             `after` that are older than `cutoff`, up to batch_size, and
+             whether the walk reached an entry that is not.
+    """
+    entries = LogEntry.objects.filter(content_type=content_type, pk__gt=after) \
+        .select_related('content_type').order_by('pk')[:batch_size]
+    expired = []
+    for entry in entries:
+        if entry.action_time >= cutoff:
+            return expired, True
+        expired.append(entry)
+    return expired, len(expired) < batch_size
+
+
+def purge_content_type(content_type, cutoff, archive=None,
+                       batch_size=DEFAULT_BATCH_SIZE,
+                       duty_cycle=DEFAULT_DUTY_CYCLE, dry_run=False):
+    """
+    Deletes, and archives when given an Archive, the entries of one content
+    type older than `cutoff`, one batch at a time.
+    :param duty_cycle: The fraction of the time the job keeps the database
+                       busy; after a batch taking t seconds it sleeps
+                       t * (1 - duty_cycle) / duty_cycle.
+    :return: The number of entries purged (or, on a dry run, that would be).
+    """
+    purged = 0
+    after = 0
+    while True:
+        started = time.monotonic()
+        expired, done = expired_batch(content_type, cutoff, after, batch_size)
+        if expired:
+            after = expired[-1].pk
+            if not dry_run:
+                if archive is not None:
+                    archive.write(expired)
+                LogEntry.objects.filter(pk__in=[entry.pk for entry in expired]).delete()
+            purged += len(expired)
+        if done:
+            return purged
+        if duty_cycle < 1:
+            time.sleep((time.monotonic() - started) * (1 - duty_cycle) / duty_cycle)
+
+
+def purge_audit_log(retention=None, archive=None, batch_size=DEFAULT_BATCH_SIZE,
+                    duty_cycle=DEFAULT_DUTY_CYCLE, dry_run=False, now=None):
+    """
+    Applies every retention policy.
+    :return: A list of (label, days, number purged) for the content types
+             with a retention period.
+    """
+    now = now or timezone.now()
+    results = []
+    for content_type, days in retention_policies(retention):
+        if days is None:
+            continue
+        purged = purge_content_type(content_type, now - timedelta(days=days),
+                                    archive, batch_size, duty_cycle, dry_run)
+        label = '{0}.{1}'.format(content_type.app_label, content_type.model) \
+            if content_type is not None else '(none)'
+        results.append((label, days, purged))
+    return results
@@ -0,0 +1,257 @@
+"""
+Earliest-available appointment search across many doctors.
+
+Doctors' free time is derived from their DoctorInformation shifts minus the
+appointments and series occurrences already booked. The search walks the
+requested window one day at a time: for each day it loads only that day's
+bookings for the candidate doctors (one query each for appointments, series
+and series exceptions), turns each doctor's free intervals into a lazy slot
+generator and merges the generators through a single priority queue. It
+stops as soon as enough slots have been popped, so the usual "first open
+slot this week" question touches a day or two of bookings rather than every
+schedule. The first day also looks at the shifts of the day before, which
+may run past midnight into the window.
+"""
+from collections import defaultdict, namedtuple
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+from datetime import datetime, time, timedelta
+import heapq
+import itertools
+import re
+from .models import (Appointment, AppointmentSeries, DoctorInformation,
+                     SeriesException, User, MAX_APPOINTMENT_MINUTES)
+
+Slot = namedtuple('Slot', ['start', 'end', 'doctor'])
+
+DEFAULT_STEP_MINUTES = 15
+
+SHIFT_TIME = re.compile(r'^\s*(\d{1,2})(?:[.:](\d{2}))?\s*([AaPp][Mm])\s*$')
+
+
+def parse_shift_time(value):
+    """
+    Parses the shift times offered by the signup form ("7AM", "7.30PM").
+    :return: A datetime.time, or None if the value is empty or malformed.
+    """
+    match = SHIFT_TIME.match(value or '')
+    if not match:
+        return None
+    hour, minute, meridiem = match.groups()
+    hour = int(hour) % 12
+    if meridiem.upper() == 'PM':
+        hour += 12
+    return time(hour, int(minute or 0))
+
+
+def visit_weekdays(doctor_information):
+    """
+    :return: The set of weekday numbers (Monday is 0) the doctor visits on.
+    """
+    visit_days = doctor_information.visit_days or ''
+    return {number for number, day in enumerate(DoctorInformation.VISIT_DAYS)
+            if day in visit_days}
+
+
+def shift_intervals(doctor_information, day):
+    """
+    :param day: A date in the current timezone.
+    :return: The (start, end) datetimes of the doctor's shifts starting on
+             that day. A shift ending at or before its start runs past
+             midnight.
+    """
+    if day.weekday() not in visit_weekdays(doctor_information):
+        return []
+    shifts = [(doctor_information.first_shift_start,
+               doctor_information.first_shift_end)]
+    if doctor_information.two_shift == 'Yes':
+        shifts.append((doctor_information.second_shift_start,
+                       doctor_information.second_shift_end))
+    tz = timezone.get_current_timezone()
+    intervals = []
+    for start, end in shifts:
+        start, end = parse_shift_time(start), parse_shift_time(end)
+        if start is None or end is None:
+            continue
+        start = timezone.make_aware(datetime.combine(day, start), tz)
+        end = timezone.make_aware(datetime.combine(day, end), tz)
+        if end <= start:
+            end += timedelta(days=1)
+        intervals.append((start, end))
+    return sorted(intervals)
+
+
+def merge_intervals(intervals):
+    """
+    :param intervals: (start, end) intervals in any order.
+    :return: The sorted, non-overlapping intervals covering the same time.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_busy(intervals, busy):
+    """
+    Removes busy periods from free intervals.
+    :param intervals: Sorted, non-overlapping (start, end) free intervals.
+    :param busy: (start, end) busy periods in any order.
+    :return: The sorted free intervals left over.
+    """
+    busy = sorted(busy)
+    free = []
+    for start, end in intervals:
+        cursor = start
+        for busy_start, busy_end in busy:
+            if busy_end <= cursor:
+                continue
+            if busy_start >= end:
+                break
+            if busy_start > cursor:
+                free.append((cursor, busy_start))
+            cursor = max(cursor, busy_end)
+        if cursor < end:
+            free.append((cursor, end))
+    return free
+
+
+def _align(moment, step):
+    """
+    :return: `moment` rounded up to the next multiple of `step` minutes
+             past midnight in the current timezone.
+    """
+    local = timezone.localtime(moment)
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    elapsed = (local - midnight) // timedelta(minutes=1)
+    if local != midnight + timedelta(minutes=elapsed):
+        elapsed += 1
+    elapsed = -(-elapsed // step) * step
+    return midnight + timedelta(minutes=elapsed)
+
+
+def free_slots(doctor, free, duration, step):
+    """
+    Lazily yields (start, doctor id, doctor) for every slot of `duration`
+    minutes that fits in the free intervals, every `step` minutes.
+    """
+    length = timedelta(minutes=duration)
+    for start, end in free:
+        slot = _align(start, step)
+        while slot + length <= end:
+            yield slot, doctor.pk, doctor
+            slot += timedelta(minutes=step)
+
+
+def booked_periods(doctor_ids, start, end):
+    """
+    Loads the bookings of several doctors between start and end in three
+    queries: appointments, recurring series and the series' exceptions.
+    :return: A dict mapping doctor id to a list of (start, end) periods.
+    """
+    lookback = start - timedelta(minutes=MAX_APPOINTMENT_MINUTES)
+    busy = defaultdict(list)
+    appointments = (Appointment.objects
+                               .filter(doctor_id__in=doctor_ids,
+                                       date__gte=lookback, date__lt=end)
+                               .values_list('doctor_id', 'date', 'duration'))
+    for doctor_id, date, duration in appointments:
+        busy[doctor_id].append((date, date + timedelta(minutes=duration)))
+    series = (AppointmentSeries.objects
+                               .filter(doctor_id__in=doctor_ids, start__lt=end)
+                               .exclude(until__lt=lookback)
+                               .prefetch_related(Prefetch(
+                                   'exceptions',
+                                   queryset=SeriesException.objects.filter(
+                                       Q(original_date__range=[lookback, end]) |
+                                       Q(new_date__range=[lookback, end])))))
+    for s in series:
+        for occurrence in s.occurrences(start - timedelta(minutes=s.duration), end):
+            busy[s.doctor_id].append((occurrence.date, occurrence.end()))
+    return busy
+
+
+def candidate_doctors(specialisation=None, hospital=None):
+    """
+    :return: The doctors matching the specialisation and hospital, with
+             their DoctorInformation joined in.
+    """
+    doctors = (User.objects.filter(groups__name='Doctor',
+                                   doctor_information__isnull=False)
+                           .select_related('doctor_information'))
+    if specialisation:
+        doctors = doctors.filter(doctor_information__specialisation=specialisation)
+    if hospital:
+        doctors = doctors.filter(hospital=hospital)
+    return doctors
+
+
+def find_earliest_slots(start, end, duration, specialisation=None,
+                        hospital=None, limit=5, step=DEFAULT_STEP_MINUTES):
+    """
+    Finds the earliest open appointment slots across all matching doctors.
+    :param start: The earliest time a slot may start.
+    :param end: The latest time a slot may end.
+    :param duration: The appointment length in minutes.
+    :param specialisation: Restricts the search to one specialisation.
+    :param hospital: Restricts the search to one hospital.
+    :param limit: The number of slots to return.
+    :param step: The spacing between candidate slot starts, in minutes.
+    :return: Up to `limit` Slots ordered by start time, then doctor.
+    """
+    doctors = list(candidate_doctors(specialisation, hospital))
+    if not doctors or limit <= 0:
+        return []
+    heap = []
+    found = []
+    # Breaks ties between identical (start, doctor) entries from
+    # overlapping shifts, so heap entries never compare generators.
+    sequence = itertools.count()
+
+    def push(generator):
+        item = next(generator, None)
+        if item is not None:
+            slot, doctor_id, doctor = item
+            heapq.heappush(heap, (slot, doctor_id, next(sequence), doctor,
+                                  generator))
+
+    def pop():
+        slot, _, _, doctor, generator = heapq.heappop(heap)
+        found.append(Slot(slot, slot + timedelta(minutes=duration), doctor))
+        push(generator)
+
+    day = timezone.localtime(start).date()
+    first_day = day
+    last_day = timezone.localtime(end).date()
+    while day <= last_day and len(found) < limit:
+        shifts = {}
+        for doctor in doctors:
+            intervals = shift_intervals(doctor.doctor_information, day)
+            if day == first_day:
+                # The previous day's overnight shifts run into the window.
+                intervals = shift_intervals(doctor.doctor_information,
+                                            day - timedelta(days=1)) + intervals
+            intervals = merge_intervals((max(s, start), min(e, end))
+                                        for s, e in intervals if s < end and e > start)
+            if intervals:
+                shifts[doctor] = intervals
+        if shifts:
+            window_start = min(i[0][0] for i in shifts.values())
+            window_end = max(i[-1][1] for i in shifts.values())
+            busy = booked_periods([d.pk for d in shifts], window_start, window_end)
+            for doctor, intervals in shifts.items():
+                free = subtract_busy(intervals, busy[doctor.pk])
+                push(free_slots(doctor, free, duration, step))
+        # Anything earlier than the next day's midnight can no longer be
+        # beaten by a shift that has not been loaded yet.
+        day += timedelta(days=1)
+        boundary = timezone.make_aware(datetime.combine(day, time.min),
+                                       timezone.get_current_timezone())
+        while heap and heap[0][0] < boundary and len(found) < limit:
+            pop()
+    while heap and len(found) < limit:
+        pop()
+    return found
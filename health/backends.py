@@ -0,0 +1,32 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from . import sharding
+
+
+class HospitalModelBackend(ModelBackend):
+    """
+    The model backend, looking users up in every hospital database at once
+    when HOSPITAL_DATABASES is set (see health.sharding). Emails are unique
+    across databases, so at most one user matches. Loading the user of an
+    existing session is left to ModelBackend, since the session's database
+    is already current.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if not sharding.enabled():
+            return super().authenticate(request, username, password, **kwargs)
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        found = [user for user in sharding.fan_out(
+            lambda: UserModel._default_manager.filter(
+                **{UserModel.USERNAME_FIELD: username}).first()).values()
+            if user is not None]
+        if not found:
+            # Hash anyway, so unknown emails take as long as wrong passwords.
+            UserModel().set_password(password)
+            return None
+        user = found[0]
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
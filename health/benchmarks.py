@@ -0,0 +1,723 @@
+"""
+Benchmarks run through `manage.py benchmark <name>`.
+
+Each benchmark seeds the data it needs inside a transaction that is rolled
+back afterwards, so benchmarks can be run against a development database
+without leaving rows behind.
+"""
+from django.contrib.auth.models import Group
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+import statistics
+import time
+from . import sharding
+from .models import Appointment, DoctorInformation, Hospital, User
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a function as a named benchmark. The function receives the
+    requested size and repeat count and returns a list of report lines.
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def run(name, size=None, repeat=5):
+    """
+    Runs a registered benchmark inside a rolled-back transaction.
+    :return: The report lines produced by the benchmark.
+    """
+    with sharding.atomic():
+        try:
+            return BENCHMARKS[name](size=size, repeat=repeat)
+        finally:
+            transaction.set_rollback(True, using=sharding.current_database())
+
+
+def measure(function, repeat):
+    """
+    Calls a function `repeat` times.
+    :return: A tuple of (median milliseconds, queries issued per call,
+             result of the last call).
+    """
+    timings = []
+    result = None
+    with CaptureQueriesContext(connection) as queries:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), len(queries) / repeat, result
+
+
+def seed_doctors(count, hospital, specialisation='General Physician',
+                 appointments_per_day=6, days=7):
+    """
+    Creates `count` doctors working 9AM-5PM on weekdays, each with a
+    patient booked into the first hours of every working day.
+    :return: The list of created doctors.
+    """
+    doctor_group, _ = Group.objects.get_or_create(name='Doctor')
+    patient_group, _ = Group.objects.get_or_create(name='Patient')
+    patient = User(username='benchmark-patient', email='benchmark-patient@example.com')
+    patient.set_unusable_password()
+    patient.save()
+    patient_group.user_set.add(patient)
+    informations = DoctorInformation.objects.bulk_create([
+        DoctorInformation(specialisation=specialisation,
+                          visit_days='Monday,Tuesday,Wednesday,Thursday,Friday',
+                          two_shift='No', first_shift_start='9AM',
+                          first_shift_end='5PM')
+        for _ in range(count)
+    ])
+    for information in informations:
+        if information.pk is None:
+            # Backends that do not return bulk-inserted keys.
+            information.save()
+    doctors = []
+    for number, information in enumerate(informations):
+        doctor = User(username='benchmark-doctor-{0}'.format(number),
+                      email='benchmark-doctor-{0}@example.com'.format(number),
+                      hospital=hospital, doctor_information=information)
+        doctor.set_unusable_password()
+        doctors.append(doctor)
+    User.objects.bulk_create(doctors)
+    doctors = list(User.objects.filter(username__startswith='benchmark-doctor-'))
+    User.groups.through.objects.bulk_create([
+        User.groups.through(user_id=doctor.pk, group_id=doctor_group.pk)
+        for doctor in doctors
+    ])
+    today = timezone.localtime().replace(hour=9, minute=0, second=0,
+                                         microsecond=0)
+    Appointment.objects.bulk_create([
+        Appointment(patient=patient, doctor=doctor, duration=30,
+                    date=today + timedelta(days=day, minutes=30 * slot))
+        for doctor in doctors
+        for day in range(days)
+        for slot in range(appointments_per_day)
+    ])
+    return doctors
+
+
+@benchmark('availability')
+def availability_benchmark(size=None, repeat=5):
+    """
+    Earliest-available search over `size` (default 500) doctors of one
+    specialisation at one hospital, each with a week of bookings.
+    """
+    from .availability import find_earliest_slots
+    size = size or 500
+    hospital = Hospital.objects.create(name='Benchmark Hospital',
+                                       address='1 Main St', city='Hartford',
+                                       state='CT', zipcode='06101')
+    seed_doctors(size, hospital)
+    start = timezone.now()
+    end = start + timedelta(days=7)
+    lines = ['{0} doctors, {1} appointments'.format(
+        size, Appointment.objects.filter(doctor__hospital=hospital).count())]
+    for limit in (1, 10, 100):
+        ms, queries, slots = measure(
+            lambda: find_earliest_slots(start, end, 30,
+                                        specialisation='General Physician',
+                                        hospital=hospital, limit=limit),
+            repeat)
+        lines.append('first {0:>3} slots: {1:8.1f} ms, {2:.0f} queries, '
+                     'earliest {3}'.format(limit, ms, queries,
+                                           slots[0].start if slots else None))
+    return lines
+
+
+# The schedule table as it was rendered before the user_link filter, with
+# one {% include %} per cell.
+INCLUDE_TEMPLATES = {
+    'user_link.html': '<a href="{% url \'medical_information\' user.pk %}">'
+                      '{{ user.get_full_name }}</a>',
+    'appointment_table.html': (
+        '{% for appointment in schedule %}<tr>'
+        '<td>{% include \'user_link.html\' with user=appointment.patient %}</td>'
+        '<td>{% include \'user_link.html\' with user=appointment.doctor %}</td>'
+        '<td>{{ appointment.date }}</td>'
+        '<td>{{ appointment.duration }} minutes</td>'
+        '{% if editable %}<td>{% url \'edit_appointment\' appointment.pk %}</td>'
+        '<td>{% url \'delete_appointment\' appointment.pk %}</td>{% endif %}'
+        '</tr>{% endfor %}'
+    ),
+}
+
+
+@benchmark('schedule_render')
+def schedule_render_benchmark(size=None, repeat=5):
+    """
+    Renders a schedule table of `size` (default 1,000) appointments with
+    the per-cell include it used to have and with the current template,
+    which includes appointment_row.html once per row. Appointments are
+    built in memory, so only rendering is measured.
+    """
+    from django.template import Context, Engine
+    from django.template.loader import get_template
+    size = size or 1000
+    users = [User(pk=n + 1, first_name='First{0}'.format(n),
+                  last_name='Last{0}'.format(n)) for n in range(50)]
+    now = timezone.now()
+    schedule = [Appointment(pk=n + 1, patient=users[n % 50],
+                            doctor=users[(n + 7) % 50],
+                            date=now + timedelta(minutes=30 * n), duration=30)
+                for n in range(size)]
+    context = {'schedule': schedule, 'editable': True}
+    engine = Engine(loaders=[('django.template.loaders.locmem.Loader',
+                              INCLUDE_TEMPLATES)])
+    included = engine.get_template('appointment_table.html')
+    current = get_template('health/appointment_table.html')
+    before, _, _ = measure(lambda: included.render(Context(context)), repeat)
+    after, _, _ = measure(lambda: current.render(context), repeat)
+    return [
+        '{0} rows'.format(size),
+        'include per cell: {0:8.1f} ms'.format(before),
+        'include per row:  {0:8.1f} ms'.format(after),
+    ]
+
+
+@benchmark('admin_changelist')
+def admin_changelist_benchmark(size=None, repeat=5):
+    """
+    Loads the Appointment changelist over `size` (default 1,000,000)
+    appointments with a default ModelAdmin and with AppointmentAdmin,
+    unfiltered, drilled into one month and searched by last name.
+    """
+    from django.contrib import admin
+    from django.test import RequestFactory
+    from .admin import AppointmentAdmin
+    size = size or 1000000
+    users = [User(username='benchmark-user-{0}'.format(n),
+                  email='benchmark-user-{0}@example.com'.format(n),
+                  last_name='Last{0}'.format(n))
+             for n in range(max(size // 1000, 20))]
+    User.objects.bulk_create(users)
+    user_ids = list(User.objects.filter(username__startswith='benchmark-user-')
+                    .values_list('pk', flat=True))
+    start = timezone.now() - timedelta(days=365)
+    for offset in range(0, size, 10000):
+        Appointment.objects.bulk_create([
+            Appointment(patient_id=user_ids[n % len(user_ids)],
+                        doctor_id=user_ids[(n * 7 + 1) % len(user_ids)],
+                        date=start + timedelta(minutes=30 * n), duration=30)
+            for n in range(offset, min(offset + 10000, size))
+        ])
+    superuser = User(username='benchmark-admin', is_staff=True, is_superuser=True)
+    superuser.set_unusable_password()
+    superuser.save()
+    factory = RequestFactory()
+    month = start + timedelta(days=30)
+
+    def load(model_admin, **params):
+        request = factory.get('/admin/health/appointment/', params)
+        request.user = superuser
+        return model_admin.changelist_view(request).render()
+
+    lines = ['{0} appointments, {1} users'.format(size, len(user_ids))]
+    admins = [('default ModelAdmin', admin.ModelAdmin(Appointment, admin.site)),
+              ('AppointmentAdmin', AppointmentAdmin(Appointment, admin.site))]
+    for label, params in [('unfiltered', {}),
+                          ('one month', {'date__year': month.year,
+                                         'date__month': month.month}),
+                          ('search', {'q': 'Last1'})]:
+        for name, model_admin in admins:
+            if 'q' in params and not model_admin.search_fields:
+                continue
+            ms, queries, _ = measure(lambda: load(model_admin, **params), repeat)
+            lines.append('{0:<10} {1:<18}: {2:8.1f} ms, {3:.0f} queries'.format(
+                label, name, ms, queries))
+    return lines
+
+
+@benchmark('nearest_hospitals')
+def nearest_hospitals_benchmark(size=None, repeat=5):
+    """
+    Nearest-hospital queries over `size` (default 5,000) hospitals spread
+    over the continental United States, against a linear scan.
+    """
+    from . import geo
+    import heapq
+    import random
+    size = size or 5000
+    generator = random.Random(size)
+    Hospital.objects.bulk_create([
+        Hospital(name='Benchmark Hospital {0}'.format(n), address='1 Main St',
+                 city='Hartford', state='CT', zipcode='06101',
+                 latitude=generator.uniform(25, 49),
+                 longitude=generator.uniform(-124, -67))
+        for n in range(size)
+    ])
+    geo.clear_hospital_index()
+    build_ms, _, index = measure(geo.hospital_index, 1)
+    queries = [(generator.uniform(25, 49), generator.uniform(-124, -67))
+               for _ in range(100)]
+    lines = ['{0} hospitals, index built in {1:.1f} ms'.format(len(index), build_ms)]
+
+    def linear(latitude, longitude, limit):
+        point = geo.to_vector(latitude, longitude)
+        return heapq.nsmallest(limit, (
+            (sum((a - b) ** 2 for a, b in zip(point, vector)), hospital.pk)
+            for vector, hospital in zip(index.points, index.items)))
+    for limit in (1, 10, 50):
+        tree_ms, _, _ = measure(lambda: [geo.nearest_hospitals(lat, lon, limit)
+                                         for lat, lon in queries], repeat)
+        scan_ms, _, _ = measure(lambda: [linear(lat, lon, limit)
+                                         for lat, lon in queries], repeat)
+        lines.append('nearest {0:>2}: k-d tree {1:.3f} ms, linear scan {2:.3f} ms '
+                     'per query'.format(limit, tree_ms / len(queries),
+                                        scan_ms / len(queries)))
+    geo.clear_hospital_index()
+    return lines
+
+
+@benchmark('reminders')
+def reminders_benchmark(size=None, repeat=1):
+    """
+    Runs the reminder scheduler over `size` (default 100,000) appointments
+    booked within the next hour, sending through the in-memory email
+    backend, and reports the sustained rate and the largest heap held.
+    """
+    from django.core import mail
+    from .reminders import EmailSender, ReminderScheduler
+    size = size or 100000
+    patients = [User(username='benchmark-patient-{0}'.format(n),
+                     email='benchmark-patient-{0}@example.com'.format(n))
+                for n in range(100)]
+    User.objects.bulk_create(patients)
+    patient_ids = list(User.objects.filter(username__startswith='benchmark-patient-')
+                       .values_list('pk', flat=True))
+    now = timezone.now()
+    lead = timedelta(hours=1)
+    for offset in range(0, size, 10000):
+        Appointment.objects.bulk_create([
+            Appointment(patient_id=patient_ids[n % 100],
+                        doctor_id=patient_ids[(n + 1) % 100], duration=30,
+                        date=now + lead + timedelta(seconds=3600 * n / size))
+            for n in range(offset, min(offset + 10000, size))
+        ])
+    scheduler = ReminderScheduler(
+        EmailSender('django.core.mail.backends.locmem.EmailBackend'),
+        lead=lead, window=timedelta(minutes=5), now=now)
+    mail.outbox = []
+    sent = 0
+    largest_heap = 0
+    started = time.perf_counter()
+    # Step the clock a minute at a time through the hour of reminders.
+    for minute in range(62):
+        sent += scheduler.run_once(now + timedelta(minutes=minute))
+        largest_heap = max(largest_heap, len(scheduler.heap))
+    seconds = time.perf_counter() - started
+    mail.outbox = []
+    return [
+        '{0} appointments over one hour, {1} reminders sent'.format(size, sent),
+        '{0:.1f} s of work, {1:,.0f} reminders per hour sustainable'.format(
+            seconds, sent / seconds * 3600),
+        'largest heap: {0} entries'.format(largest_heap),
+    ]
+
+
+@benchmark('asgi_capacity')
+def asgi_capacity_benchmark(size=None, repeat=1):
+    """
+    Serves `size` (default 800) requests for the login page from 200
+    concurrent clients that each take 50 ms to send their request, once
+    with sync WSGI worker threads, which are held while the client sends,
+    and once through the ASGI adapter, with the same number of threads.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from django.core.handlers.wsgi import WSGIHandler
+    from .asgi import WsgiToAsgi
+    size = size or 800
+    threads = 8
+    connections = 200
+    delay = 0.05
+    wsgi_application = WSGIHandler()
+    scope = {'type': 'http', 'method': 'GET', 'path': '/login/',
+             'query_string': b'', 'headers': [(b'host', b'localhost')],
+             'server': ('localhost', 80), 'client': ('127.0.0.1', 40000)}
+
+    def wsgi_request():
+        time.sleep(delay)  # The worker thread reads from the slow client.
+        environ = WsgiToAsgi.environ(scope, b'')
+        result = wsgi_application(environ, lambda status, headers: None)
+        b''.join(result)
+        result.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for future in [pool.submit(wsgi_request) for _ in range(size)]:
+            future.result()
+    wsgi_seconds = time.perf_counter() - started
+
+    asgi_application = WsgiToAsgi(wsgi_application, threads=threads)
+
+    async def asgi_request(limit):
+        async with limit:
+            async def receive():
+                await asyncio.sleep(delay)  # The loop waits on the client.
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                pass
+            await asgi_application(scope, receive, send)
+
+    async def serve():
+        limit = asyncio.Semaphore(connections)
+        await asyncio.gather(*[asgi_request(limit) for _ in range(size)])
+
+    started = time.perf_counter()
+    asyncio.run(serve())
+    asgi_seconds = time.perf_counter() - started
+    asgi_application.executor.shutdown()
+    return [
+        '{0} requests, {1} clients, {2:.0f} ms to send each request, '
+        '{3} threads'.format(size, connections, delay * 1000, threads),
+        'WSGI: {0:7.1f} requests/s, {1} connections served at once'.format(
+            size / wsgi_seconds, threads),
+        'ASGI: {0:7.1f} requests/s, up to {1} connections served at once'.format(
+            size / asgi_seconds, connections),
+    ]
+
+
+@benchmark('query_pool')
+def query_pool_benchmark(size=None, repeat=20):
+    """
+    Times `size` (default 4) queries run on the query thread pool, as
+    gather() runs them: once with every task closing its connection
+    afterwards, so each query connects first, and once keeping connections
+    for as long as the database's CONN_MAX_AGE allows. Connecting is part
+    of every timing, and the connections opened per call are counted. The
+    pool cannot see the benchmark's transaction, so the queries read
+    committed rows only.
+    """
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    from . import concurrency
+    size = size or 4
+    database = sharding.current_database()
+    opened = []
+
+    def count(sender, connection, **kwargs):
+        opened.append(connection.alias)
+
+    def query():
+        return list(User.objects.order_by('pk').values_list('pk', flat=True)[:50])
+
+    def reconnecting():
+        try:
+            return query()
+        finally:
+            connections[database].close()
+
+    lines = ['{0} queries per call on {1} threads'.format(
+        size, concurrency.executor()._max_workers)]
+    connection_created.connect(count)
+    try:
+        for label, function in (('new connection per query', reconnecting),
+                                ('CONN_MAX_AGE={0}'.format(
+                                    connections[database].settings_dict['CONN_MAX_AGE']),
+                                 query)):
+            del opened[:]
+            ms, _, _ = measure(lambda: [
+                future.result() for future in [
+                    concurrency.executor().submit(concurrency._in_pool,
+                                                  function, database)
+                    for _ in range(size)]], repeat)
+            lines.append('{0:<35} {1:8.1f} ms, {2:.1f} connections opened'.format(
+                label, ms, len(opened) / repeat))
+    finally:
+        connection_created.disconnect(count)
+    return lines
+
+
+@benchmark('schedule_events')
+def schedule_events_benchmark(size=None, repeat=5):
+    """
+    Compares what one appointment change costs while `size` (default 50)
+    pages show the schedule of a doctor with 200 upcoming appointments:
+    every page reloading, as they did after each change, against one event
+    published to the pages' streams.
+    """
+    from django.contrib.sessions.backends.base import SessionBase
+    from django.test import RequestFactory
+    from . import events
+    from .views import schedule
+    size = size or 50
+    hospital = Hospital.objects.create(name='Benchmark Hospital')
+    doctor, = seed_doctors(1, hospital, appointments_per_day=8, days=25)
+    appointment = Appointment.objects.filter(doctor=doctor) \
+        .select_related('patient', 'doctor').last()
+    request = RequestFactory().get('/schedule/')
+    request.user = doctor
+    request.session = SessionBase()
+    reload, reload_queries, _ = measure(lambda: schedule(request), repeat)
+
+    broker = events.LocalBroker()
+    topics = events.watched_topics(doctor, request.GET)
+
+    def publish():
+        broker.publish(events.topics_for(appointment), 'appointment',
+                       events._payload('changed', appointment, appointment.pk))
+        # Each page's stream reads the event from where it last stopped.
+        for _ in range(size):
+            broker.read(broker.last_id - 1, topics)
+
+    fan_out, fan_out_queries, _ = measure(publish, repeat)
+    return [
+        '{0} pages open, one change'.format(size),
+        'every page reloads: {0:8.1f} ms, {1:.0f} queries'.format(
+            reload * size, reload_queries * size),
+        'one event, fanned out: {0:8.1f} ms, {1:.0f} queries'.format(
+            fan_out, fan_out_queries),
+    ]
+
+
+@benchmark('login_spike')
+def login_spike_benchmark(size=None, repeat=1):
+    """
+    Times `size` (default 20) logins by separate clients while 32 threads
+    from 4 addresses flood the login form with wrong passwords, once
+    without admission control and once with the configured RATE_LIMITS and
+    CONCURRENCY_LIMITS. The accounts do not exist, which costs the same
+    password hashing as a wrong password.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from django.contrib.sessions.backends.base import SessionBase
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.cache import cache
+    from django.test import RequestFactory
+    from django.test.utils import override_settings
+    from .views import login_view
+    import threading
+    size = size or 20
+    attackers = 32
+    factory = RequestFactory()
+
+    def attempt(address, email):
+        request = factory.post('/login/', {'email': email, 'password': 'wrong'},
+                               REMOTE_ADDR=address)
+        request.user = AnonymousUser()
+        request.session = SessionBase()
+        started = time.perf_counter()
+        status = login_view(request).status_code
+        return (time.perf_counter() - started) * 1000, status
+
+    def spike():
+        cache.clear()
+        done = threading.Event()
+
+        def flood(number):
+            while not done.is_set():
+                attempt('10.0.0.{0}'.format(number % 4),
+                        'victim{0}@example.com'.format(number))
+
+        with ThreadPoolExecutor(max_workers=attackers) as pool:
+            for number in range(attackers):
+                pool.submit(flood, number)
+            time.sleep(0.5)
+            results = [attempt('192.168.0.{0}'.format(n), 'patient{0}@example.com'.format(n))
+                       for n in range(size)]
+            done.set()
+        timings = sorted(ms for ms, _ in results)
+        refused = sum(1 for _, status in results if status == 429)
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], refused
+
+    with override_settings(RATE_LIMITS={}, CONCURRENCY_LIMITS={}):
+        before = spike()
+    after = spike()
+    cache.clear()
+    return [
+        '{0} logins during a flood from {1} threads'.format(size, attackers),
+        'no admission control: median {0:7.1f} ms, p95 {1:7.1f} ms, {2} refused'.format(*before),
+        'rate and concurrency limits: median {0:7.1f} ms, p95 {1:7.1f} ms, {2} refused'.format(*after),
+    ]
+
+
+@benchmark('shift_revalidation')
+def shift_revalidation_benchmark(size=None, repeat=5):
+    """
+    Revalidates a doctor with `size` (default 5,000) future appointments
+    after their shift is shortened, which flags the afternoon and weekend
+    bookings, and again after it is restored, which unflags the afternoon
+    ones.
+    """
+    from .shifts import outside_shifts, revalidate, shift_cover
+    size = size or 5000
+    hospital = Hospital.objects.create(name='Benchmark Hospital',
+                                       address='1 Main St', city='Hartford',
+                                       state='CT', zipcode='06101')
+    per_day = 16
+    doctor = seed_doctors(1, hospital, appointments_per_day=per_day,
+                          days=-(-size // per_day))[0]
+    information = doctor.doctor_information
+    now = timezone.now() - timedelta(hours=1)
+    lines = ['{0} future appointments'.format(
+        Appointment.objects.filter(doctor=doctor, date__gte=now).count())]
+    for label, shift_end in (('shortened to 9AM-1PM', '1PM'),
+                             ('restored to 9AM-5PM', '5PM')):
+        information.first_shift_end = shift_end
+
+        def run_once():
+            # Each run starts from the flags as they were before the change.
+            with sharding.atomic():
+                outside = revalidate(doctor, now)
+                transaction.set_rollback(True, using=sharding.current_database())
+            return outside
+
+        ms, queries, outside = measure(run_once, repeat)
+        lines.append('{0}: {1:7.1f} ms, {2:.0f} queries, {3} outside'.format(
+            label, ms, queries, len(outside)))
+        revalidate(doctor, now)
+    bookings = [(a.pk, a.date, a.end()) for a in
+                Appointment.objects.filter(doctor=doctor, date__gte=now).order_by('date')]
+    ms, _, _ = measure(lambda: outside_shifts(bookings, shift_cover(
+        information, bookings[0][1], bookings[-1][2])), repeat)
+    lines.append('interval arithmetic alone: {0:7.1f} ms'.format(ms))
+    lines.append('{0} appointments flagged'.format(
+        Appointment.objects.filter(doctor=doctor,
+                                   outside_shift_since__isnull=False).count()))
+    return lines
+
+
+@benchmark('phi_encryption')
+def phi_encryption_benchmark(size=None, repeat=5):
+    """
+    Lists `size` (default 2,000) patients with their medical information
+    and insurance and reads every encrypted field, for records stored in
+    plaintext and for encrypted ones decrypted on first read of each
+    instance, in batches, and through the encrypting queryset. The data key
+    cache is cleared before every run.
+    """
+    from django.test.utils import override_settings
+    from . import encryption
+    from .models import Insurance, MedicalInformation
+    size = size or 2000
+    fields = {
+        MedicalInformation: [field.name for field in
+                             encryption.encrypted_fields(MedicalInformation)],
+        Insurance: [field.name for field in encryption.encrypted_fields(Insurance)],
+    }
+
+    def seed(prefix):
+        for number in range(size):
+            insurance = Insurance.objects.create(
+                company='Benchmark Mutual', policy_number='POL-{0:08d}'.format(number))
+            information = MedicalInformation.objects.create(
+                sex='Female', insurance=insurance, medications='Lisinopril 10mg',
+                allergies='Penicillin, peanuts', medical_conditions='Hypertension',
+                family_history='Type 2 diabetes', additional_info='None')
+            User.objects.create(username='{0}-{1}'.format(prefix, number),
+                                medical_information=information)
+        return User.objects.filter(username__startswith=prefix + '-') \
+            .select_related('medical_information__insurance')
+
+    def read(information):
+        for obj in (information, information.insurance):
+            for name in fields[type(obj)]:
+                getattr(obj, name)
+
+    def per_instance(users):
+        encryption.clear_key_cache()
+        for user in users.all():
+            read(user.medical_information)
+
+    def batched(users):
+        encryption.clear_key_cache()
+        informations = [user.medical_information for user in users.all()]
+        encryption.decrypt_all(informations + [i.insurance for i in informations])
+        for information in informations:
+            read(information)
+
+    def queryset():
+        encryption.clear_key_cache()
+        informations = list(MedicalInformation.objects.filter(
+            pk__in=encrypted.values('medical_information')))
+        insurances = {i.pk: i for i in Insurance.objects.filter(
+            pk__in=[information.insurance_id for information in informations])}
+        for information in informations:
+            information.insurance = insurances[information.insurance_id]
+            read(information)
+
+    with override_settings(PHI_MASTER_KEY=None):
+        plaintext = seed('benchmark-plain')
+    encrypted = seed('benchmark-encrypted')
+    # Seeding fills the query log, which measure() counts from.
+    reset_queries()
+    lines = ['{0} patients, {1} encrypted fields each'.format(
+        size, len(fields[MedicalInformation]) + len(fields[Insurance]))]
+    for label, function in (
+            ('plaintext', lambda: per_instance(plaintext)),
+            ('encrypted, decrypted per instance', lambda: per_instance(encrypted)),
+            ('encrypted, decrypt_all()', lambda: batched(encrypted)),
+            ('encrypted, EncryptedQuerySet', queryset)):
+        ms, queries, _ = measure(function, repeat)
+        lines.append('{0:<35} {1:8.1f} ms, {2:.0f} queries'.format(label, ms, queries))
+    encryption.clear_key_cache()
+    return lines
+
+
+@benchmark('insurer_lookup')
+def insurer_lookup_benchmark(size=None, repeat=5):
+    """
+    Seeds `size` (default 5,000) patients on policies of 20 insurers, with
+    every company name written three ways, and times normalizing them with
+    normalize_insurance(). Then times finding the patients on one policy
+    and the patients of one insurer, by scanning and decrypting every
+    policy and through the Policy indexes.
+    """
+    from . import insurers
+    from .models import Insurance, MedicalInformation
+    size = size or 5000
+    spellings = ('Insurer {0}', 'insurer {0} inc', 'INSURER {0}, LLC')
+    # Every third policy number is shared by two patients.
+    shared = [number - number % 3 // 2 for number in range(size)]
+    Insurance.objects.bulk_create([
+        Insurance(company=spellings[number % 3].format(shared[number] % 20),
+                  policy_number='POL-{0:08d}'.format(shared[number]))
+        for number in range(size)])
+    policies = list(Insurance.objects.order_by('-pk').values_list('pk', flat=True)[:size])
+    MedicalInformation.objects.bulk_create([
+        MedicalInformation(sex='Female', insurance_id=pk) for pk in policies])
+    informations = MedicalInformation.objects.order_by('-pk') \
+        .values_list('pk', flat=True)[:size]
+    User.objects.bulk_create([
+        User(username='benchmark-insured-{0}'.format(pk), medical_information_id=pk)
+        for pk in informations])
+    reset_queries()
+    lines = ['{0} patients'.format(size)]
+    ms, queries, normalized = measure(insurers.normalize_insurance, 1)
+    lines.append('{0:<35} {1:8.1f} ms, {2:.0f} queries ({3} rows)'.format(
+        'normalize_insurance()', ms, queries, normalized))
+    company, number = 'Insurer 7', 'POL-00000007'
+
+    def scan_policy():
+        key, wanted = insurers.normalize_name(company), insurers.normalize_policy(number)
+        return list(User.objects.filter(medical_information__insurance__in=[
+            insurance.pk for insurance in Insurance.objects.all()
+            if insurers.normalize_name(insurance.company) == key and
+            insurers.normalize_policy(insurance.policy_number) == wanted]))
+
+    def scan_insurer():
+        key = insurers.normalize_name(company)
+        return list(User.objects.filter(medical_information__insurance__in=[
+            insurance.pk for insurance in Insurance.objects.all()
+            if insurers.normalize_name(insurance.company) == key]))
+
+    for label, function in (
+            ('policy, scan', scan_policy),
+            ('policy, index', lambda: list(insurers.patients_with_policy(company, number))),
+            ('insurer, scan', scan_insurer),
+            ('insurer, index', lambda: list(insurers.patients_by_insurer(
+                insurers.find_insurer(company))[:insurers.REPORT_LIMIT]))):
+        ms, queries, _ = measure(function, repeat)
+        lines.append('{0:<35} {1:8.1f} ms, {2:.0f} queries'.format(label, ms, queries))
+    return lines
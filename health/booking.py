@@ -0,0 +1,113 @@
+"""
+The conflict-safe booking path shared by the appointment form and the
+waitlist matcher.
+
+Checking that both people are free and inserting the appointment is a
+read-then-write, so two requests booking the same doctor could both see
+the slot free. Booking therefore locks the doctor's and patient's user
+rows first, in primary key order to avoid deadlocks, which serializes
+every booking involving either of them until the transaction ends.
+Moving an appointment locks its own row before the people's, as the bulk
+operations do. Moving one occurrence of a series locks only the people.
+"""
+from django.db import transaction
+import copy
+from .models import Appointment, MAX_APPOINTMENT_MINUTES, User
+from . import events, recurrence, sharding
+
+DOCTOR_BUSY = "The doctor is not free at that time. Please specify a different time."
+PATIENT_BUSY = "The patient is not free at that time. Please specify a different time."
+INVALID_DURATION = "Appointments must last between 1 and {0} minutes.".format(
+    MAX_APPOINTMENT_MINUTES)
+APPOINTMENT_CHANGED = "The appointment has changed. Please reload it and try again."
+
+
+def lock_people(*users):
+    """
+    Locks the users' rows until the surrounding transaction ends.
+    """
+    list(User.objects.select_for_update()
+         .filter(pk__in={user.pk for user in users})
+         .order_by('pk').values_list('pk', flat=True))
+
+
+def book(doctor, patient, date, duration):
+    """
+    Creates an appointment if the doctor and patient are both free.
+    Must be called inside a transaction.
+    :return: A tuple of (appointment, None), or (None, failure message).
+    """
+    assert transaction.get_connection(sharding.current_database()).in_atomic_block, \
+        'book() must run inside a transaction.'
+    if not 0 < duration <= MAX_APPOINTMENT_MINUTES:
+        return None, INVALID_DURATION
+    lock_people(doctor, patient)
+    if not doctor.is_free(date, duration):
+        return None, DOCTOR_BUSY
+    if not patient.is_free(date, duration):
+        return None, PATIENT_BUSY
+    appointment = Appointment.objects.create(date=date, duration=duration,
+                                             doctor=doctor, patient=patient)
+    events.appointment_changed(appointment, 'added')
+    return appointment, None
+
+
+def move(appointment, doctor, patient, date, duration, version=None):
+    """
+    Changes an appointment in place, keeping its id, if the doctor and
+    patient are both free. Must be called inside a transaction.
+    :param version: The version the caller last saw, to refuse the change
+                    if the appointment has changed since, or None.
+    :return: A tuple of (appointment, None), or (None, failure message).
+    """
+    assert transaction.get_connection(sharding.current_database()).in_atomic_block, \
+        'move() must run inside a transaction.'
+    if not 0 < duration <= MAX_APPOINTMENT_MINUTES:
+        return None, INVALID_DURATION
+    current = Appointment.objects.select_for_update().filter(pk=appointment.pk)
+    if version is not None:
+        current = current.filter(version=version)
+    current = current.first()
+    if current is None:
+        return None, APPOINTMENT_CHANGED
+    lock_people(doctor, patient)
+    if not doctor.is_free(date, duration, exclude=current):
+        return None, DOCTOR_BUSY
+    if not patient.is_free(date, duration, exclude=current):
+        return None, PATIENT_BUSY
+    previous = copy.copy(current)
+    current.date, current.duration = date, duration
+    current.doctor, current.patient = doctor, patient
+    current.save()
+    if (previous.doctor_id, previous.patient_id) == (doctor.pk, patient.pk):
+        events.appointment_changed(current, 'changed')
+    else:
+        events.appointment_changed(previous, 'removed')
+        events.appointment_changed(current, 'added')
+    return current, None
+
+
+def move_occurrence(series, original_date, date, duration=None):
+    """
+    Moves one occurrence of a series, if the doctor and patient are both
+    free at the new date. Must be called inside a transaction.
+    :param duration: The occurrence's new length, or None to keep the
+                     series' duration.
+    :return: A tuple of (exception, None), or (None, failure message).
+    """
+    database = sharding.current_database()
+    assert transaction.get_connection(database).in_atomic_block, \
+        'move_occurrence() must run inside a transaction.'
+    if duration is not None and not 0 < duration <= MAX_APPOINTMENT_MINUTES:
+        return None, INVALID_DURATION
+    lock_people(series.doctor, series.patient)
+    # Skipped first, so the occurrence does not clash with itself.
+    savepoint = transaction.savepoint(using=database)
+    recurrence.skip_occurrence(series, original_date)
+    for person, message in ((series.doctor, DOCTOR_BUSY),
+                            (series.patient, PATIENT_BUSY)):
+        if not person.is_free(date, duration or series.duration):
+            transaction.savepoint_rollback(savepoint, using=database)
+            return None, message
+    transaction.savepoint_commit(savepoint, using=database)
+    return recurrence.move_occurrence(series, original_date, date, duration), None
@@ -0,0 +1,149 @@
+"""
+Bulk operations over a doctor's appointments in a time range, used when a
+doctor's day has to be cancelled or shifted as a whole.
+
+Each operation locks the affected rows (rescheduling also locks the
+doctor's and patients' user rows, as booking does, so no booking can take
+a slot the appointments move into), changes them with one set-based
+statement and writes all of its audit entries with one INSERT, all inside
+a single transaction. Once it commits, the freed slots are offered to the
+waitlist.
+"""
+from collections import defaultdict
+from django.contrib.admin.models import CHANGE, DELETION
+from django.db.models import F, Q
+from datetime import timedelta
+import copy
+from .form_utilities import log_batch
+from .models import Appointment, AppointmentSeries, MAX_APPOINTMENT_MINUTES
+from . import booking, events, sharding, shifts, utilization, waitlist
+
+
+def doctor_appointments(doctor, start, end):
+    """
+    :return: The doctor's appointments starting in [start, end).
+    """
+    return Appointment.objects.filter(doctor=doctor, date__gte=start,
+                                      date__lt=end)
+
+
+def _lock(doctor, start, end):
+    """
+    Locks and loads the doctor's appointments in the range, with the users
+    their audit representations need.
+    """
+    return list(doctor_appointments(doctor, start, end)
+                .select_for_update()
+                .select_related('patient', 'doctor')
+                .order_by('date'))
+
+
+def cancel_appointments(request, doctor, start, end):
+    """
+    Cancels every appointment the doctor has starting in [start, end).
+    :return: The number of appointments cancelled.
+    """
+    with sharding.atomic():
+        appointments = _lock(doctor, start, end)
+        if not appointments:
+            return 0
+        log_batch(request, appointments, DELETION)
+        events.appointments_changed(appointments, 'removed')
+        with utilization.batched():
+            Appointment.objects.filter(
+                pk__in=[a.pk for a in appointments]).delete()
+    waitlist.backfill_many(request, appointments)
+    return len(appointments)
+
+
+def find_conflicts(appointments, delta):
+    """
+    Checks whether moving the appointments by `delta` would overlap anything
+    else their doctors or patients have booked. All other bookings in the
+    affected window are loaded with one query for appointments and one for
+    series, then each person's timeline is checked in a single sorted sweep.
+    :return: The first moved appointment that would conflict, or None.
+    """
+    moving = {a.pk: (a, a.date + delta, a.end() + delta) for a in appointments}
+    people = set()
+    for appointment in appointments:
+        people.update((appointment.doctor_id, appointment.patient_id))
+    window_start = min(new_start for _, new_start, _ in moving.values())
+    window_end = max(new_end for _, _, new_end in moving.values())
+    lookback = window_start - timedelta(minutes=MAX_APPOINTMENT_MINUTES)
+
+    timelines = defaultdict(list)
+    for appointment, new_start, new_end in moving.values():
+        for person in (appointment.doctor_id, appointment.patient_id):
+            timelines[person].append((new_start, new_end, appointment))
+    others = (Appointment.objects
+                         .filter(Q(doctor_id__in=people) | Q(patient_id__in=people),
+                                 date__gt=lookback, date__lt=window_end)
+                         .exclude(pk__in=moving)
+                         .values_list('doctor_id', 'patient_id', 'date', 'duration'))
+    for doctor_id, patient_id, date, duration in others:
+        end = date + timedelta(minutes=duration)
+        for person in {doctor_id, patient_id} & people:
+            timelines[person].append((date, end, None))
+    series = (AppointmentSeries.objects
+                               .filter(Q(doctor_id__in=people) | Q(patient_id__in=people),
+                                       start__lt=window_end)
+                               .exclude(until__lt=lookback))
+    for s in series:
+        for occurrence in s.occurrences(window_start - timedelta(minutes=s.duration),
+                                        window_end):
+            for person in {s.doctor_id, s.patient_id} & people:
+                timelines[person].append((occurrence.date, occurrence.end(), None))
+
+    for timeline in timelines.values():
+        timeline.sort(key=lambda period: period[0])
+        # The latest end so far among fixed bookings, and among moved
+        # appointments together with the appointment that reaches it.
+        fixed_end = moved_end = moved_by = None
+        for start, end, appointment in timeline:
+            if appointment is None:
+                if moved_end is not None and start < moved_end:
+                    return moved_by
+                fixed_end = end if fixed_end is None else max(fixed_end, end)
+            else:
+                if fixed_end is not None and start < fixed_end:
+                    return appointment
+                if moved_end is None or end > moved_end:
+                    moved_end, moved_by = end, appointment
+    return None
+
+
+def reschedule_appointments(request, doctor, start, end, delta):
+    """
+    Shifts every appointment the doctor has starting in [start, end) by
+    `delta`, provided none of them would then overlap another booking of
+    the doctor or of its patient.
+    :return: A tuple containing either the number of appointments moved or
+             a failure message.
+    """
+    with sharding.atomic():
+        appointments = _lock(doctor, start, end)
+        if not appointments:
+            return 0, None
+        booking.lock_people(doctor, *[a.patient for a in appointments])
+        conflict = find_conflicts(appointments, delta)
+        if conflict is not None:
+            return None, ("Moving the appointment on {0} with {1} would " +
+                          "overlap another booking.").format(
+                              conflict.date, conflict.patient.get_full_name())
+        Appointment.objects.filter(pk__in=[a.pk for a in appointments]) \
+                           .update(date=F('date') + delta,
+                                   version=F('version') + 1)
+        utilization.record_many(appointments, -1)
+        freed = [copy.copy(appointment) for appointment in appointments]
+        for appointment in appointments:
+            appointment.date += delta
+        utilization.record_many(appointments)
+        # Moved appointments may have left, or come back inside, the shifts.
+        shifts.revalidate(doctor)
+        events.appointments_changed(appointments, 'changed')
+        log_batch(request, appointments, CHANGE, 'Changed date.')
+    # The slots left behind, where the moved appointments do not overlap
+    # them, go to the waitlist.
+    waitlist.backfill_many(request, freed)
+    return len(appointments), None
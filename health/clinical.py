@@ -0,0 +1,177 @@
+"""
+Structured allergy, medication and condition records.
+
+The free-text `allergies`, `medications` and `medical_conditions` fields
+of MedicalInformation stay the source patients edit. Each save parses them
+into ClinicalCode entries linked through MedicalInformation.codes, so
+population queries ("patients allergic to penicillin at this hospital")
+are a unique-index seek on (kind, code hash) followed by index lookups
+through the link table, instead of LIKE scans over every record.
+
+Codes are stored as their blind index (see health.encryption), so
+after PHI_INDEX_KEY has changed, `manage.py rehash_clinical_codes`
+recomputes them from the encrypted display text.
+"""
+from django.db.models import Case, CharField, Count, Value, When
+import re
+from . import encryption, sharding
+from .models import ClinicalCode, User
+
+DEFAULT_BATCH_SIZE = 500
+
+# The MedicalInformation text field each kind of code is parsed from.
+TEXT_FIELDS = {
+    ClinicalCode.ALLERGY: 'allergies',
+    ClinicalCode.MEDICATION: 'medications',
+    ClinicalCode.CONDITION: 'medical_conditions',
+}
+
+_SEPARATORS = re.compile(r'[,;/\n]+|\band\b', re.IGNORECASE)
+_NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+# Entries that say there is nothing to record.
+_EMPTY_ENTRIES = {'', 'none', 'na', 'n-a', 'no', 'nil', 'nka', 'nkda', 'unknown'}
+# Words that only restate the kind, e.g. "penicillin allergy".
+_NOISE_WORDS = {
+    ClinicalCode.ALLERGY: {'allergy', 'allergies', 'allergic', 'to'},
+    ClinicalCode.MEDICATION: set(),
+    ClinicalCode.CONDITION: set(),
+}
+
+
+def normalize(kind, term):
+    """
+    :return: The code a free-text term is recorded under, or '' if the
+             term records nothing.
+    """
+    words = [word for word in _NON_ALPHANUMERIC.split(term.lower())
+             if word and word not in _NOISE_WORDS[kind]]
+    code = '-'.join(words)[:100]
+    return '' if code in _EMPTY_ENTRIES else code
+
+
+def code_hash(kind, code):
+    """
+    :return: The blind index a normalized code is stored under.
+    """
+    return encryption.blind_index('{0}:{1}'.format(kind, code))
+
+
+def parse_terms(kind, text):
+    """
+    Splits a free-text field on commas, semicolons, slashes, new lines and
+    "and".
+    :return: A list of (code, display) pairs, without duplicate codes,
+             in the order they were written.
+    """
+    terms = []
+    seen = set()
+    for term in _SEPARATORS.split(text or ''):
+        code = normalize(kind, term)
+        if code and code not in seen:
+            seen.add(code)
+            terms.append((code, ' '.join(term.split())[:200]))
+    return terms
+
+
+def resolve_codes(kind, terms, cache=None):
+    """
+    Finds or creates the ClinicalCode for each (code, display) pair.
+    :param cache: An optional dict of (kind, code) -> ClinicalCode shared
+                  across calls.
+    :return: The list of ClinicalCode objects.
+    """
+    cache = {} if cache is None else cache
+    missing = {code_hash(kind, code): code for code, _ in terms
+               if (kind, code) not in cache}
+    if missing:
+        for found in ClinicalCode.objects.filter(kind=kind, code_hash__in=missing):
+            cache[(kind, missing[found.code_hash])] = found
+    for code, display in terms:
+        if (kind, code) not in cache:
+            cache[(kind, code)], _ = ClinicalCode.objects.get_or_create(
+                kind=kind, code_hash=code_hash(kind, code),
+                defaults={'display': display})
+    return [cache[(kind, code)] for code, _ in terms]
+
+
+def codes_for(information, cache=None):
+    """
+    :return: The ClinicalCode objects a MedicalInformation's text describes.
+    """
+    codes = []
+    for kind, field in TEXT_FIELDS.items():
+        codes += resolve_codes(kind, parse_terms(kind, getattr(information, field)),
+                               cache)
+    return codes
+
+
+def sync_codes(information):
+    """
+    Re-parses a MedicalInformation's text fields into its codes.
+    """
+    information.codes.set(codes_for(information))
+
+
+def medical_information_saved(sender, instance, raw=False, update_fields=None,
+                              **kwargs):
+    """
+    Re-parses a MedicalInformation's codes after it is saved with possibly
+    changed text.
+    """
+    if raw:
+        return
+    if update_fields is not None and \
+            not set(TEXT_FIELDS.values()).intersection(update_fields):
+        return
+    sync_codes(instance)
+
+
+def patients_with(kind, term, hospital=None):
+    """
+    :param kind: One of ClinicalCode.KINDS.
+    :param term: Free text naming the allergy, medication or condition,
+                 e.g. "Penicillin".
+    :param hospital: Optionally restricts the result to one hospital.
+    :return: A queryset of the users whose records carry the code.
+    """
+    patients = User.objects.filter(
+        medical_information__codes__kind=kind,
+        medical_information__codes__code_hash=code_hash(kind, normalize(kind, term)))
+    if hospital is not None:
+        patients = patients.filter(hospital=hospital)
+    return patients
+
+
+def prevalence(kind, hospital=None, limit=20):
+    """
+    :return: The `limit` most recorded codes of a kind, each annotated with
+             `patient_count`.
+    """
+    codes = ClinicalCode.objects.filter(kind=kind)
+    if hospital is not None:
+        codes = codes.filter(records__user__hospital=hospital)
+    return codes.annotate(patient_count=Count('records__user', distinct=True)) \
+        .order_by('-patient_count', 'pk')[:limit]
+
+
+def rehash_codes(batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Recomputes the hash of every code from its display text, after
+    PHI_INDEX_KEY has changed, with one UPDATE per batch.
+    :return: The number of codes rehashed.
+    """
+    rows = ClinicalCode.objects.order_by('pk')
+    rehashed = 0
+    after = 0
+    while True:
+        with sharding.atomic():
+            codes = list(rows.filter(pk__gt=after)[:batch_size])
+            if not codes:
+                return rehashed
+            after = codes[-1].pk
+            ClinicalCode.objects.filter(pk__in=[code.pk for code in codes]).update(
+                code_hash=Case(*[When(pk=code.pk, then=Value(
+                                     code_hash(code.kind, normalize(code.kind, code.display))))
+                                 for code in codes],
+                               output_field=CharField()))
+        rehashed += len(codes)
@@ -0,0 +1,79 @@
+"""
+Runs independent read-only queries concurrently.
+
+A view that needs several unrelated querysets (the future and past
+schedule, the doctor and patient pickers) would otherwise wait for each
+round trip in turn. gather() evaluates them on a small per-process thread
+pool, each on that thread's own database connection, while the calling
+thread evaluates the first one itself. Pool threads query the caller's
+hospital database (see health.sharding). No request ends on a pool thread
+to close its connections, so each task does what close_old_connections()
+does at the end of a request: connections left unusable by an error or
+older than CONN_MAX_AGE are closed, and the next query reconnects. Set
+CONN_MAX_AGE to keep them open between tasks, which saves connecting for
+every query at the cost of up to QUERY_THREADS idle connections per
+database.
+
+Threads cannot see a transaction the caller has open, so inside an atomic
+block (and when CONCURRENT_QUERIES is off) the functions simply run one
+after another.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+import threading
+from . import sharding
+
+DEFAULT_QUERY_THREADS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    """
+    :return: The process's query thread pool, created on first use.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'QUERY_THREADS', DEFAULT_QUERY_THREADS),
+                    thread_name_prefix='health-query')
+    return _executor
+
+
+def _close_old_connections():
+    for connection in connections.all():
+        connection.close_if_unusable_or_obsolete()
+
+
+def _in_pool(function, database):
+    try:
+        with sharding.use_database(database):
+            return function()
+    finally:
+        _close_old_connections()
+
+
+def enabled():
+    return getattr(settings, 'CONCURRENT_QUERIES', True) and \
+        not any(connection.in_atomic_block for connection in connections.all())
+
+
+def gather(*functions):
+    """
+    Calls each function, concurrently where possible. Functions must be
+    read-only and return fully evaluated results (lists, not querysets),
+    since a lazy queryset would only hit the database after being handed
+    back to the caller.
+    :return: The list of results, in the order the functions were given.
+    """
+    if len(functions) < 2 or not enabled():
+        return [function() for function in functions]
+    database = sharding.current_database()
+    futures = [executor().submit(_in_pool, function, database)
+               for function in functions[1:]]
+    first = functions[0]()
+    return [first] + [future.result() for future in futures]
@@ -0,0 +1,16 @@
+from . import user_snapshot
+
+
+def user_version(request):
+    """
+    Exposes the logged-in user's snapshot version as `user_version`, and
+    their database as `user_database`, for template fragments cached per
+    user that must refresh when the user, its roles or its profiles change.
+    User ids repeat across hospital databases, so such fragments vary on
+    both.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {'user_version': 'anonymous', 'user_database': ''}
+    return {'user_version': user_snapshot.current_version(user.pk, user._state.db),
+            'user_database': user._state.db}
@@ -0,0 +1,486 @@
+"""
+Field-level encryption of patient health information.
+
+Values of an EncryptedTextField are encrypted with AES-GCM under a data
+key, and stored as `phi1$<key id>$<base64 nonce and ciphertext>`. Data
+keys are random, kept in the EncryptionKey table of each database wrapped
+(encrypted) by a master key from settings: PHI_MASTER_KEYS maps master key
+ids to base64-encoded 32-byte keys, and PHI_MASTER_KEY names the one new
+data keys are wrapped with. The master keys never reach the database, and
+changing master key only means wrapping a new data key; `manage.py
+encrypt_phi` then re-encrypts the stored values under it, after which the
+old master key can be dropped. Each value is bound to its model and field,
+so ciphertext copied into another column does not decrypt. encrypt_phi
+also rewrites the audit log reprs written before the models' reprs left
+the encrypted fields out.
+
+Unwrapped data keys are cached per process, so after the first use of a
+key encrypting or decrypting a value costs no query. Values are decrypted
+when first read: reading one encrypted attribute of an instance decrypts
+all of them. Lists decrypt in batches instead: querysets of models with
+encrypted fields decrypt every row they fetch in one pass, loading the
+data keys they need with one query, and decrypt_all() does the same for
+instances reached through select_related().
+
+Encrypted fields cannot be filtered on, and values() returns them
+encrypted (see decrypt_value()); blind_index() gives a keyed hash of a
+value to look it up by instead. Without PHI_MASTER_KEY, new values are
+stored in plaintext. Values stored before encryption was enabled stay
+readable until encrypt_phi has run. Stored values starting with `phi1$`
+are taken for ciphertext, but plaintext may start that way too: a value
+that does not decrypt is read as it was stored, and encrypt_phi encrypts
+it. Encryption needs the optional cryptography package.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+from django.utils.functional import cached_property
+from functools import lru_cache
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import threading
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = InvalidTag = None
+
+PREFIX = 'phi1'
+NONCE_BYTES = 12
+KEY_BYTES = 32
+DEFAULT_BATCH_SIZE = 500
+# Binds wrapped data keys to their purpose.
+WRAPPING_CONTEXT = b'health.encryptionkey'
+# SHA-256 fingerprints of keys that were published and must never protect
+# data again (see check_revoked_keys()).
+REVOKED_KEY_FINGERPRINTS = frozenset([
+    'acaf718c5b8b83e65ac739fa2ec4e94cca76637d8ba869f1fb6573de5d60753f',
+    '99298ebafbb0d505e25ae54fbf2dc42b7098ac5ae7d88ab0b0c375bb0b35aa9e',
+])
+
+logger = logging.getLogger(__name__)
+
+
+class Ciphertext(str):
+    """
+    An encrypted value as stored, told apart from plaintext assigned to a
+    field by its type.
+    """
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def active_master_key_id():
+    return getattr(settings, 'PHI_MASTER_KEY', None)
+
+
+def enabled():
+    return bool(active_master_key_id())
+
+
+def _cipher(key):
+    if AESGCM is None:
+        raise ImproperlyConfigured('Encrypting patient health information '
+                                   'requires the cryptography package.')
+    return AESGCM(key)
+
+
+def master_key(key_id):
+    """
+    :return: The cipher for a master key listed in PHI_MASTER_KEYS.
+    """
+    encoded = getattr(settings, 'PHI_MASTER_KEYS', {}).get(key_id)
+    if encoded is None:
+        raise ImproperlyConfigured('Master key {0} is not in PHI_MASTER_KEYS.'
+                                   .format(key_id))
+    key = base64.b64decode(encoded)
+    if len(key) != KEY_BYTES:
+        raise ImproperlyConfigured('Master key {0} is not {1} bytes long.'
+                                   .format(key_id, KEY_BYTES))
+    return _cipher(key)
+
+
+def wrap(data_key, master_key_id):
+    nonce = os.urandom(NONCE_BYTES)
+    sealed = master_key(master_key_id).encrypt(nonce, data_key, WRAPPING_CONTEXT)
+    return base64.b64encode(nonce + sealed).decode('ascii')
+
+
+def unwrap(encryption_key):
+    sealed = base64.b64decode(encryption_key.wrapped_key)
+    return master_key(encryption_key.master_key_id).decrypt(
+        sealed[:NONCE_BYTES], sealed[NONCE_BYTES:], WRAPPING_CONTEXT)
+
+
+# Unwrapped data key ciphers by (database, key id), and the id of the data
+# key new values are encrypted with by (database, master key id).
+_data_keys = {}
+_active_keys = {}
+_lock = threading.Lock()
+
+
+def clear_key_cache():
+    _data_keys.clear()
+    _active_keys.clear()
+
+
+def load_keys(database, key_ids):
+    """
+    Unwraps the data keys that are not cached yet, with one query. Ids
+    without a key are left out; the values naming them do not decrypt.
+    """
+    from .models import EncryptionKey
+    missing = {key_id for key_id in key_ids if (database, key_id) not in _data_keys}
+    if not missing:
+        return
+    for encryption_key in EncryptionKey.objects.using(database).filter(pk__in=missing):
+        _data_keys[(database, encryption_key.pk)] = _cipher(unwrap(encryption_key))
+
+
+def active_key(database):
+    """
+    :return: The id and cipher of the data key new values are encrypted
+             with, creating the key on first use of the master key.
+    """
+    from .models import EncryptionKey
+    master_key_id = active_master_key_id()
+    key_id = _active_keys.get((database, master_key_id))
+    if key_id is None:
+        with _lock:
+            key_id = _active_keys.get((database, master_key_id))
+            if key_id is None:
+                encryption_key = EncryptionKey.objects.using(database) \
+                    .filter(master_key_id=master_key_id).order_by('-pk').first()
+                if encryption_key is None:
+                    encryption_key = EncryptionKey.objects.using(database).create(
+                        master_key_id=master_key_id,
+                        wrapped_key=wrap(os.urandom(KEY_BYTES), master_key_id))
+                load_keys(database, [encryption_key.pk])
+                key_id = _active_keys[(database, master_key_id)] = encryption_key.pk
+    return key_id, _data_keys[(database, key_id)]
+
+
+def encrypt(plaintext, database, context):
+    """
+    :param context: The model and field the value belongs to.
+    :return: The Ciphertext of a string.
+    """
+    key_id, cipher = active_key(database)
+    nonce = os.urandom(NONCE_BYTES)
+    sealed = cipher.encrypt(nonce, plaintext.encode('utf-8'), context.encode('ascii'))
+    return Ciphertext('{0}${1}${2}'.format(
+        PREFIX, key_id, base64.b64encode(nonce + sealed).decode('ascii')))
+
+
+def key_id(ciphertext):
+    try:
+        return int(ciphertext.split('$', 2)[1])
+    except (IndexError, ValueError):
+        raise DecryptionError('Malformed ciphertext.')
+
+
+def _decrypt(ciphertext, database, context):
+    """
+    Decrypts a value whose data key is already loaded.
+    """
+    try:
+        sealed = base64.b64decode(ciphertext.split('$', 2)[2])
+        plaintext = _data_keys[(database, key_id(ciphertext))].decrypt(
+            sealed[:NONCE_BYTES], sealed[NONCE_BYTES:], context.encode('ascii'))
+        return plaintext.decode('utf-8')
+    except (IndexError, KeyError, binascii.Error, InvalidTag, UnicodeDecodeError):
+        raise DecryptionError('Could not decrypt a value of {0}.'.format(context))
+
+
+def _read(ciphertext, database, context):
+    """
+    :return: The plaintext of a value stored with the ciphertext prefix,
+             or the value as stored if it does not decrypt: plaintext
+             that happens to start with the prefix.
+    """
+    try:
+        return _decrypt(ciphertext, database, context)
+    except DecryptionError:
+        logger.warning('A value of %s does not decrypt and is read as plaintext.',
+                       context)
+        return str(ciphertext)
+
+
+def _key_ids(values):
+    ids = set()
+    for value in values:
+        try:
+            ids.add(key_id(value))
+        except DecryptionError:
+            pass
+    return ids
+
+
+def decrypt_value(value, field, database=DEFAULT_DB_ALIAS):
+    """
+    :return: The plaintext of a value of an encrypted field read without
+             its model, e.g. through values().
+    """
+    if not isinstance(value, str) or not value.startswith(PREFIX + '$'):
+        return value
+    load_keys(database, _key_ids([value]))
+    return _read(value, database, field.context)
+
+
+def blind_index(value):
+    """
+    :return: The blind index of a string, as hex: its HMAC-SHA256 under
+             PHI_INDEX_KEY, which lets equal values be found without
+             storing them. While values are stored in plaintext (no
+             PHI_MASTER_KEY), an unkeyed SHA-256 stands in for it until
+             PHI_INDEX_KEY is set.
+    """
+    key = getattr(settings, 'PHI_INDEX_KEY', None)
+    value = value.encode('utf-8')
+    if key:
+        return hmac.new(base64.b64decode(key), value, hashlib.sha256).hexdigest()
+    if enabled():
+        raise ImproperlyConfigured('Set PHI_INDEX_KEY to index encrypted values.')
+    # The values are stored in plaintext, so the hash reveals nothing more.
+    return hashlib.sha256(value).hexdigest()
+
+
+def key_fingerprint(encoded):
+    """
+    :return: The SHA-256 of a base64-encoded key, as hex, or None if it is
+             not valid base64.
+    """
+    try:
+        return hashlib.sha256(base64.b64decode(encoded)).hexdigest()
+    except (binascii.Error, TypeError, ValueError):
+        return None
+
+
+def check_revoked_keys(app_configs, **kwargs):
+    """
+    A system check for revoked keys in the settings. New values must not be
+    encrypted or indexed under one, so an active master key or index key
+    that is revoked is an error. Another revoked master key is only a
+    warning: it is still needed to read old values until encrypt_phi has
+    re-encrypted them.
+    """
+    from django.core import checks
+    messages = []
+    for key_id, encoded in getattr(settings, 'PHI_MASTER_KEYS', {}).items():
+        if key_fingerprint(encoded) not in REVOKED_KEY_FINGERPRINTS:
+            continue
+        if key_id == active_master_key_id():
+            messages.append(checks.Error(
+                'PHI_MASTER_KEY names the revoked master key {0}.'.format(key_id),
+                hint='Add a new master key, point PHI_MASTER_KEY at it and run '
+                     '`manage.py encrypt_phi`, then remove the revoked one.',
+                id='health.E001'))
+        else:
+            messages.append(checks.Warning(
+                'PHI_MASTER_KEYS still holds the revoked master key {0}.'.format(key_id),
+                hint='Remove it once `manage.py encrypt_phi` has re-encrypted '
+                     'every value under the active master key.',
+                id='health.W001'))
+    index_key = getattr(settings, 'PHI_INDEX_KEY', None)
+    if index_key and key_fingerprint(index_key) in REVOKED_KEY_FINGERPRINTS:
+        messages.append(checks.Error(
+            'PHI_INDEX_KEY is a revoked key.',
+            hint='Set a new PHI_INDEX_KEY, then run `manage.py normalize_insurers '
+                 '--rehash` and `manage.py rehash_clinical_codes`.',
+            id='health.E002'))
+    return messages
+
+
+@lru_cache(maxsize=None)
+def encrypted_fields(model):
+    return [field for field in model._meta.concrete_fields
+            if isinstance(field, EncryptedTextField)]
+
+
+def decrypt_all(instances):
+    """
+    Decrypts the encrypted fields of many instances, of any models, in one
+    pass, loading the data keys they need with one query per database.
+    """
+    pending = []
+    values = {}
+    for instance in instances:
+        if instance is None:
+            continue
+        database = instance._state.db or DEFAULT_DB_ALIAS
+        for field in encrypted_fields(type(instance)):
+            value = instance.__dict__.get(field.attname)
+            if isinstance(value, Ciphertext):
+                pending.append((instance, field, database, value))
+                values.setdefault(database, []).append(value)
+    for database, stored in values.items():
+        load_keys(database, _key_ids(stored))
+    for instance, field, database, value in pending:
+        instance.__dict__[field.attname] = _read(value, database, field.context)
+
+
+def reencrypt(model, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Rewrites the stored values of a model's encrypted fields that are in
+    plaintext or under another data key than the active one, a batch of
+    rows per transaction. Values under the active key are decrypted to
+    tell ciphertext from plaintext that starts like it.
+    :return: The number of rows rewritten.
+    """
+    if not enabled():
+        raise ImproperlyConfigured('Set PHI_MASTER_KEY to encrypt.')
+    database = router.db_for_write(model)
+    current, _ = active_key(database)
+    fields = encrypted_fields(model)
+    rows = model._base_manager.using(database) \
+        .only('pk', *[field.attname for field in fields]).order_by('pk')
+
+    def is_current(value, field):
+        if not isinstance(value, Ciphertext):
+            return False
+        try:
+            return key_id(value) == current and \
+                _decrypt(value, database, field.context) is not None
+        except DecryptionError:
+            return False
+
+    rewritten = 0
+    after = 0
+    while True:
+        batch = list(rows.filter(pk__gt=after)[:batch_size])
+        if not batch:
+            return rewritten
+        after = batch[-1].pk
+        stale = []
+        for instance in batch:
+            names = [field.attname for field in fields
+                     if instance.__dict__[field.attname] is not None and
+                     not is_current(instance.__dict__[field.attname], field)]
+            if names:
+                stale.append((instance, names))
+        decrypt_all(instance for instance, _ in stale)
+        with transaction.atomic(using=database):
+            for instance, names in stale:
+                model._base_manager.using(database).filter(pk=instance.pk).update(
+                    **{name: instance.__dict__[name] for name in names})
+        rewritten += len(stale)
+
+
+def scrub_audit_log(model, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Rewrites the audit log entries of a model's objects with their current
+    repr, which leaves the encrypted fields out: entries written before
+    that hold them in plaintext. Entries of deleted objects get the
+    generic "<model> object (<pk>)" instead. A batch of entries per
+    transaction.
+    :return: The number of entries rewritten.
+    """
+    from django.contrib.admin.models import LogEntry
+    from django.contrib.contenttypes.models import ContentType
+    database = router.db_for_write(model)
+    content_type = ContentType.objects.db_manager(database).get_for_model(model)
+    entries = LogEntry.objects.using(database) \
+        .filter(content_type=content_type).order_by('pk')
+    related = [field.name for field in model._meta.concrete_fields
+               if field.many_to_one]
+    rewritten = 0
+    after = 0
+    while True:
+        batch = list(entries.filter(pk__gt=after)
+                            .values_list('pk', 'object_id', 'object_repr')[:batch_size])
+        if not batch:
+            return rewritten
+        after = batch[-1][0]
+        ids = {object_id for _, object_id, _ in batch if object_id.isdigit()}
+        reprs = {str(instance.pk): repr(instance)[:200]
+                 for instance in model._base_manager.using(database)
+                                      .select_related(*related)
+                                      .filter(pk__in=ids)}
+        stale = {}
+        for pk, object_id, object_repr in batch:
+            current = reprs.get(object_id) or '{0} object ({1})'.format(
+                model._meta.object_name, object_id)[:200]
+            if object_repr != current:
+                stale[pk] = current
+        if stale:
+            # One UPDATE for the batch.
+            with transaction.atomic(using=database):
+                LogEntry.objects.using(database).filter(pk__in=stale).update(
+                    object_repr=models.Case(
+                        *[models.When(pk=pk, then=models.Value(current))
+                          for pk, current in stale.items()],
+                        output_field=models.CharField()))
+        rewritten += len(stale)
+
+
+class EncryptedAttribute(object):
+    """
+    Holds an encrypted field's value on an instance, decrypting the
+    instance's encrypted fields on first read.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            # Deferred by only() or defer().
+            instance.refresh_from_db(fields=[attname])
+        if isinstance(instance.__dict__[attname], Ciphertext):
+            decrypt_all([instance])
+        return instance.__dict__[attname]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class EncryptedTextField(models.TextField):
+    """
+    A text field stored encrypted, decrypted transparently on read.
+    """
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, EncryptedAttribute(self))
+
+    @cached_property
+    def context(self):
+        return '{0}.{1}'.format(self.model._meta.label_lower, self.name)
+
+    def from_db_value(self, value, expression, connection):
+        if value is not None and value.startswith(PREFIX + '$'):
+            return Ciphertext(value)
+        return value
+
+    def pre_save(self, model_instance, add):
+        # Values that were never read are saved as they were loaded,
+        # without decrypting them first.
+        return model_instance.__dict__.get(self.attname)
+
+    def get_db_prep_save(self, value, connection):
+        value = super().get_db_prep_save(value, connection)
+        if value is None or isinstance(value, Ciphertext) or not enabled():
+            return value
+        return encrypt(value, connection.alias, self.context)
+
+
+class EncryptedQuerySet(models.QuerySet):
+    """
+    Decrypts the rows it fetches in one batch.
+    """
+
+    def _fetch_all(self):
+        decrypt = self._result_cache is None
+        super()._fetch_all()
+        if decrypt and self._iterable_class is models.query.ModelIterable:
+            decrypt_all(self._result_cache)
@@ -0,0 +1,316 @@
+"""
+Live appointment changes, pushed to open schedule pages over Server-Sent
+Events.
+
+Every write path that books, moves or cancels appointments reports the
+change here, next to its health.utilization call. Events are published
+once the surrounding transaction commits, to the doctor's and patient's
+topics in their database, through the broker named by EVENT_BROKER. The row HTML is
+rendered once per event, however many pages are watching.
+
+The default LocalBroker keeps a bounded log of recent events in process
+memory and wakes the streams waiting on event loops. It stands in
+for a cross-worker broker: a stream only sees events published by the
+worker process serving it, so deployments with several worker processes
+need a shared broker class with the same interface.
+
+Event ids carry the broker's epoch, so a client that reconnects with a
+Last-Event-ID from another process, or from before a restart, or that has
+fallen out of the log, gets a `reset` event and reloads instead of
+silently missing changes.
+
+Streams are served on the event loop of health.asgi, where an open one
+costs a future rather than a thread. WSGI servers, whose threads would
+each be held by one stream, only get the events already published, and
+browsers poll by reconnecting (see EventStreamResponse).
+"""
+from collections import deque, namedtuple
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.module_loading import import_string
+import asyncio
+import functools
+import json
+import threading
+import uuid
+from . import sharding
+
+DEFAULT_BROKER = 'health.events.LocalBroker'
+DEFAULT_STREAM_SECONDS = 300
+DEFAULT_HEARTBEAT_SECONDS = 15
+# How long EventSource waits before reconnecting, in milliseconds.
+RETRY_MILLISECONDS = 3000
+
+Event = namedtuple('Event', ['id', 'topics', 'name', 'data'])
+
+
+class LocalBroker(object):
+    """
+    In-process pub/sub: the last `size` events, in publication order, and
+    the futures of the streams waiting for the next one.
+    """
+
+    def __init__(self, size=1000):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.lock = threading.Lock()
+        # (event loop, future) of the streams waiting in wait().
+        self.waiters = set()
+
+    def publish(self, topics, name, data):
+        """
+        :return: The id of the new event.
+        """
+        with self.lock:
+            self.last_id += 1
+            self.events.append(Event(self.last_id, frozenset(topics), name, data))
+            for loop, waiter in self.waiters:
+                loop.call_soon_threadsafe(_wake, waiter)
+        return self.last_id
+
+    def cursor(self, sequence=None):
+        """
+        :return: An opaque position, by default the latest: resuming from
+                 it returns only events published afterwards.
+        """
+        return '{0}:{1}'.format(self.epoch,
+                                self.last_id if sequence is None else sequence)
+
+    def position(self, cursor):
+        """
+        :return: The sequence number a cursor from this broker points at,
+                 or None if the events after it are not all still held.
+        """
+        epoch, _, sequence = (cursor or '').partition(':')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        with self.lock:
+            oldest = self.events[0].id if self.events else self.last_id + 1
+            if sequence > self.last_id or sequence < oldest - 1:
+                return None
+        return sequence
+
+    def read(self, sequence, topics=None):
+        """
+        :param topics: The topics to match, or None for every event.
+        :return: The events after `sequence` matching any of the topics,
+                 and the sequence to read from next.
+        """
+        with self.lock:
+            last_id = self.last_id
+            # Events are in id order, so only the tail needs to be scanned.
+            count = min(last_id - sequence, len(self.events))
+            recent = [self.events[-i] for i in range(count, 0, -1)]
+        return [event for event in recent
+                if topics is None or event.topics & topics], last_id
+
+    async def wait(self, sequence, timeout):
+        """
+        Waits on the event loop until an event after `sequence` is
+        published, or `timeout` seconds pass.
+        :return: Whether there are new events.
+        """
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        with self.lock:
+            if self.last_id > sequence:
+                return True
+            self.waiters.add((loop, waiter))
+        try:
+            await asyncio.wait([waiter], timeout=timeout)
+        finally:
+            with self.lock:
+                self.waiters.discard((loop, waiter))
+        return self.last_id > sequence
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """
+    :return: The process's instance of the broker class named by
+             EVENT_BROKER, created on first use.
+    """
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'EVENT_BROKER',
+                                                DEFAULT_BROKER))()
+    return _broker
+
+
+def _topic(kind, database, pk=None):
+    # Ids repeat across hospital databases, so topics name the database.
+    if pk is None:
+        return '{0}:{1}'.format(kind, database)
+    return '{0}:{1}:{2}'.format(kind, database, pk)
+
+
+def topics_for(appointment):
+    database = appointment._state.db or sharding.current_database()
+    return {_topic('database', database),
+            _topic('doctor', database, appointment.doctor_id),
+            _topic('patient', database, appointment.patient_id)}
+
+
+def watched_topics(user, params):
+    """
+    The topics a user's stream follows: their own schedule, as in
+    User.schedule(), in the current database. Administrators follow every
+    appointment in it, or only the `doctor` and `patient` ids given in the
+    query string.
+    :return: A set of topics.
+    """
+    database = sharding.current_database()
+    if user.is_superuser:
+        topics = {_topic('doctor', database, pk) for pk in params.getlist('doctor')} | \
+                 {_topic('patient', database, pk) for pk in params.getlist('patient')}
+        return topics or {_topic('database', database)}
+    if user.is_doctor():
+        return {_topic('doctor', database, user.pk)}
+    return {_topic('patient', database, user.pk)}
+
+
+def _payload(action, appointment, pk):
+    data = {
+        'action': action,
+        'id': pk,
+        'date': appointment.date.isoformat(),
+    }
+    if action != 'removed':
+        data['row'] = render_to_string('health/appointment_row.html', {
+            'appointment': appointment, 'editable': True,
+        })
+    return data
+
+
+def appointments_changed(appointments, action):
+    """
+    Publishes an event for each appointment once the current transaction
+    commits. Removals must be reported before the appointments are deleted,
+    while they still have their ids.
+    :param action: 'added', 'changed' or 'removed'.
+    """
+    changed = [(appointment, appointment.pk, topics_for(appointment))
+               for appointment in appointments]
+
+    def publish():
+        broker = get_broker()
+        for appointment, pk, topics in changed:
+            broker.publish(topics, 'appointment', _payload(action, appointment, pk))
+
+    sharding.on_commit(publish)
+
+
+def appointment_changed(appointment, action):
+    appointments_changed([appointment], action)
+
+
+def format_event(name, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append('id: {0}'.format(event_id))
+    lines.append('event: {0}'.format(name))
+    lines.append('data: {0}'.format(json.dumps(data)))
+    return '\n'.join(lines) + '\n\n'
+
+
+def _settings(seconds, heartbeat):
+    if seconds is None:
+        seconds = getattr(settings, 'EVENT_STREAM_SECONDS', DEFAULT_STREAM_SECONDS)
+    if heartbeat is None:
+        heartbeat = getattr(settings, 'EVENT_HEARTBEAT_SECONDS',
+                            DEFAULT_HEARTBEAT_SECONDS)
+    return seconds, heartbeat
+
+
+def _formatted(broker, events):
+    return [format_event(event.name, event.data, broker.cursor(event.id))
+            for event in events]
+
+
+def _position_id(broker, sequence):
+    # An id without data moves the client's reconnection point past events
+    # for other topics.
+    return ': keep-alive\nid: {0}\n\n'.format(broker.cursor(sequence))
+
+
+def poll(topics, cursor, broker=None):
+    """
+    Generates the Server-Sent Events already published after `cursor` for
+    the given topics, without waiting for more. EventSource reconnects
+    after RETRY_MILLISECONDS with the id of the last event it saw, so a
+    schedule page polls instead of holding a server thread.
+    """
+    broker = broker or get_broker()
+    yield 'retry: {0}\n\n'.format(RETRY_MILLISECONDS)
+    sequence = broker.position(cursor)
+    if sequence is None:
+        yield format_event('reset', {}, broker.cursor())
+        return
+    events, sequence = broker.read(sequence, topics)
+    for line in _formatted(broker, events):
+        yield line
+    yield _position_id(broker, sequence)
+
+
+async def stream(topics, cursor, broker=None, seconds=None, heartbeat=None):
+    """
+    Generates the Server-Sent Events of a schedule stream, as bytes, on
+    the event loop: the events after `cursor` for the given topics, as they
+    are published, for up to EVENT_STREAM_SECONDS. EventSource then
+    reconnects with the id of the last event it saw. A heartbeat is sent
+    after EVENT_HEARTBEAT_SECONDS without events, so proxies and clients
+    can tell an idle stream from a dead one. Waiting for events awaits the
+    broker, so an open stream holds neither a thread nor a connection.
+    """
+    broker = broker or get_broker()
+    seconds, heartbeat = _settings(seconds, heartbeat)
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + seconds
+    yield 'retry: {0}\n\n'.format(RETRY_MILLISECONDS).encode('utf-8')
+    sequence = broker.position(cursor)
+    if sequence is None:
+        yield format_event('reset', {}, broker.cursor()).encode('utf-8')
+        return
+    last_sent = loop.time()
+    while True:
+        events, sequence = broker.read(sequence, topics)
+        if events:
+            yield ''.join(_formatted(broker, events)).encode('utf-8')
+        now = loop.time()
+        if events:
+            last_sent = now
+        elif now - last_sent >= heartbeat:
+            yield _position_id(broker, sequence).encode('utf-8')
+            last_sent = now
+        if now >= deadline:
+            return
+        await broker.wait(sequence, min(last_sent + heartbeat, deadline) - now)
+
+
+class EventStreamResponse(StreamingHttpResponse):
+    """
+    A schedule's event stream. Served through health.asgi, it is streamed
+    by `async_stream` on the event loop for up to EVENT_STREAM_SECONDS.
+    A WSGI server would have to give it a worker thread for as long, so
+    there it only carries the events already published (see poll()).
+    """
+
+    def __init__(self, topics, cursor):
+        super().__init__(poll(topics, cursor), content_type='text/event-stream')
+        self.async_stream = functools.partial(stream, topics, cursor)
+        self['Cache-Control'] = 'no-cache'
+        # Keeps nginx from buffering the stream.
+        self['X-Accel-Buffering'] = 'no'
@@ -94,3 +94,25 @@ def deletion(request, obj, object_repr=None):
         object_repr=object_repr or repr(obj),
         action_flag=models.DELETION
     )
+
+
+def log_batch(request, objects, action_flag, message=''):
+    """
+    Log the same action against many objects of one model with a single
+    INSERT, instead of one log_action() call per object.
+    """
+    objects = list(objects)
+    if not objects:
+        return []
+    content_type = ContentType.objects.get_for_model(objects[0])
+    return models.LogEntry.objects.bulk_create([
+        models.LogEntry(
+            user_id=request.user.pk,
+            content_type_id=content_type.pk,
+            object_id=str(obj.pk),
+            object_repr=repr(obj)[:200],
+            action_flag=action_flag,
+            change_message=message
+        )
+        for obj in objects
+    ])
@@ -0,0 +1,219 @@
+"""
+Nearest-hospital search.
+
+Hospital locations are held in a per-process k-d tree, built on first use
+(or at worker boot by health.startup). The tree is tagged with a version
+token kept in the cache, which is dropped whenever a hospital is saved or
+deleted, so every worker sharing the cache rebuilds its tree on its next
+search. As for health.user_snapshot, the local-memory cache only reaches
+a single process. Points are stored as unit vectors on the sphere, so the
+straight-line distance between them orders exactly like great-circle
+distance and a plain three-dimensional k-d tree answers nearest-neighbour
+queries without special cases at the poles or the antimeridian.
+"""
+from collections import namedtuple
+from django.core.cache import cache
+import heapq
+import math
+import uuid
+from .models import Hospital, ZipCentroid
+
+EARTH_RADIUS_KM = 6371.0088
+INDEX_VERSION_KEY = 'hospital-index-version'
+
+Nearby = namedtuple('Nearby', ['hospital', 'distance_km'])
+
+_index = None
+_zipcodes = {}
+
+
+def to_vector(latitude, longitude):
+    """
+    :return: The (x, y, z) unit vector of a latitude and longitude in degrees.
+    """
+    phi = math.radians(latitude)
+    lam = math.radians(longitude)
+    return (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam),
+            math.sin(phi))
+
+
+def chord_to_km(chord):
+    """
+    :return: The great-circle distance in kilometres between two unit
+             vectors `chord` apart.
+    """
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+class KDTree(object):
+    """
+    A static k-d tree over three-dimensional points. Nodes are kept in flat
+    lists, with the median of each range at the middle index, so no node
+    objects are allocated.
+    """
+
+    def __init__(self, points, items):
+        size = len(points)
+        self.points = [None] * size
+        self.items = [None] * size
+        self.axes = [0] * size
+        # Each range [low, high) of the flat lists holds a subtree whose root
+        # is at the middle slot, with the left half below it and the right
+        # half above. Built with an explicit stack of (indices, depth, low,
+        # high) ranges.
+        stack = [(list(range(size)), 0, 0, size)]
+        while stack:
+            indices, depth, low, high = stack.pop()
+            if low >= high:
+                continue
+            axis = depth % 3
+            indices.sort(key=lambda i: points[i][axis])
+            middle = len(indices) // 2
+            slot = low + middle
+            self.points[slot] = points[indices[middle]]
+            self.items[slot] = items[indices[middle]]
+            self.axes[slot] = axis
+            stack.append((indices[:middle], depth + 1, low, slot))
+            stack.append((indices[middle + 1:], depth + 1, slot + 1, high))
+
+    def __len__(self):
+        return len(self.points)
+
+    def nearest(self, point, limit):
+        """
+        :return: Up to `limit` (distance, item) pairs, nearest first.
+        """
+        best = []  # A max-heap of (-squared distance, slot).
+        stack = [(0, len(self.points))]
+        while stack:
+            low, high = stack.pop()
+            if low >= high:
+                continue
+            slot = low + (high - low) // 2
+            node = self.points[slot]
+            squared = ((node[0] - point[0]) ** 2 + (node[1] - point[1]) ** 2 +
+                       (node[2] - point[2]) ** 2)
+            if len(best) < limit:
+                heapq.heappush(best, (-squared, slot))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, slot))
+            difference = point[self.axes[slot]] - node[self.axes[slot]]
+            near, far = ((low, slot), (slot + 1, high)) if difference < 0 \
+                else ((slot + 1, high), (low, slot))
+            # The far side is only searched if the splitting plane is closer
+            # than the current worst result. It is pushed first so the near
+            # side is searched first and tightens that bound.
+            if len(best) < limit or difference * difference < -best[0][0]:
+                stack.append(far)
+            stack.append(near)
+        return [(math.sqrt(-squared), self.items[slot])
+                for squared, slot in sorted(best, reverse=True)]
+
+
+def index_version():
+    """
+    :return: The current version token of the hospital table, creating one
+             if the cache has none.
+    """
+    version = cache.get(INDEX_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(INDEX_VERSION_KEY, version, None):
+            version = cache.get(INDEX_VERSION_KEY, version)
+    return version
+
+
+def hospital_index():
+    """
+    :return: The k-d tree over every hospital with a location, built on
+             first use and rebuilt once the hospitals have changed.
+    """
+    global _index
+    # Read before the hospitals, so a change made while building is seen
+    # on the next use.
+    version = index_version()
+    if _index is None or _index[0] != version:
+        hospitals = list(Hospital.objects.filter(latitude__isnull=False,
+                                                 longitude__isnull=False))
+        _index = (version, KDTree([to_vector(h.latitude, h.longitude)
+                                   for h in hospitals], hospitals))
+    return _index[1]
+
+
+def clear_hospital_index(**kwargs):
+    """
+    Discards the hospital index in every process sharing the cache.
+    """
+    global _index
+    _index = None
+    cache.delete(INDEX_VERSION_KEY)
+
+
+def zipcode_location(zipcode):
+    """
+    :return: The (latitude, longitude) of a zipcode's centroid, or None if
+             it is unknown. Known zipcodes are cached for the life of the
+             process.
+    """
+    zipcode = (zipcode or '').strip()[:5]
+    if zipcode not in _zipcodes:
+        location = ZipCentroid.objects.filter(zipcode=zipcode) \
+            .values_list('latitude', 'longitude').first()
+        if location is None:
+            return None
+        _zipcodes[zipcode] = location
+    return _zipcodes[zipcode]
+
+
+def clear_zipcodes(**kwargs):
+    _zipcodes.clear()
+
+
+def nearest_hospitals(latitude, longitude, limit=10):
+    """
+    :return: A list of up to `limit` Nearby tuples, nearest first.
+    """
+    return [Nearby(hospital, chord_to_km(chord)) for chord, hospital in
+            hospital_index().nearest(to_vector(latitude, longitude), limit)]
+
+
+def nearest_hospitals_to_zipcode(zipcode, limit=10):
+    """
+    :return: A list of up to `limit` Nearby tuples, nearest first, or None
+             if the zipcode is unknown.
+    """
+    location = zipcode_location(zipcode)
+    if location is None:
+        return None
+    return nearest_hospitals(location[0], location[1], limit)
+
+
+def locate_hospitals():
+    """
+    Sets the location of every hospital without one from its zipcode's
+    centroid.
+    :return: The number of hospitals located.
+    """
+    located = 0
+    for hospital in Hospital.objects.filter(latitude__isnull=True):
+        location = zipcode_location(hospital.zipcode)
+        if location is not None:
+            Hospital.objects.filter(pk=hospital.pk).update(
+                latitude=location[0], longitude=location[1])
+            located += 1
+    clear_hospital_index()
+    return located
+
+
+def hospital_choices(zipcode=None, nearest=20):
+    """
+    Orders the hospital picker: with a known zipcode, the `nearest`
+    closest hospitals come first, then every other hospital.
+    :return: A list of (hospital, distance in km or None) pairs.
+    """
+    nearby = nearest_hospitals_to_zipcode(zipcode, nearest) if zipcode else None
+    if not nearby:
+        return [(hospital, None) for hospital in Hospital.objects.all()]
+    rest = Hospital.objects.exclude(pk__in=[n.hospital.pk for n in nearby])
+    return [(n.hospital, n.distance_km) for n in nearby] + \
+        [(hospital, None) for hospital in rest]
@@ -0,0 +1,200 @@
+"""
+Normalized insurers and indexed policy lookup.
+
+Insurance company names are reduced to a key (lowercased, punctuation and
+corporate suffixes dropped, so "Aetna", "aetna inc" and "Aetna, Inc." are
+one Insurer). Policy numbers are encrypted (see health.encryption), so
+they cannot be indexed or compared directly. Each policy instead carries
+the blind index of the number with case, spaces and dashes removed.
+
+Every patient keeps their own Insurance row, edited in place by the forms
+and the admin. index_policy() points it, on every save, at the one Policy
+row of its insurer and hash, which all the patients on that policy share.
+Finding the patients on a policy is one seek on the policy's unique index
+followed by the insurance foreign key index, and listing an insurer's
+patients follows the policy's insurer index.
+
+`manage.py normalize_insurers` backfills rows written without a policy,
+and with --rehash moves every row to the policy of its recomputed hash
+after PHI_INDEX_KEY has changed, then drops the policies no patient is on
+any more.
+"""
+from django.db import IntegrityError
+from django.db.models import Case, IntegerField, Value, When
+import re
+from . import encryption, sharding
+from .models import Insurance, Insurer, Policy, User
+
+DEFAULT_BATCH_SIZE = 500
+REPORT_LIMIT = 500
+
+_NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+_POLICY_SEPARATORS = re.compile(r'[\s\-_./]+')
+# Words that do not tell insurers apart.
+_CORPORATE_SUFFIXES = {'inc', 'incorporated', 'co', 'corp', 'corporation',
+                       'company', 'llc', 'ltd', 'limited', 'plc', 'the'}
+
+
+def normalize_name(name):
+    """
+    :return: The key an insurer's name is recorded under, or '' for a
+             blank name.
+    """
+    words = [word for word in _NON_ALPHANUMERIC.split((name or '').lower())
+             if word and word not in _CORPORATE_SUFFIXES]
+    return ' '.join(words)[:200]
+
+
+def normalize_policy(number):
+    return _POLICY_SEPARATORS.sub('', (number or '').upper())
+
+
+def policy_hash(number):
+    """
+    :return: The blind index of a policy number, as hex.
+    """
+    return encryption.blind_index(normalize_policy(number))
+
+
+def get_insurer(name):
+    """
+    :return: The Insurer a company name normalizes to, created if new, or
+             None for a blank name.
+    """
+    key = normalize_name(name)
+    if not key:
+        return None
+    insurer, _ = Insurer.objects.get_or_create(
+        normalized_name=key, defaults={'name': ' '.join(name.split())[:200]})
+    return insurer
+
+
+def find_insurer(name):
+    """
+    :return: The Insurer a company name normalizes to, or None.
+    """
+    key = normalize_name(name)
+    if not key:
+        return None
+    return Insurer.objects.filter(normalized_name=key).first()
+
+
+def get_policy(company, number):
+    """
+    :return: The Policy of a company and policy number, created if new, or
+             None for a blank number.
+    """
+    if not normalize_policy(number):
+        return None
+    policy, _ = Policy.objects.get_or_create(insurer=get_insurer(company),
+                                             policy_hash=policy_hash(number))
+    return policy
+
+
+def find_policy(company, number):
+    """
+    :return: The Policy of a company and policy number, or None.
+    """
+    if not normalize_policy(number):
+        return None
+    key = normalize_name(company)
+    policies = Policy.objects.filter(policy_hash=policy_hash(number))
+    if key:
+        return policies.filter(insurer__normalized_name=key).first()
+    return policies.filter(insurer=None).first()
+
+
+def index_policy(sender, instance, raw=False, **kwargs):
+    """
+    pre_save handler for Insurance pointing it at the policy of the company
+    and policy number being saved.
+    """
+    if raw:
+        return
+    instance.policy = get_policy(instance.company, instance.policy_number)
+
+
+def patients_with_policy(company, number):
+    """
+    :return: The patients whose policy has the given number, with the
+             given company or, for a blank company, without an insurer.
+    """
+    policy = find_policy(company, number)
+    if policy is None:
+        return User.objects.none()
+    return User.objects.filter(medical_information__insurance__policy=policy) \
+        .order_by('last_name', 'first_name')
+
+
+def patients_by_insurer(insurer):
+    return User.objects.filter(
+        medical_information__insurance__policy__insurer=insurer
+    ).order_by('last_name', 'first_name')
+
+
+def normalize_batch(insurances):
+    """
+    Points insurance rows at the policies of their company and policy
+    number, looking the batch's policies up with one query, creating the
+    missing ones with another, and setting them with one UPDATE.
+    :param insurances: Insurance rows, decrypted, in primary key order.
+    """
+    insurers = {}
+    keys = {}
+    for insurance in insurances:
+        if not normalize_policy(insurance.policy_number):
+            continue
+        name = normalize_name(insurance.company)
+        if name and name not in insurers:
+            insurers[name] = get_insurer(insurance.company)
+        insurer = insurers.get(name)
+        keys[insurance.pk] = (insurer and insurer.pk,
+                              policy_hash(insurance.policy_number))
+
+    def known(digests):
+        return {(policy.insurer_id, policy.policy_hash): policy.pk
+                for policy in Policy.objects.filter(policy_hash__in=digests)}
+
+    policies = known({digest for _, digest in keys.values()})
+    missing = set(keys.values()) - set(policies)
+    if missing:
+        try:
+            with sharding.atomic():
+                Policy.objects.bulk_create([Policy(insurer_id=insurer_id, policy_hash=digest)
+                                            for insurer_id, digest in missing])
+        except IntegrityError:
+            # Another writer created some of them first.
+            for insurer_id, digest in missing:
+                Policy.objects.get_or_create(insurer_id=insurer_id, policy_hash=digest)
+        policies.update(known({digest for _, digest in missing}))
+    Insurance.objects.filter(pk__in=[insurance.pk for insurance in insurances]).update(
+        policy_id=Case(*[When(pk=pk, then=Value(policies[key]))
+                         for pk, key in keys.items()],
+                       default=None, output_field=IntegerField()))
+
+
+def normalize_insurance(batch_size=DEFAULT_BATCH_SIZE, rehash=False):
+    """
+    Runs normalize_batch over every row without a policy, a batch per
+    transaction.
+    :param rehash: Whether to recompute the policy of every row instead,
+                   after PHI_INDEX_KEY has changed, and then delete the
+                   policies of the old hashes.
+    :return: The number of rows normalized.
+    """
+    rows = Insurance.objects.order_by('pk')
+    if not rehash:
+        rows = rows.filter(policy__isnull=True)
+    normalized = 0
+    after = 0
+    while True:
+        with sharding.atomic():
+            insurances = list(rows.filter(pk__gt=after)[:batch_size])
+            if not insurances:
+                break
+            after = insurances[-1].pk
+            normalize_batch(insurances)
+        normalized += len(insurances)
+    if rehash:
+        Policy.objects.filter(insurances=None).delete()
+    return normalized
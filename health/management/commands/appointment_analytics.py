@@ -0,0 +1,66 @@
+import csv
+import os
+import time
+from django.core.management.base import CommandError
+from health import analytics, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Computes hour-of-week heatmaps per doctor and specialisation, '
+            'duration distributions and booking lead times over all live '
+            'and archived appointments, and writes them as .npz or CSV.')
+
+    # Each run writes one output, for one hospital database.
+    all_databases = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('output',
+                            help='An .npz file, or a directory for CSV files.')
+        parser.add_argument('--format', choices=('npz', 'csv'), default=None,
+                            help='Defaults to npz when the output ends in .npz.')
+        parser.add_argument('--chunk-size', type=int,
+                            default=analytics.DEFAULT_CHUNK_SIZE,
+                            help='Rows fetched per query.')
+
+    def handle(self, *args, **options):
+        if analytics.np is None:
+            raise CommandError('appointment_analytics requires NumPy.')
+        output = options['output']
+        output_format = options['format'] or (
+            'npz' if output.endswith('.npz') else 'csv')
+        started = time.perf_counter()
+        results = analytics.compute(chunk_size=options['chunk_size'])
+        if output_format == 'npz':
+            analytics.np.savez_compressed(output, **results)
+        else:
+            os.makedirs(output, exist_ok=True)
+            self.write_csv(output, results)
+        self.stdout.write('Analyzed {0} appointments in {1:.2f}s; wrote {2}.'.format(
+            results['duration_histogram'].sum(),
+            time.perf_counter() - started, output))
+
+    def write_csv(self, directory, results):
+        def write(name, header, rows):
+            with open(os.path.join(directory, name), 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(rows)
+
+        hours = ['{0}:{1:02d}'.format(day, hour)
+                 for day in ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+                 for hour in range(24)]
+        write('doctor_heatmap.csv', ['doctor_id'] + hours,
+              ([doctor] + list(row) for doctor, row in
+               zip(results['doctor_ids'], results['doctor_heatmap'])))
+        write('doctor_minutes.csv', ['doctor_id'] + hours,
+              ([doctor] + list(row) for doctor, row in
+               zip(results['doctor_ids'], results['doctor_minutes'])))
+        write('specialisation_heatmap.csv', ['specialisation'] + hours,
+              ([name] + list(row) for name, row in
+               zip(results['specialisations'],
+                   results['specialisation_heatmap'])))
+        write('durations.csv', ['minutes_from', 'appointments'],
+              ((n * analytics.DURATION_BIN_MINUTES, count) for n, count in
+               enumerate(results['duration_histogram'])))
+        write('lead_times.csv', ['lead_time', 'appointments'],
+              zip(analytics.LEAD_TIME_LABELS, results['lead_time_histogram']))
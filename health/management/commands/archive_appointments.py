@@ -0,0 +1,23 @@
+from health import archive, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Moves appointments older than APPOINTMENT_ARCHIVE_DAYS into the '
+            'month-partitioned archive. Safe to interrupt and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Override the archive horizon, in days.')
+        parser.add_argument('--batch-size', type=int,
+                            default=archive.DEFAULT_BATCH_SIZE,
+                            help='Appointments moved per transaction.')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches.')
+
+    def handle(self, *args, **options):
+        before = archive.archive_horizon(days=options['days'])
+        moved = archive.archive_appointments(
+            before=before, batch_size=options['batch_size'],
+            max_batches=options['max_batches'])
+        self.stdout.write('Archived {0} appointments older than {1}.'.format(
+            moved, before))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from health import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Runs a named benchmark against seeded data. The seeded rows '
+            'are rolled back when the benchmark finishes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', nargs='?',
+                            help='The benchmark to run; omit to list them.')
+        parser.add_argument('--size', type=int, default=None,
+                            help='The data size, e.g. number of doctors or rows.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed repetitions per measurement.')
+
+    def handle(self, *args, **options):
+        name = options['name']
+        if not name:
+            for available in sorted(benchmarks.BENCHMARKS):
+                self.stdout.write(available)
+            return
+        if name not in benchmarks.BENCHMARKS:
+            raise CommandError('Unknown benchmark "{0}". Choose from: {1}'.format(
+                name, ', '.join(sorted(benchmarks.BENCHMARKS))))
+        for line in benchmarks.run(name, size=options['size'],
+                                   repeat=options['repeat']):
+            self.stdout.write(line)
@@ -0,0 +1,23 @@
+from health import encryption, sharding
+from health.models import ClinicalCode, Insurance, MedicalInformation
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Encrypts the patient health information stored in plaintext, '
+            'and re-encrypts what was encrypted under an earlier master key, '
+            'with the data key of PHI_MASTER_KEY, then removes it from the '
+            'audit log reprs. Safe to interrupt and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=encryption.DEFAULT_BATCH_SIZE,
+                            help='Rows rewritten per transaction.')
+
+    def handle(self, *args, **options):
+        for model in (MedicalInformation, Insurance, ClinicalCode):
+            rewritten = encryption.reencrypt(model, options['batch_size'])
+            self.stdout.write('Encrypted {0} {1} rows.'.format(
+                rewritten, model._meta.verbose_name))
+            scrubbed = encryption.scrub_audit_log(model, options['batch_size'])
+            self.stdout.write('Rewrote {0} {1} audit log entries.'.format(
+                scrubbed, model._meta.verbose_name))
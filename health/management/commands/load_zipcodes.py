@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import csv
+from health import geo
+from health.models import ZipCentroid
+
+# Accepted header names, matched case-insensitively; the first set matches
+# the Census Bureau's ZCTA gazetteer file.
+COLUMNS = {
+    'zipcode': ('geoid', 'zcta5', 'zipcode', 'zip'),
+    'latitude': ('intptlat', 'latitude', 'lat'),
+    'longitude': ('intptlong', 'longitude', 'lon', 'lng'),
+}
+
+
+class Command(BaseCommand):
+    help = ('Replaces the zipcode centroid table from a CSV or tab-separated '
+            'file, such as the Census Bureau ZCTA gazetteer, and locates '
+            'hospitals that have no coordinates yet.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The centroid file to load.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows inserted per query.')
+
+    def handle(self, *args, **options):
+        with open(options['path'], newline='', encoding='utf-8-sig') as f:
+            header = f.readline()
+            delimiter = '\t' if '\t' in header else ','
+            names = [name.strip().lower() for name in header.split(delimiter)]
+            positions = {}
+            for field, candidates in COLUMNS.items():
+                matches = [names.index(c) for c in candidates if c in names]
+                if not matches:
+                    raise CommandError('No {0} column in {1}.'.format(
+                        field, options['path']))
+                positions[field] = matches[0]
+            rows = {}
+            for line, row in enumerate(csv.reader(f, delimiter=delimiter), 2):
+                if not row:
+                    continue
+                try:
+                    zipcode = row[positions['zipcode']].strip().zfill(5)
+                    rows[zipcode] = ZipCentroid(
+                        zipcode=zipcode,
+                        latitude=float(row[positions['latitude']]),
+                        longitude=float(row[positions['longitude']]))
+                except (IndexError, ValueError):
+                    raise CommandError('Invalid row on line {0}.'.format(line))
+        with transaction.atomic():
+            ZipCentroid.objects.all().delete()
+            ZipCentroid.objects.bulk_create(list(rows.values()),
+                                            batch_size=options['batch_size'])
+        geo.clear_zipcodes()
+        located = geo.locate_hospitals()
+        self.stdout.write('Loaded {0} zipcodes and located {1} hospitals.'.format(
+            len(rows), located))
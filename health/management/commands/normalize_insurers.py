@@ -0,0 +1,19 @@
+from health import insurers, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Points insurance rows written without a policy at the policy '
+            'of their insurer and policy number. Safe to interrupt and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=insurers.DEFAULT_BATCH_SIZE,
+                            help='Rows normalized per transaction.')
+        parser.add_argument('--rehash', action='store_true',
+                            help='Recompute the policy of every row, after '
+                                 'PHI_INDEX_KEY has changed.')
+
+    def handle(self, *args, **options):
+        normalized = insurers.normalize_insurance(
+            options['batch_size'], rehash=options['rehash'])
+        self.stdout.write('Normalized {0} insurance rows.'.format(normalized))
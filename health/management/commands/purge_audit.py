@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.utils import timezone
+import os
+from health import audit, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Deletes audit log entries older than their AUDIT_RETENTION '
+            'period, in small batches, archiving them to gzip-compressed '
+            'NDJSON under AUDIT_ARCHIVE_DIR first. Safe to interrupt and '
+            're-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive', default=None,
+                            help='The file to archive to, instead of a new '
+                                 'file under AUDIT_ARCHIVE_DIR.')
+        parser.add_argument('--no-archive', action='store_true',
+                            help='Delete without archiving.')
+        parser.add_argument('--batch-size', type=int,
+                            default=audit.DEFAULT_BATCH_SIZE,
+                            help='Entries deleted per statement.')
+        parser.add_argument('--duty-cycle', type=float,
+                            default=audit.DEFAULT_DUTY_CYCLE,
+                            help='The fraction of the time spent working; '
+                                 'the rest is spent sleeping between batches.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count the entries that would be purged.')
+
+    def handle(self, *args, **options):
+        if not 0 < options['duty_cycle'] <= 1:
+            raise CommandError('--duty-cycle must be in (0, 1].')
+        archive = None
+        if not options['no_archive'] and not options['dry_run']:
+            path = options['archive']
+            if path is None:
+                directory = getattr(settings, 'AUDIT_ARCHIVE_DIR', None)
+                if not directory:
+                    raise CommandError('Set AUDIT_ARCHIVE_DIR, or pass '
+                                       '--archive or --no-archive.')
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, timezone.now().strftime(
+                    'audit-%Y%m%dT%H%M%S.ndjson.gz'))
+            archive = audit.Archive(path)
+        try:
+            results = audit.purge_audit_log(
+                archive=archive, batch_size=options['batch_size'],
+                duty_cycle=options['duty_cycle'], dry_run=options['dry_run'])
+        finally:
+            if archive is not None:
+                archive.close()
+        verb = 'Would purge' if options['dry_run'] else 'Purged'
+        for label, days, purged in results:
+            if purged:
+                self.stdout.write('{0} {1} {2} entries older than {3} days.'.format(
+                    verb, purged, label, days))
+        total = sum(purged for _, _, purged in results)
+        if archive is not None and total:
+            self.stdout.write('Archived to {0}.'.format(archive.path))
+        self.stdout.write('{0} {1} entries in total.'.format(verb, total))
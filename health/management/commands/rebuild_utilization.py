@@ -0,0 +1,23 @@
+from django.core.management.base import CommandError
+from django.utils import dateparse
+from health import utilization, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Recomputes the per-doctor daily utilization summary from the '
+            'live and archived appointments, e.g. after a backfill.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to rebuild (YYYY-MM-DD).')
+        parser.add_argument('--end', help='Last day to rebuild (YYYY-MM-DD).')
+
+    def handle(self, *args, **options):
+        days = []
+        for option in ('start', 'end'):
+            value = options[option]
+            day = dateparse.parse_date(value) if value else None
+            if value and not day:
+                raise CommandError('Invalid --{0} date: {1}'.format(option, value))
+            days.append(day)
+        rows = utilization.rebuild(*days)
+        self.stdout.write('Wrote {0} summary rows.'.format(rows))
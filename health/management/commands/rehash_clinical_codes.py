@@ -0,0 +1,15 @@
+from health import clinical, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Recomputes the hash of every clinical code from its display '
+            'text, after PHI_INDEX_KEY has changed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=clinical.DEFAULT_BATCH_SIZE,
+                            help='Codes rehashed per transaction.')
+
+    def handle(self, *args, **options):
+        rehashed = clinical.rehash_codes(options['batch_size'])
+        self.stdout.write('Rehashed {0} clinical codes.'.format(rehashed))
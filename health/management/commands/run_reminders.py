@@ -0,0 +1,46 @@
+from django.db import close_old_connections
+from django.utils import timezone
+from datetime import timedelta
+import time
+from health import reminders, sharding
+
+
+class Command(sharding.ShardedCommand):
+    help = ('Runs the appointment reminder worker, sending each reminder '
+            'REMINDER_LEAD_MINUTES before its appointment through '
+            'REMINDER_SENDER.')
+
+    # A worker runs forever, so each hospital database needs its own.
+    all_databases = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Send the reminders due now and exit.')
+        parser.add_argument('--window-minutes', type=int, default=60,
+                            help='How far past the lead time to load at once.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Reminders handed to the sender per call.')
+        parser.add_argument('--poll-seconds', type=float, default=10,
+                            help='The longest the worker sleeps between '
+                                 'checks for changed appointments.')
+
+    def handle(self, *args, **options):
+        scheduler = reminders.ReminderScheduler(
+            reminders.get_sender(),
+            window=timedelta(minutes=options['window_minutes']),
+            batch_size=options['batch_size'])
+        try:
+            while True:
+                close_old_connections()
+                sent = scheduler.run_once()
+                if sent:
+                    self.stdout.write('Sent {0} reminders.'.format(sent))
+                if options['once']:
+                    return
+                next_due = scheduler.next_due()
+                pause = options['poll_seconds']
+                if next_due is not None:
+                    pause = min(pause, (next_due - timezone.now()).total_seconds())
+                time.sleep(max(pause, 0.1))
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
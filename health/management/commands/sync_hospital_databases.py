@@ -0,0 +1,23 @@
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from health import sharding
+from health.models import Hospital
+
+
+class Command(BaseCommand):
+    help = ('Copies the role groups and hospitals from the default database '
+            'into every other hospital database, keeping their ids. Run '
+            'after migrating a new hospital database.')
+
+    def handle(self, *args, **options):
+        groups = list(Group.objects.using(DEFAULT_DB_ALIAS).all())
+        hospitals = list(Hospital.objects.using(DEFAULT_DB_ALIAS).all())
+        for hospital in hospitals:
+            sharding.mirror_hospital(Hospital, hospital, DEFAULT_DB_ALIAS)
+        for alias in sharding.databases()[1:]:
+            for group in groups:
+                Group.objects.using(alias).update_or_create(
+                    pk=group.pk, defaults={'name': group.name})
+            self.stdout.write('Copied {0} groups and {1} hospitals to {2}.'.format(
+                len(groups), len(hospitals), alias))
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.contrib import auth
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from . import sharding, user_snapshot
+
+
+class UserSnapshotMiddleware(MiddlewareMixin):
+    """
+    Serves request.user from the session snapshot kept by
+    health.user_snapshot, falling back to a normal load (which also takes a
+    fresh snapshot) when the snapshot is missing or stale.
+    Must come after AuthenticationMiddleware. Enabled by
+    settings.USER_SNAPSHOT_ENABLED.
+    """
+
+    def __init__(self, get_response=None):
+        if not getattr(settings, 'USER_SNAPSHOT_ENABLED', False):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_request(self, request):
+        if auth.SESSION_KEY not in request.session:
+            return
+        request.user = SimpleLazyObject(lambda: self.get_user(request))
+
+    def get_user(self, request):
+        if not hasattr(request, '_cached_user'):
+            user = user_snapshot.restore(request.session)
+            if user is None:
+                user = auth.get_user(request)
+                if user.is_authenticated:
+                    user_snapshot.take(user, request.session)
+            request._cached_user = user
+        return request._cached_user
+
+
+class HospitalDatabaseMiddleware(MiddlewareMixin):
+    """
+    Makes the logged-in user's hospital database current for the request
+    (see health.sharding). Must come after SessionMiddleware and before
+    AuthenticationMiddleware. Enabled by settings.HOSPITAL_DATABASES.
+    """
+
+    def __init__(self, get_response=None):
+        if not sharding.enabled():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_request(self, request):
+        alias = request.session.get(sharding.SESSION_KEY)
+        sharding.set_current_database(
+            alias if alias in sharding.databases() else None)
+
+    def process_response(self, request, response):
+        sharding.set_current_database(None)
+        return response
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0006_auto_20190102_1731'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAppointment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.IntegerField(unique=True)),
+                ('date', models.DateTimeField()),
+                ('duration', models.IntegerField()),
+                ('month', models.DateField(db_index=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_doctor_appointments', to=settings.AUTH_USER_MODEL)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_patient_appointments', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedappointment',
+            index=models.Index(fields=['patient', 'date'], name='health_arch_patient_7eda06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedappointment',
+            index=models.Index(fields=['doctor', 'date'], name='health_arch_doctor__95c47f_idx'),
+        ),
+    ]
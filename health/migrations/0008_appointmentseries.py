@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0007_archivedappointment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentSeries',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('duration', models.IntegerField()),
+                ('frequency', models.CharField(max_length=10)),
+                ('interval', models.IntegerField(default=1)),
+                ('weekdays', models.CharField(blank=True, default='', max_length=20)),
+                ('count', models.IntegerField(null=True)),
+                ('until', models.DateTimeField(null=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='doctor_series', to=settings.AUTH_USER_MODEL)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patient_series', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SeriesException',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_date', models.DateTimeField()),
+                ('new_date', models.DateTimeField(null=True)),
+                ('new_duration', models.IntegerField(null=True)),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='health.AppointmentSeries')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='seriesexception',
+            index=models.Index(fields=['series', 'new_date'], name='health_seri_series__a53f59_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='seriesexception',
+            unique_together={('series', 'original_date')},
+        ),
+        migrations.AddIndex(
+            model_name='appointmentseries',
+            index=models.Index(fields=['doctor', 'start'], name='health_appo_doctor__d38627_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentseries',
+            index=models.Index(fields=['patient', 'start'], name='health_appo_patient_cc3c59_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0008_appointmentseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorDailyUtilization',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('booked_minutes', models.IntegerField(default=0)),
+                ('appointment_count', models.IntegerField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_utilization', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='doctordailyutilization',
+            index=models.Index(fields=['day'], name='health_doct_day_c75265_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='doctordailyutilization',
+            unique_together={('doctor', 'day')},
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+# The admin's prefix searches (UPPER(column) LIKE 'X%') can only use an
+# index on the same expression with pattern ops, which Index() cannot
+# express, and the audit log changelist sorts django_admin_log by
+# action_time. Both are PostgreSQL-only; other backends are left alone.
+POSTGRESQL_INDEXES = [
+    ('health_user_upper_username_like', 'health_user', 'UPPER("username") varchar_pattern_ops'),
+    ('health_user_upper_email_like', 'health_user', 'UPPER("email") varchar_pattern_ops'),
+    ('health_user_upper_last_name_like', 'health_user', 'UPPER("last_name") varchar_pattern_ops'),
+    ('django_admin_log_action_time_idx', 'django_admin_log', '"action_time"'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, expression in POSTGRESQL_INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS "{0}" ON "{1}" ({2})'.format(
+            name, table, expression))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in POSTGRESQL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS "{0}"'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0009_doctordailyutilization'),
+        ('admin', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['date'], name='health_appo_date_35efb2_idx'),
+        ),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,95 @@
+from django.db import migrations, models
+import re
+
+# A frozen copy of the parsing in health.clinical as of this migration, so
+# that later changes to the app code do not change what it does.
+TEXT_FIELDS = {
+    'allergy': 'allergies',
+    'medication': 'medications',
+    'condition': 'medical_conditions',
+}
+SEPARATORS = re.compile(r'[,;/\n]+|\band\b', re.IGNORECASE)
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+EMPTY_ENTRIES = {'', 'none', 'na', 'n-a', 'no', 'nil', 'nka', 'nkda', 'unknown'}
+NOISE_WORDS = {
+    'allergy': {'allergy', 'allergies', 'allergic', 'to'},
+    'medication': set(),
+    'condition': set(),
+}
+BATCH_SIZE = 1000
+
+
+def parse_terms(kind, text):
+    terms = []
+    seen = set()
+    for term in SEPARATORS.split(text or ''):
+        words = [word for word in NON_ALPHANUMERIC.split(term.lower())
+                 if word and word not in NOISE_WORDS[kind]]
+        code = '-'.join(words)[:100]
+        if code not in EMPTY_ENTRIES and code not in seen:
+            seen.add(code)
+            terms.append((code, ' '.join(term.split())[:200]))
+    return terms
+
+
+def parse_existing_records(apps, schema_editor):
+    """
+    Parses every existing record in primary key order, a batch at a time,
+    and links the codes with one bulk insert per batch.
+    """
+    MedicalInformation = apps.get_model('health', 'MedicalInformation')
+    ClinicalCode = apps.get_model('health', 'ClinicalCode')
+    database = schema_editor.connection.alias
+    through = MedicalInformation.codes.through
+    codes = {}
+    last_pk = 0
+    while True:
+        batch = list(MedicalInformation.objects.using(database)
+                     .filter(pk__gt=last_pk).order_by('pk')
+                     .only('pk', *TEXT_FIELDS.values())[:BATCH_SIZE])
+        if not batch:
+            return
+        links = []
+        for information in batch:
+            linked = set()
+            for kind, field in TEXT_FIELDS.items():
+                for code, display in parse_terms(kind, getattr(information, field)):
+                    if (kind, code) not in codes:
+                        codes[(kind, code)], _ = ClinicalCode.objects.using(database) \
+                            .get_or_create(kind=kind, code=code,
+                                           defaults={'display': display})
+                    pk = codes[(kind, code)].pk
+                    if pk not in linked:
+                        linked.add(pk)
+                        links.append(through(medicalinformation_id=information.pk,
+                                             clinicalcode_id=pk))
+        through.objects.using(database).bulk_create(links)
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0010_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClinicalCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20)),
+                ('code', models.CharField(max_length=100)),
+                ('display', models.CharField(max_length=200)),
+            ],
+            options={
+                'unique_together': {('kind', 'code')},
+            },
+        ),
+        migrations.AddField(
+            model_name='medicalinformation',
+            name='codes',
+            field=models.ManyToManyField(blank=True, related_name='records', to='health.ClinicalCode'),
+        ),
+        migrations.RunPython(parse_existing_records, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0011_clinicalcode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZipCentroid',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zipcode', models.CharField(max_length=10, unique=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='hospital',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hospital',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0012_zipcentroid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='reminded_for',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# django_admin_log belongs to the admin app, so these are created by hand.
+# (content_type_id, id) lets purge_audit and the reminder worker walk one
+# content type's entries in order; (content_type_id, object_id) serves the
+# admin history pages. Only PostgreSQL and SQLite are handled; object_id is
+# a text column, which MySQL cannot index without a prefix length.
+INDEXES = [
+    ('django_admin_log_content_type_id_id_idx', 'django_admin_log',
+     '"content_type_id", "id"'),
+    ('django_admin_log_content_type_id_object_id_idx', 'django_admin_log',
+     '"content_type_id", "object_id"'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, table, columns in INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS "{0}" ON "{1}" ({2})'.format(
+            name, table, columns))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, _, _ in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS "{0}"'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0015_version_counters'),
+        ('admin', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0017_appointment_patient_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='outside_shift_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'date'], name='health_appo_doctor__cdf43a_idx'),
+        ),
+    ]
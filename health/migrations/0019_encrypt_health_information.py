@@ -0,0 +1,51 @@
+from django.db import migrations, models
+import health.encryption
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0018_appointment_outside_shift'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncryptionKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('master_key_id', models.CharField(max_length=50)),
+                ('wrapped_key', models.CharField(max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='insurance',
+            name='policy_number',
+            field=health.encryption.EncryptedTextField(max_length=200, null=True),
+        ),
+        migrations.AlterField(
+            model_name='medicalinformation',
+            name='additional_info',
+            field=health.encryption.EncryptedTextField(max_length=400, null=True),
+        ),
+        migrations.AlterField(
+            model_name='medicalinformation',
+            name='allergies',
+            field=health.encryption.EncryptedTextField(max_length=200, null=True),
+        ),
+        migrations.AlterField(
+            model_name='medicalinformation',
+            name='family_history',
+            field=health.encryption.EncryptedTextField(max_length=200, null=True),
+        ),
+        migrations.AlterField(
+            model_name='medicalinformation',
+            name='medical_conditions',
+            field=health.encryption.EncryptedTextField(max_length=200, null=True),
+        ),
+        migrations.AlterField(
+            model_name='medicalinformation',
+            name='medications',
+            field=health.encryption.EncryptedTextField(max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0019_encrypt_health_information'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Insurer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('normalized_name', models.CharField(max_length=200, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='insurance',
+            name='policy_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='insurance',
+            name='insurer',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='policies', to='health.Insurer'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='insurance',
+            unique_together={('policy_hash', 'insurer')},
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def split_shared_policies(apps, schema_editor):
+    """
+    Gives every patient sharing an Insurance row their own copy of it. The
+    stored policy numbers are copied as they are, encrypted or not.
+    """
+    Insurance = apps.get_model('health', 'Insurance')
+    MedicalInformation = apps.get_model('health', 'MedicalInformation')
+    database = schema_editor.connection.alias
+    informations = MedicalInformation.objects.using(database)
+    shared = (informations.exclude(insurance=None)
+                          .values('insurance_id')
+                          .annotate(patients=Count('id'))
+                          .filter(patients__gt=1)
+                          .values_list('insurance_id', flat=True))
+    for insurance_id in list(shared):
+        policy = Insurance.objects.using(database).values(
+            'company', 'policy_number', 'insurer_id', 'policy_hash'
+        ).get(pk=insurance_id)
+        others = informations.filter(insurance_id=insurance_id) \
+            .order_by('pk').values_list('pk', flat=True)[1:]
+        for pk in list(others):
+            copy = Insurance.objects.using(database).create(**policy)
+            informations.filter(pk=pk).update(insurance_id=copy.pk)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0020_insurer'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='insurance',
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name='insurance',
+            name='policy_hash',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(split_shared_policies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+from django.db import migrations, models
+from django.db.models import Case, IntegerField, Value, When
+import django.db.models.deletion
+
+BATCH_SIZE = 500
+
+# unique_together does not stop two policies without an insurer from
+# sharing a hash, since NULLs compare distinct. Only PostgreSQL and SQLite
+# are handled; MySQL has no partial indexes.
+NO_INSURER_INDEX = 'health_policy_policy_hash_no_insurer_uniq'
+
+
+def move_to_policies(apps, schema_editor):
+    """
+    Gives every distinct (insurer, policy hash) among the insurance rows one
+    Policy, and points the rows at it, a batch at a time. Rows not hashed
+    yet are left for `manage.py normalize_insurers`.
+    """
+    Insurance = apps.get_model('health', 'Insurance')
+    Policy = apps.get_model('health', 'Policy')
+    database = schema_editor.connection.alias
+    rows = Insurance.objects.using(database).filter(policy_hash__isnull=False) \
+        .order_by('pk').values_list('pk', 'insurer_id', 'policy_hash')
+    after = 0
+    while True:
+        batch = list(rows.filter(pk__gt=after)[:BATCH_SIZE])
+        if not batch:
+            return
+        after = batch[-1][0]
+        keys = {(insurer_id, digest) for _, insurer_id, digest in batch}
+        policies = {(policy.insurer_id, policy.policy_hash): policy.pk
+                    for policy in Policy.objects.using(database).filter(
+                        policy_hash__in={digest for _, digest in keys})}
+        for insurer_id, digest in keys - set(policies):
+            policies[insurer_id, digest] = Policy.objects.using(database).create(
+                insurer_id=insurer_id, policy_hash=digest).pk
+        Insurance.objects.using(database).filter(pk__in=[pk for pk, _, _ in batch]).update(
+            policy_id=Case(*[When(pk=pk, then=Value(policies[insurer_id, digest]))
+                             for pk, insurer_id, digest in batch],
+                           output_field=IntegerField()))
+
+
+def restore_insurance_keys(apps, schema_editor):
+    Insurance = apps.get_model('health', 'Insurance')
+    database = schema_editor.connection.alias
+    for insurance in Insurance.objects.using(database).exclude(policy=None) \
+            .select_related('policy').iterator():
+        Insurance.objects.using(database).filter(pk=insurance.pk).update(
+            insurer_id=insurance.policy.insurer_id,
+            policy_hash=insurance.policy.policy_hash)
+
+
+def create_no_insurer_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    schema_editor.execute('CREATE UNIQUE INDEX IF NOT EXISTS "{0}" ON "health_policy" '
+                          '("policy_hash") WHERE "insurer_id" IS NULL'.format(NO_INSURER_INDEX))
+
+
+def drop_no_insurer_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS "{0}"'.format(NO_INSURER_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0021_insurance_per_patient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Policy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('policy_hash', models.CharField(max_length=64)),
+                ('insurer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='policies', to='health.Insurer')),
+            ],
+            options={
+                'unique_together': {('insurer', 'policy_hash')},
+            },
+        ),
+        migrations.AddField(
+            model_name='insurance',
+            name='policy',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='insurances', to='health.Policy'),
+        ),
+        migrations.RunPython(move_to_policies, restore_insurance_keys),
+        migrations.RunPython(create_no_insurer_index, drop_no_insurer_index),
+        migrations.RemoveField(
+            model_name='insurance',
+            name='insurer',
+        ),
+        migrations.RemoveField(
+            model_name='insurance',
+            name='policy_hash',
+        ),
+    ]
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import migrations, models
+from django.db.models import Case, CharField, Value, When
+import base64
+import hashlib
+import hmac
+import health.encryption
+
+BATCH_SIZE = 500
+
+
+def blind_index(value):
+    # As health.encryption.blind_index() computed it when this was written.
+    key = getattr(settings, 'PHI_INDEX_KEY', None)
+    value = value.encode('utf-8')
+    if key:
+        return hmac.new(base64.b64decode(key), value, hashlib.sha256).hexdigest()
+    if getattr(settings, 'PHI_MASTER_KEY', None):
+        raise ImproperlyConfigured('Set PHI_INDEX_KEY to index encrypted values.')
+    return hashlib.sha256(value).hexdigest()
+
+
+def hash_codes(apps, schema_editor):
+    """
+    Replaces every stored code with its blind index, a batch at a time. The
+    display text is encrypted later, by `manage.py encrypt_phi`.
+    """
+    ClinicalCode = apps.get_model('health', 'ClinicalCode')
+    database = schema_editor.connection.alias
+    rows = ClinicalCode.objects.using(database).order_by('pk') \
+        .values_list('pk', 'kind', 'code_hash')
+    after = 0
+    while True:
+        batch = list(rows.filter(pk__gt=after)[:BATCH_SIZE])
+        if not batch:
+            return
+        after = batch[-1][0]
+        ClinicalCode.objects.using(database).filter(pk__in=[pk for pk, _, _ in batch]).update(
+            code_hash=Case(*[When(pk=pk, then=Value(blind_index('{0}:{1}'.format(kind, code))))
+                             for pk, kind, code in batch],
+                           output_field=CharField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0022_policy'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='clinicalcode',
+            old_name='code',
+            new_name='code_hash',
+        ),
+        # Irreversible: the codes cannot be recovered from their hashes.
+        migrations.RunPython(hash_codes),
+        migrations.AlterField(
+            model_name='clinicalcode',
+            name='code_hash',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='clinicalcode',
+            name='display',
+            field=health.encryption.EncryptedTextField(max_length=200),
+        ),
+    ]
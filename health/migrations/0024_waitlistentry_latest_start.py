@@ -0,0 +1,62 @@
+from django.db import migrations, models
+from django.db.models import Case, DateTimeField, Value, When
+from datetime import timedelta
+
+BATCH_SIZE = 500
+
+
+def set_latest_start(apps, schema_editor):
+    """
+    Fills in the latest start of every entry, a batch at a time.
+    """
+    WaitlistEntry = apps.get_model('health', 'WaitlistEntry')
+    database = schema_editor.connection.alias
+    rows = WaitlistEntry.objects.using(database).order_by('pk') \
+        .values_list('pk', 'window_end', 'duration')
+    after = 0
+    while True:
+        batch = list(rows.filter(pk__gt=after)[:BATCH_SIZE])
+        if not batch:
+            return
+        after = batch[-1][0]
+        WaitlistEntry.objects.using(database).filter(pk__in=[pk for pk, _, _ in batch]).update(
+            latest_start=Case(*[When(pk=pk, then=Value(window_end - timedelta(minutes=duration)))
+                                for pk, window_end, duration in batch],
+                              output_field=DateTimeField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0023_encrypt_clinical_codes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='waitlistentry',
+            name='health_wait_doctor__7d8f4a_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='waitlistentry',
+            name='health_wait_special_859f68_idx',
+        ),
+        migrations.AddField(
+            model_name='waitlistentry',
+            name='latest_start',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(set_latest_start, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='waitlistentry',
+            name='latest_start',
+            field=models.DateTimeField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='waitlistentry',
+            index=models.Index(fields=['doctor', 'latest_start'], name='health_wait_doctor__26c23e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waitlistentry',
+            index=models.Index(fields=['specialisation', 'latest_start'], name='health_wait_special_e809be_idx'),
+        ),
+    ]
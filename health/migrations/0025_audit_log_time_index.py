@@ -0,0 +1,33 @@
+from django.db import migrations
+
+# Extends the (content_type_id, object_id) index of 0016 with action_time,
+# so the patient timeline reads one object's entries newest first from the
+# index. The admin history pages use its leading columns, so the old index
+# is dropped. As in 0016, only PostgreSQL and SQLite are handled.
+OLD_INDEX = ('django_admin_log_content_type_id_object_id_idx',
+             '"content_type_id", "object_id"')
+NEW_INDEX = ('django_admin_log_content_type_id_object_id_time_idx',
+             '"content_type_id", "object_id", "action_time"')
+
+
+def replace_index(old, new):
+    def replace(apps, schema_editor):
+        if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+            return
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS "{0}" ON "django_admin_log" ({1})'.format(*new))
+        schema_editor.execute('DROP INDEX IF EXISTS "{0}"'.format(old[0]))
+    return replace
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0024_waitlistentry_latest_start'),
+        ('admin', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(replace_index(OLD_INDEX, NEW_INDEX),
+                             replace_index(NEW_INDEX, OLD_INDEX)),
+    ]
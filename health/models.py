@@ -2,14 +2,130 @@
 from django.db import models
 from django.utils import timezone
 from datetime import timedelta
+import heapq
+import itertools
+from . import recurrence, sharding
+from .encryption import EncryptedQuerySet, EncryptedTextField
+from .concurrency import gather
+
+# The longest appointment the scheduler accounts for when looking backwards
+# for an appointment that may still be in progress.
+MAX_APPOINTMENT_MINUTES = 24 * 60
 from django.contrib.auth.models import AbstractUser, Group
 
+# Role groups ('Patient', 'Doctor') are fixed reference data, so lookups by
+# name are cached for the life of the process, per hospital database.
+# HealthConfig.ready() clears the cache whenever a group is saved or deleted.
+_role_groups = {}
+
+
+def role_group(name):
+    """
+    :return: The Group with the given name in the current hospital
+             database, cached per process.
+    """
+    key = (sharding.current_database(), name)
+    if key not in _role_groups:
+        _role_groups[key] = Group.objects.get(name=name)
+    return _role_groups[key]
+
+
+def clear_role_groups(**kwargs):
+    _role_groups.clear()
+
+
+# Models with a `version` counter, which every save of an existing row
+# increments. The JSON API derives ETags from it. Saves limited to other
+# fields (such as the last_login update on every login) do not count, and
+# set-based updates must increment the counter themselves.
+VERSIONED_MODELS = ('Appointment', 'DoctorInformation', 'MedicalInformation',
+                    'User')
+
+
+def bump_version(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and 'version' not in update_fields:
+        return
+    instance.version = models.F('version') + 1
+
+
+def refresh_version(sender, instance, raw=False, **kwargs):
+    if not raw and hasattr(instance.version, 'resolve_expression'):
+        instance.version = sender.objects.filter(pk=instance.pk) \
+            .values_list('version', flat=True).get()
+
+
+def bump_group_members(sender, instance, raw=False, **kwargs):
+    """
+    post_save and pre_delete handler for Group: renaming or deleting a group
+    changes the roles of its members, so their versions are incremented.
+    """
+    if raw or kwargs.get('created'):
+        return
+    User.objects.filter(groups=instance).update(version=models.F('version') + 1)
+
+
+def bump_membership_version(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    """
+    m2m_changed handler for User.groups: adding or removing groups changes
+    the user's roles, so the affected users' versions are incremented.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        users = User.objects.filter(pk=instance.pk)
+    elif action == 'pre_clear':
+        users = User.objects.filter(groups=instance)
+    else:
+        users = User.objects.filter(pk__in=pk_set or ())
+    users.update(version=models.F('version') + 1)
+
+
+class Insurer(models.Model):
+    """
+    An insurance company. `normalized_name` is the key company names are
+    matched on (see health.insurers); `name` is the name as first entered.
+    """
+    name = models.CharField(max_length=200)
+    normalized_name = models.CharField(max_length=200, unique=True)
+
+    def __repr__(self):
+        return self.name
+
+class Policy(models.Model):
+    """
+    An insurance policy: its insurer and the blind index of its number (see
+    health.insurers). The patients on a policy each keep their own
+    Insurance row, and those rows share the policy's. (insurer,
+    policy_hash) is unique; so is policy_hash among policies without an
+    insurer, through a partial index created by migration 0022.
+    """
+    insurer = models.ForeignKey(Insurer, null=True, blank=True,
+                                related_name='policies',
+                                on_delete=models.PROTECT)
+    policy_hash = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('insurer', 'policy_hash')
+
+    def __repr__(self):
+        return "Policy with {0}".format(self.insurer)
+
 class Insurance(models.Model):
-    policy_number = models.CharField(max_length=200, null=True)
+    policy_number = EncryptedTextField(max_length=200, null=True)
     company = models.CharField(max_length=200, null=True)
+    # Set by health.insurers from the company and policy number.
+    policy = models.ForeignKey(Policy, null=True, blank=True,
+                               related_name='insurances',
+                               on_delete=models.PROTECT)
+
+    objects = EncryptedQuerySet.as_manager()
 
     def __repr__(self):
-        return "{0} with {1}".format(self.policy_number, self.company)
+        # Written to the audit log, so without the encrypted fields.
+        return "Policy with {0}".format(self.company)
 
 class EmergencyContact(models.Model):
     first_name = models.CharField(max_length=20)
@@ -17,6 +133,37 @@ class EmergencyContact(models.Model):
     phone_number = models.CharField(max_length=30)
     relationship = models.CharField(max_length=30)
 
+class ClinicalCode(models.Model):
+    """
+    One entry in the vocabulary of allergies, medications and conditions
+    recorded on patients. `code_hash` is the blind index of the normalized
+    key the free-text entries are parsed into (see health.clinical), and
+    `display`, the text as first entered, is encrypted, so the database
+    does not name anyone's allergies, medications or conditions. It still
+    shows which patients share a code, through MedicalInformation.codes.
+    """
+    ALLERGY = 'allergy'
+    MEDICATION = 'medication'
+    CONDITION = 'condition'
+    KINDS = (ALLERGY, MEDICATION, CONDITION)
+
+    kind = models.CharField(max_length=20)
+    code_hash = models.CharField(max_length=64)
+    display = EncryptedTextField(max_length=200)
+
+    objects = EncryptedQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('kind', 'code_hash')
+
+    def __str__(self):
+        return self.display
+
+    def __repr__(self):
+        # Written to the audit log, so without the encrypted fields.
+        return '{0} {1}'.format(self.kind, self.pk)
+
+
 class MedicalInformation(models.Model):
     SEX_CHOICES = (
         'Female',
@@ -25,20 +172,21 @@ class MedicalInformation(models.Model):
     )
     sex = models.CharField(max_length=50)
     insurance = models.ForeignKey(Insurance,on_delete=models.CASCADE, null=True)
-    medications = models.CharField(max_length=200, null=True)
-    allergies = models.CharField(max_length=200, null=True)
-    medical_conditions = models.CharField(max_length=200, null=True)
-    family_history = models.CharField(max_length=200, null=True)
-    additional_info = models.CharField(max_length=400, null=True)
+    medications = EncryptedTextField(max_length=200, null=True)
+    allergies = EncryptedTextField(max_length=200, null=True)
+    medical_conditions = EncryptedTextField(max_length=200, null=True)
+    family_history = EncryptedTextField(max_length=200, null=True)
+    additional_info = EncryptedTextField(max_length=400, null=True)
+    version = models.PositiveIntegerField(default=1)
+    # Structured form of allergies, medications and medical_conditions,
+    # re-parsed from the text on every save by health.clinical.
+    codes = models.ManyToManyField(ClinicalCode, related_name='records', blank=True)
+
+    objects = EncryptedQuerySet.as_manager()
 
     def __repr__(self):
-        return (("Sex: {0}, Insurance: {1}, Medications: {2}, Allergies: {3}, " +
-                "Medical Conditions: {4}, Family History: {5}," +
-                " Additional Info: {6}").format(
-                    self.sex, repr(self.insurance), self.medications,
-                    self.allergies, self.medical_conditions,
-                    self.family_history, self.additional_info
-                ))
+        # Written to the audit log, so without the encrypted fields.
+        return "Sex: {0}, Insurance: {1}".format(self.sex, repr(self.insurance))
 
 
 class Hospital(models.Model):
@@ -47,12 +195,36 @@ class Hospital(models.Model):
     city = models.CharField(max_length=200)
     state = models.CharField(max_length=2)
     zipcode = models.CharField(max_length=20)
+    # Filled from the zipcode's centroid by `manage.py load_zipcodes`;
+    # hospitals without a location are left out of nearest-hospital search.
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+
+    def users_in_group(self, group_name):
+        """
+        :return: The hospital's users in the named group, by name.
+        """
+        return User.objects.filter(hospital=self, groups__name=group_name) \
+            .order_by('last_name', 'first_name')
 
     def __repr__(self):
         # "St. Jude Hospital at 1 Hospital Road, Waterbury, CT 06470"
         return ("%s at %s, %s, %s %s" % self.name, self.address, self.city,
                 self.state, self.zipcode)
 
+class ZipCentroid(models.Model):
+    """
+    The geographic centre of a zipcode, loaded from a gazetteer file by
+    `manage.py load_zipcodes`.
+    """
+    zipcode = models.CharField(max_length=10, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+    def __repr__(self):
+        return '{0} at {1}, {2}'.format(self.zipcode, self.latitude, self.longitude)
+
+
 class DoctorInformation(models.Model):
     specialisation = models.CharField(max_length=100,null=True)
     years_of_experience = models.CharField(max_length=2,null=True)
@@ -64,6 +236,7 @@ class DoctorInformation(models.Model):
     first_shift_end = models.CharField(max_length=10,null=True)
     second_shift_start = models.CharField(max_length=10,null=True)
     second_shift_end = models.CharField(max_length=10,null=True)
+    version = models.PositiveIntegerField(default=1)
 
     VISIT_DAYS = (
         'Monday',
@@ -109,6 +282,7 @@ class User(AbstractUser):
     emergency_contact = models.ForeignKey(EmergencyContact, null=True,on_delete=models.CASCADE)
     hospital = models.ForeignKey(Hospital,null=True,on_delete=models.CASCADE)
     doctor_information = models.ForeignKey(DoctorInformation,null=True,on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(default=1)
 
     REQUIRED_FIELDS = ['phone_number', 'email', 'first_name',
                        'last_name']
@@ -126,7 +300,7 @@ class User(AbstractUser):
         """
         if self.is_superuser or self.is_doctor():
             # Admins and doctors can see all users as patients.
-            return Group.objects.get(name='Patient').user_set.all()
+            return role_group('Patient').user_set.all()
         else:
             # Users can only see themselves.
             return User.objects.filter(pk=self.pk)
@@ -146,23 +320,82 @@ class User(AbstractUser):
         return self.all_patients().filter(is_active=True)
 
 
-    def schedule(self):
+    def schedule(self, archived=False):
         """
+        :param archived: If True, reads from the appointment archive instead
+                         of the live Appointment table.
         :return: All appointments for which this person is needed.
         """
+        appointments = (ArchivedAppointment.objects if archived
+                        else Appointment.objects)
         if self.is_superuser:
-            return Appointment.objects
+            return appointments
         elif self.is_doctor():
             # Doctors see all appointments for which they are needed.
-            return Appointment.objects.filter(doctor=self)
+            return appointments.filter(doctor=self)
         # Patients see all appointments
-        return Appointment.objects.filter(patient=self)
+        return appointments.filter(patient=self)
+
+    def past_schedule(self, now=None, limit=None):
+        """
+        Reads past appointments across the live table and the archive.
+        Both sides are ordered by date in the database and merged lazily,
+        so callers never see where an appointment is stored.
+        :param now: The cutoff; defaults to the current time.
+        :param limit: If given, reads at most this many appointments from
+                      each side and returns the `limit` most recent.
+        :return: An iterator over appointments before `now`, most recent first.
+        """
+        now = now or timezone.now()
+        live = (self.schedule().filter(date__lt=now)
+                    .select_related('patient', 'doctor').order_by('-date'))
+        archived = (self.schedule(archived=True).filter(date__lt=now)
+                        .select_related('patient', 'doctor').order_by('-date'))
+        if limit is not None:
+            live, archived = live[:limit], archived[:limit]
+        merged = heapq.merge(live.iterator(), archived.iterator(),
+                             key=lambda appointment: appointment.date,
+                             reverse=True)
+        return itertools.islice(merged, limit)
+
+    def series(self):
+        """
+        :return: All recurring appointment series for which this person
+                 is needed.
+        """
+        if self.is_superuser:
+            return AppointmentSeries.objects
+        elif self.is_doctor():
+            return AppointmentSeries.objects.filter(doctor=self)
+        return AppointmentSeries.objects.filter(patient=self)
+
+    def series_between(self, start, end):
+        """
+        :return: The series that could have an occurrence between start and
+                 end, narrowed in the database by their first and last dates.
+        """
+        return (self.series().filter(start__lte=end)
+                    .exclude(until__lt=start - timedelta(minutes=MAX_APPOINTMENT_MINUTES)))
 
     def upcoming_appointments(self):
+        """
+        :return: This week's appointments and series occurrences, by date.
+        """
         date = timezone.now()
         start_week = date - timedelta(date.weekday())
         end_week = start_week + timedelta(7)
-        return self.schedule().filter(date__range=[start_week, end_week])
+        appointments, series = gather(
+            lambda: list(self.schedule()
+                             .filter(date__range=[start_week, end_week])
+                             .select_related('patient', 'doctor')
+                             .order_by('date')),
+            lambda: list(self.series_between(start_week, end_week)
+                             .select_related('patient', 'doctor')),
+        )
+        occurrences = [recurrence.occurrences(s, start_week, end_week)
+                       for s in series]
+        return list(heapq.merge(appointments, *occurrences,
+                                key=lambda appointment: appointment.date))
 
     def is_patient(self):
         """
@@ -181,32 +414,55 @@ class User(AbstractUser):
         :param group_name: The group within which to check membership.
         :return: True if the user is a member of the group provided.
         """
-        try:
-            return (Group.objects.get(name=group_name)
-                         .user_set.filter(pk=self.pk).exists())
-        except ValueError:
-            return False
+        return group_name in self.role_names()
+
+    def role_names(self):
+        """
+        Loads the names of the user's groups once per instance, so repeated
+        role checks while rendering a page share a single query.
+        :return: The set of group names the user belongs to.
+        """
+        if not hasattr(self, '_role_names'):
+            try:
+                self._role_names = set(self.groups.values_list('name', flat=True))
+            except ValueError:
+                # Unsaved users cannot have groups.
+                return set()
+        return self._role_names
 
     def group(self):
         return self.groups.first()
 
-    def is_free(self, date, duration):
+    def is_free(self, date, duration, exclude=None):
         """
         Checks the user's schedule for a given date and duration to see if
         the user does not have an appointment at that time.
         :param date:
         :param duration:
+        :param exclude: An appointment to leave out, when moving it.
         :return:
         """
-        schedule = self.schedule().all()
         end = date + timedelta(minutes=duration)
+        # Only appointments starting before `end`, and recently enough to
+        # still be in progress at `date`, can intersect.
+        schedule = self.schedule().filter(
+            date__lt=end,
+            date__gt=date - timedelta(minutes=MAX_APPOINTMENT_MINUTES)
+        )
+        if exclude is not None:
+            schedule = schedule.exclude(pk=exclude.pk)
         for appointment in schedule:
             # If the dates intersect (meaning one starts while the other is
             # in progress) then the person is not free at the provided date
-            # and time.
-            if (date <= appointment.date <= end or
-                    appointment.date <= date <= appointment.end()):
+            # and time. Back-to-back appointments do not intersect.
+            if appointment.date < end and date < appointment.end():
                 return False
+        # Recurring series are expanded only around the requested window.
+        for series in self.series_between(date, end):
+            window_start = date - timedelta(minutes=series.duration)
+            for occurrence in recurrence.occurrences(series, window_start, end):
+                if occurrence.date < end and date < occurrence.end():
+                    return False
         return True
 
 
@@ -215,6 +471,21 @@ class Appointment(models.Model):
     doctor = models.ForeignKey(User, related_name='doctor_appointments',on_delete=models.CASCADE)
     date = models.DateTimeField()
     duration = models.IntegerField()
+    # The date the last reminder was sent for; an appointment moved after
+    # being reminded becomes due for a reminder again.
+    reminded_for = models.DateTimeField(null=True, blank=True)
+    # When a change to the doctor's shifts left the appointment outside
+    # them; set and cleared by health.shifts. Such appointments are queued
+    # on the doctor's schedule for rescheduling.
+    outside_shift_since = models.DateTimeField(null=True, blank=True)
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date']),
+            models.Index(fields=['patient', 'date']),
+            models.Index(fields=['doctor', 'date']),
+        ]
 
     def end(self):
         """
@@ -225,3 +496,214 @@ class Appointment(models.Model):
     def __repr__(self):
         return '{0} minutes on {1}, {2} with {3}'.format(self.duration, self.date,
                                                          self.patient, self.doctor)
+
+
+class ArchivedAppointment(models.Model):
+    """
+    An appointment moved out of the live Appointment table by the archiver.
+    Rows are partitioned by `month` (the first day of the appointment's
+    month) so history can be scanned, exported or dropped a month at a time.
+    """
+    original_id = models.IntegerField(unique=True)
+    patient = models.ForeignKey(User, related_name='archived_patient_appointments',on_delete=models.CASCADE)
+    doctor = models.ForeignKey(User, related_name='archived_doctor_appointments',on_delete=models.CASCADE)
+    date = models.DateTimeField()
+    duration = models.IntegerField()
+    month = models.DateField(db_index=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'date']),
+            models.Index(fields=['doctor', 'date']),
+        ]
+
+    @classmethod
+    def from_appointment(cls, appointment):
+        """
+        :return: An unsaved archive row holding a copy of the appointment.
+        """
+        return cls(original_id=appointment.pk, patient_id=appointment.patient_id,
+                   doctor_id=appointment.doctor_id, date=appointment.date,
+                   duration=appointment.duration,
+                   month=timezone.localtime(appointment.date).date().replace(day=1))
+
+    def end(self):
+        """
+        :return: A datetime representing the end of the appointment.
+        """
+        return self.date + timedelta(minutes=self.duration)
+
+    def __repr__(self):
+        return '{0} minutes on {1}, {2} with {3} (archived)'.format(
+            self.duration, self.date, self.patient, self.doctor)
+
+
+class AppointmentSeries(models.Model):
+    """
+    A recurring appointment described by an RRULE-like rule (frequency,
+    interval, weekdays, count and until). Occurrences are never stored;
+    health.recurrence expands them lazily for the window being looked at.
+    """
+    FREQUENCIES = (
+        'Daily',
+        'Weekly',
+    )
+
+    patient = models.ForeignKey(User, related_name='patient_series',on_delete=models.CASCADE)
+    doctor = models.ForeignKey(User, related_name='doctor_series',on_delete=models.CASCADE)
+    start = models.DateTimeField()
+    duration = models.IntegerField()
+    frequency = models.CharField(max_length=10)
+    interval = models.IntegerField(default=1)
+    # Comma-separated weekday numbers (Monday is 0) for weekly series.
+    # Empty means the weekday of `start`.
+    weekdays = models.CharField(max_length=20, blank=True, default='')
+    count = models.IntegerField(null=True)
+    until = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'start']),
+            models.Index(fields=['patient', 'start']),
+        ]
+
+    def weekday_list(self):
+        """
+        :return: The sorted weekday numbers this series occurs on.
+        """
+        if self.frequency != 'Weekly':
+            return []
+        if not self.weekdays:
+            return [timezone.localtime(self.start).weekday()]
+        return sorted({int(day) for day in self.weekdays.split(',')})
+
+    def occurrences(self, start, end):
+        """
+        :return: A generator of the occurrences starting between start and end.
+        """
+        return recurrence.occurrences(self, start, end)
+
+    def next_occurrence(self, after=None):
+        """
+        :return: The first occurrence at or after `after` (default: now),
+                 or None if the series has ended.
+        """
+        after = max(after or timezone.now(), self.start)
+        horizon = after + timedelta(weeks=self.interval * 5)
+        return next(recurrence.occurrences(self, after, horizon), None)
+
+    def describe(self):
+        """
+        :return: A human-readable rule, e.g. "Every 2 weeks on Mon, Wed".
+        """
+        unit = 'day' if self.frequency == 'Daily' else 'week'
+        rule = ('Every {0}'.format(unit) if self.interval == 1 else
+                'Every {0} {1}s'.format(self.interval, unit))
+        days = self.weekday_list()
+        if days:
+            rule += ' on ' + ', '.join(DoctorInformation.VISIT_DAYS[d][:3]
+                                       for d in days)
+        if self.count:
+            rule += ', {0} times'.format(self.count)
+        if self.until:
+            rule += ' until {0}'.format(timezone.localtime(self.until).date())
+        return rule
+
+    def __repr__(self):
+        return '{0}, {1} minutes from {2}, {3} with {4}'.format(
+            self.describe(), self.duration, self.start, self.patient,
+            self.doctor)
+
+
+class SeriesException(models.Model):
+    """
+    A change to a single occurrence of a series. Only changed occurrences
+    have a row: a null `new_date` skips the occurrence, otherwise it is
+    moved to `new_date` (and optionally given a new duration).
+    """
+    series = models.ForeignKey(AppointmentSeries, related_name='exceptions',on_delete=models.CASCADE)
+    original_date = models.DateTimeField()
+    new_date = models.DateTimeField(null=True)
+    new_duration = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('series', 'original_date')
+        indexes = [
+            models.Index(fields=['series', 'new_date']),
+        ]
+
+
+
+class DoctorDailyUtilization(models.Model):
+    """
+    Booked minutes per doctor per day, kept up to date incrementally by
+    health.utilization as appointments are created, moved and cancelled.
+    Shift minutes are derived from DoctorInformation when reports are read.
+    """
+    doctor = models.ForeignKey(User, related_name='daily_utilization',on_delete=models.CASCADE)
+    day = models.DateField()
+    booked_minutes = models.IntegerField(default=0)
+    appointment_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('doctor', 'day')
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __repr__(self):
+        return '{0} minutes in {1} appointments on {2} for {3}'.format(
+            self.booked_minutes, self.appointment_count, self.day, self.doctor)
+
+
+class WaitlistEntry(models.Model):
+    """
+    A patient waiting for an earlier appointment, either with one doctor or
+    with any doctor of a specialisation (optionally at one hospital),
+    starting at any time between `window_start` and `window_end`.
+    When a matching slot is freed, health.waitlist books it and records the
+    appointment here.
+    """
+    patient = models.ForeignKey(User, related_name='waitlist_entries',on_delete=models.CASCADE)
+    doctor = models.ForeignKey(User, related_name='waitlisted_by', null=True, blank=True,on_delete=models.CASCADE)
+    specialisation = models.CharField(max_length=100, null=True, blank=True)
+    hospital = models.ForeignKey(Hospital, null=True, blank=True,on_delete=models.CASCADE)
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    duration = models.IntegerField()
+    # The latest start of an appointment that still ends inside the window,
+    # kept by save() so matching can filter on it in the database.
+    latest_start = models.DateTimeField(editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    appointment = models.ForeignKey(Appointment, related_name='waitlist_entries', null=True, blank=True,on_delete=models.SET_NULL)
+    fulfilled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # Matching scans only entries that can still take a slot.
+        indexes = [
+            models.Index(fields=['doctor', 'latest_start']),
+            models.Index(fields=['specialisation', 'latest_start']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.latest_start = self.window_end - timedelta(minutes=self.duration)
+        super().save(*args, **kwargs)
+
+    def __repr__(self):
+        return '{0} waiting for {1} between {2} and {3}'.format(
+            self.patient, self.doctor or self.specialisation,
+            self.window_start, self.window_end)
+
+
+class EncryptionKey(models.Model):
+    """
+    A data key for health.encryption, stored wrapped by the master key
+    named `master_key_id` in PHI_MASTER_KEYS.
+    """
+    master_key_id = models.CharField(max_length=50)
+    wrapped_key = models.CharField(max_length=200)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __repr__(self):
+        return 'Data key {0} under master key {1}'.format(self.pk, self.master_key_id)
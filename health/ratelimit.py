@@ -0,0 +1,155 @@
+"""
+Admission control for the expensive endpoints: logging in, which hashes
+the password with PBKDF2, and booking, which locks and checks both
+people's schedules.
+
+Each protected view has two layers, configured by name in settings:
+
+* RATE_LIMITS gives token buckets per client IP and per account (the
+  logged-in user, or the email being logged in as), as (requests, seconds)
+  pairs. A bucket holds up to `requests` tokens and refills at
+  requests/seconds, so short bursts pass and sustained floods are held to
+  the average rate. Buckets live in the default cache, which must be
+  shared between workers (memcached, redis, database) for the limits to
+  hold across them. With the local-memory cache each process keeps its own
+  buckets. Reading and writing a bucket is not atomic, so racing requests
+  can occasionally both take the last token.
+* CONCURRENCY_LIMITS caps how many requests per process run the view at
+  once. A request arriving when every slot is taken is turned away at once
+  instead of queueing behind the others, so the requests already admitted
+  keep their latency during a spike.
+
+Refused requests get a 429 with a Retry-After header, as JSON when the
+request came from a script or the API.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from functools import wraps
+import hashlib
+import math
+import threading
+import time
+
+DEFAULT_RATE_LIMITS = {}
+DEFAULT_CONCURRENCY_LIMITS = {}
+# How long a request that found every slot busy is told to wait.
+BUSY_RETRY_SECONDS = 1
+
+
+def client_ip(request):
+    """
+    :return: The client's address. Behind RATE_LIMIT_PROXY_COUNT trusted
+             reverse proxies, that is the address the outermost proxy saw,
+             read from the right of X-Forwarded-For.
+    """
+    proxies = getattr(settings, 'RATE_LIMIT_PROXY_COUNT', 0)
+    if proxies:
+        forwarded = [address.strip() for address in
+                     request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')
+                     if address.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def bucket_key(name, kind, identity):
+    digest = hashlib.sha1(str(identity).encode('utf-8')).hexdigest()
+    return 'ratelimit:{0}:{1}:{2}'.format(name, kind, digest)
+
+
+def take_token(key, requests, seconds, now=None):
+    """
+    Takes a token from a bucket holding up to `requests` tokens that
+    refills at requests/seconds.
+    :return: 0 if a token was taken, otherwise the seconds until one will
+             be available.
+    """
+    now = time.time() if now is None else now
+    rate = requests / seconds
+    tokens, updated = cache.get(key, (requests, now))
+    tokens = min(requests, tokens + (now - updated) * rate)
+    if tokens < 1:
+        return (1 - tokens) / rate
+    # Once the bucket would be full again its entry can expire.
+    cache.set(key, (tokens - 1, now), math.ceil(seconds))
+    return 0
+
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def slots(name):
+    """
+    :return: The per-process semaphore counting the requests running the
+             views named `name`, or None if they are not capped.
+    """
+    limit = getattr(settings, 'CONCURRENCY_LIMITS',
+                    DEFAULT_CONCURRENCY_LIMITS).get(name)
+    if not limit:
+        return None
+    if name not in _slots:
+        with _slots_lock:
+            if name not in _slots:
+                _slots[name] = threading.BoundedSemaphore(limit)
+    return _slots[name]
+
+
+def too_many_requests(request, retry_after, json=False):
+    retry_after = max(1, int(math.ceil(retry_after)))
+    message = 'Too many requests. Please try again in {0} seconds.'.format(retry_after)
+    if json or request.is_ajax():
+        response = JsonResponse({'error': message}, status=429)
+    else:
+        response = HttpResponse(message, status=429, content_type='text/plain')
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def request_identities(request, account_field):
+    """
+    :return: (kind, identity) pairs to limit the request by. Logged-in
+             users are told apart by their database as well as their id,
+             since ids repeat across hospital databases.
+    """
+    identities = [('ip', client_ip(request))]
+    if request.user.is_authenticated:
+        identities.append(('user', '{0}:{1}'.format(request.user._state.db,
+                                                    request.user.pk)))
+    elif account_field and request.POST.get(account_field):
+        identities.append(('user', request.POST[account_field].lower()))
+    return identities
+
+
+def limit(name, methods=('POST',), account_field=None, json=False):
+    """
+    Applies the RATE_LIMITS and CONCURRENCY_LIMITS configured under `name`
+    to a view, for requests with the given methods.
+    :param account_field: For anonymous requests, the POST field naming the
+                          account the request acts on, such as the email
+                          on the login form.
+    :param json: Whether refusals are always answered with JSON.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return view(request, *args, **kwargs)
+            rates = getattr(settings, 'RATE_LIMITS', DEFAULT_RATE_LIMITS).get(name, {})
+            for kind, identity in request_identities(request, account_field):
+                if kind in rates:
+                    wait = take_token(bucket_key(name, kind, identity), *rates[kind])
+                    if wait:
+                        return too_many_requests(request, wait, json)
+            capped = slots(name)
+            if capped is None:
+                return view(request, *args, **kwargs)
+            if not capped.acquire(blocking=False):
+                return too_many_requests(request, BUSY_RETRY_SECONDS, json)
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                capped.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,158 @@
+"""
+Lazy expansion of recurring appointment series.
+
+A series is never materialized into Appointment rows. Instead, the
+occurrences that fall inside a window are computed arithmetically from the
+rule, so looking at one week of a series that runs for years costs the same
+as looking at one week of a series that runs for a month. Exceptions are
+stored sparsely and only the ones touching the window are loaded.
+"""
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+import heapq
+
+
+class Occurrence(object):
+    """
+    A single occurrence of a series. It has the same attributes templates
+    and conflict checks use on an Appointment.
+    """
+
+    def __init__(self, series, date, duration, original_date):
+        self.series = series
+        self.date = date
+        self.duration = duration
+        self.original_date = original_date
+
+    @property
+    def patient(self):
+        return self.series.patient
+
+    @property
+    def doctor(self):
+        return self.series.doctor
+
+    def end(self):
+        """
+        :return: A datetime representing the end of the occurrence.
+        """
+        return self.date + timedelta(minutes=self.duration)
+
+    def __repr__(self):
+        return '{0} minutes on {1}, {2} with {3} (recurring)'.format(
+            self.duration, self.date, self.patient, self.doctor)
+
+
+def _rule(series):
+    """
+    Breaks a series into a repeating period and the offsets within it.
+    :return: A tuple of (origin, period, offsets, skipped): the start of the
+             first period, the period length, the sorted offsets of the
+             occurrences inside one period, and how many of the first
+             period's offsets fall before the series start.
+    """
+    if series.frequency == 'Daily':
+        return series.start, timedelta(days=series.interval), [timedelta(0)], 0
+    local_start = timezone.localtime(series.start)
+    origin = series.start - timedelta(days=local_start.weekday())
+    offsets = [timedelta(days=day) for day in series.weekday_list()]
+    skipped = sum(1 for day in series.weekday_list()
+                  if day < local_start.weekday())
+    return origin, timedelta(weeks=series.interval), offsets, skipped
+
+
+def rule_dates(series, start, end):
+    """
+    Yields the dates the rule produces between start and end (inclusive),
+    in order, ignoring exceptions. The first period to examine is computed
+    directly, so nothing before `start` is generated.
+    """
+    origin, period, offsets, skipped = _rule(series)
+    if not offsets:
+        return
+    first_period = max(0, (start - origin) // period)
+    index = first_period * len(offsets) - skipped
+    date = origin + first_period * period
+    while True:
+        for offset in offsets:
+            occurrence = date + offset
+            if index >= 0:
+                if occurrence > end:
+                    return
+                if series.count is not None and index >= series.count:
+                    return
+                if series.until is not None and occurrence > series.until:
+                    return
+                if occurrence >= start:
+                    yield occurrence
+            index += 1
+        date += period
+
+
+def occurrences(series, start, end):
+    """
+    Yields the occurrences of a series starting between start and end
+    (inclusive), in date order, with skipped occurrences removed and moved
+    occurrences placed at their new date.
+    :param series: The AppointmentSeries to expand.
+    :param start: The beginning of the window.
+    :param end: The end of the window.
+    """
+    if 'exceptions' in getattr(series, '_prefetched_objects_cache', {}):
+        # Prefetched for a wider window by the caller.
+        exceptions = [exception for exception in series.exceptions.all()
+                      if start <= exception.original_date <= end
+                      or (exception.new_date is not None
+                          and start <= exception.new_date <= end)]
+    else:
+        exceptions = list(series.exceptions.filter(
+            Q(original_date__range=[start, end]) | Q(new_date__range=[start, end])
+        ))
+    changed = {exception.original_date for exception in exceptions}
+    moved = sorted(
+        (Occurrence(series, exception.new_date,
+                    exception.new_duration or series.duration,
+                    exception.original_date)
+         for exception in exceptions
+         if exception.new_date is not None
+         and start <= exception.new_date <= end),
+        key=lambda occurrence: occurrence.date
+    )
+    regular = (Occurrence(series, date, series.duration, date)
+               for date in rule_dates(series, start, end)
+               if date not in changed)
+    return heapq.merge(regular, moved,
+                       key=lambda occurrence: occurrence.date)
+
+
+def is_occurrence(series, date):
+    """
+    :return: Whether the rule produces an occurrence at `date`, including
+             one that has since been skipped or moved.
+    """
+    return next(rule_dates(series, date, date), None) == date
+
+
+def skip_occurrence(series, original_date):
+    """
+    Cancels a single occurrence of a series.
+    :return: The stored exception.
+    """
+    exception, _ = series.exceptions.update_or_create(
+        original_date=original_date,
+        defaults={'new_date': None, 'new_duration': None}
+    )
+    return exception
+
+
+def move_occurrence(series, original_date, new_date, duration=None):
+    """
+    Moves a single occurrence of a series to a new date.
+    :return: The stored exception.
+    """
+    exception, _ = series.exceptions.update_or_create(
+        original_date=original_date,
+        defaults={'new_date': new_date, 'new_duration': duration}
+    )
+    return exception
@@ -0,0 +1,204 @@
+"""
+Appointment reminders, dispatched by the long-running
+`manage.py run_reminders` worker.
+
+The worker keeps a heap of reminders due over a bounded horizon: it loads
+appointments a window at a time (a range scan on Appointment.date), so
+memory holds at most one lead time plus one window of bookings. Between
+loads it follows the admin LogEntry table, which every appointment write
+path appends to, from the last entry it has seen, so bookings and moves
+inside the loaded horizon are picked up without re-scanning appointments.
+Each due batch is re-read before sending, which drops anything cancelled
+or moved since it was queued, is handed to the configured sender in one
+call, and is marked with a single UPDATE.
+
+Reminders are sent REMINDER_LEAD_MINUTES before an appointment through the
+class named by REMINDER_SENDER. Recurring series occurrences are not
+stored as appointments and are not reminded.
+"""
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from datetime import timedelta
+import heapq
+from .models import Appointment
+
+DEFAULT_LEAD_MINUTES = 24 * 60
+DEFAULT_SENDER = 'health.reminders.EmailSender'
+
+
+class EmailSender(object):
+    """
+    Sends each batch of reminders over one connection to the configured
+    email backend. In development that is the file backend, which writes
+    the messages under EMAIL_FILE_PATH instead of sending them.
+    """
+    subject = 'Appointment reminder'
+    body = ('Dear {name},\n\nThis is a reminder of your {duration} minute '
+            'appointment with {doctor} on {date:%A, %B %d at %I:%M %p}.\n')
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def message(self, appointment):
+        patient = appointment.patient
+        return EmailMessage(
+            self.subject,
+            self.body.format(
+                name=patient.get_full_name() or patient.username,
+                duration=appointment.duration,
+                doctor=appointment.doctor.get_full_name() or appointment.doctor.username,
+                date=timezone.localtime(appointment.date)),
+            to=[patient.email])
+
+    def send(self, appointments):
+        """
+        :return: The appointments whose reminders were sent.
+        """
+        appointments = [a for a in appointments if a.patient.email]
+        connection = get_connection(self.backend)
+        connection.send_messages([self.message(a) for a in appointments])
+        return appointments
+
+
+def get_sender():
+    """
+    :return: An instance of the sender class named by REMINDER_SENDER.
+    """
+    return import_string(getattr(settings, 'REMINDER_SENDER', DEFAULT_SENDER))()
+
+
+def needs_reminder():
+    """
+    :return: A filter for appointments not yet reminded at their date.
+    """
+    return Q(reminded_for__isnull=True) | ~Q(reminded_for=F('date'))
+
+
+class ReminderScheduler(object):
+    """
+    The reminder worker's state: a heap of (due, appointment id, date)
+    entries, the latest queued date per appointment (older heap entries
+    for an appointment are stale and skipped), the end of the loaded
+    horizon and the LogEntry cursor.
+    """
+
+    def __init__(self, sender, lead=None, window=timedelta(hours=1),
+                 batch_size=500, now=None):
+        self.sender = sender
+        self.lead = lead if lead is not None else timedelta(
+            minutes=getattr(settings, 'REMINDER_LEAD_MINUTES', DEFAULT_LEAD_MINUTES))
+        self.window = window
+        self.batch_size = batch_size
+        self.heap = []
+        self.queued = {}
+        self.loaded_until = now or timezone.now()
+        self.content_type = ContentType.objects.get_for_model(Appointment)
+        last = LogEntry.objects.filter(content_type=self.content_type) \
+            .order_by('-pk').values_list('pk', flat=True).first()
+        self.log_cursor = last or 0
+
+    def queue(self, appointment_id, date):
+        self.queued[appointment_id] = date
+        heapq.heappush(self.heap, (date - self.lead, appointment_id, date))
+
+    def load_window(self, now):
+        """
+        Queues the unreminded appointments between the end of the loaded
+        horizon and one lead time plus one window from now.
+        :return: The number of appointments queued.
+        """
+        until = now + self.lead + self.window
+        if until <= self.loaded_until:
+            return 0
+        rows = Appointment.objects.filter(
+            needs_reminder(), date__gte=max(self.loaded_until, now), date__lt=until
+        ).values_list('pk', 'date')
+        count = 0
+        for appointment_id, date in rows.iterator():
+            self.queue(appointment_id, date)
+            count += 1
+        self.loaded_until = until
+        return count
+
+    def poll_changes(self, now):
+        """
+        Follows the audit log from the cursor and requeues the appointments
+        it names that now fall inside the loaded horizon.
+        :return: The number of appointments requeued.
+        """
+        entries = list(LogEntry.objects.filter(
+            content_type=self.content_type, pk__gt=self.log_cursor
+        ).order_by('pk').values_list('pk', 'object_id'))
+        if not entries:
+            return 0
+        self.log_cursor = entries[-1][0]
+        ids = {int(object_id) for _, object_id in entries if object_id}
+        for appointment_id in ids:
+            self.queued.pop(appointment_id, None)
+        rows = Appointment.objects.filter(
+            needs_reminder(), pk__in=ids, date__gte=now, date__lt=self.loaded_until
+        ).values_list('pk', 'date')
+        count = 0
+        for appointment_id, date in rows:
+            self.queue(appointment_id, date)
+            count += 1
+        return count
+
+    def pop_due(self, now):
+        """
+        :return: A dict of up to batch_size appointment ids due by `now`,
+                 mapped to the date they were queued for.
+        """
+        due = {}
+        while self.heap and len(due) < self.batch_size and self.heap[0][0] <= now:
+            _, appointment_id, date = heapq.heappop(self.heap)
+            if self.queued.get(appointment_id) == date:
+                del self.queued[appointment_id]
+                due[appointment_id] = date
+        return due
+
+    def dispatch(self, due):
+        """
+        Sends the reminders for a batch of due appointments that still
+        exist at the queued date and marks them reminded.
+        :return: The number of reminders sent.
+        """
+        appointments = [
+            a for a in Appointment.objects.filter(needs_reminder(), pk__in=due)
+            .select_related('patient', 'doctor')
+            if a.date == due[a.pk]
+        ]
+        if not appointments:
+            return 0
+        sent = self.sender.send(appointments)
+        Appointment.objects.filter(pk__in=[a.pk for a in sent]) \
+            .update(reminded_for=F('date'))
+        return len(sent)
+
+    def next_due(self):
+        """
+        :return: When the earliest queued reminder is due, or None.
+        """
+        while self.heap and self.queued.get(self.heap[0][1]) != self.heap[0][2]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def run_once(self, now=None):
+        """
+        Loads, follows changes and sends every reminder due by `now`.
+        :return: The number of reminders sent.
+        """
+        now = now or timezone.now()
+        self.load_window(now)
+        self.poll_changes(now)
+        sent = 0
+        while True:
+            due = self.pop_due(now)
+            if not due:
+                return sent
+            sent += self.dispatch(due)
@@ -0,0 +1,233 @@
+"""
+Hospital sharding: each hospital's users and everything hanging off them
+(profiles, appointments, series, waitlists, summaries, the audit log) can
+live in a database of its own, named by HOSPITAL_DATABASES, which maps
+hospital ids to database aliases. Hospitals not listed, and users without
+a hospital, stay in 'default'.
+
+Every database has the full schema. GLOBAL_MODELS live in 'default' only,
+except that hospitals are mirrored into every other database whenever
+they are saved, so the foreign keys and joins from users to their
+hospital hold inside each database. Role groups are reference data copied
+by `manage.py sync_hospital_databases`.
+
+Queries are routed by the database current for the thread: during a
+request, the one holding the logged-in user, remembered in the session at
+login; elsewhere, the one selected with use_database(). The schedule, the
+pickers, all_patients() and the directory are therefore scoped to the
+user's database without naming it. Queries about a saved object follow
+the object's database. Transactions are opened with atomic() from here,
+on the current database, since that is where the queries inside them go.
+Logging in, checking that an email is free and the user directory look
+in every database, in parallel, through fan_out().
+
+The admin site and administrators' schedules and event streams are not
+cross-hospital: like every other page, they show the database of the
+session's user, so an administrator works on one hospital database at a
+time.
+
+Appointments can only join a doctor and a patient in the same database.
+Users cannot be moved between databases by editing their hospital.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from contextlib import contextmanager
+import threading
+
+SESSION_KEY = '_hospital_database'
+
+# Models stored only in the default database, as 'app_label.model'.
+GLOBAL_MODELS = frozenset(['health.hospital', 'health.zipcentroid',
+                           'sessions.session'])
+
+_state = threading.local()
+
+
+def enabled():
+    return bool(getattr(settings, 'HOSPITAL_DATABASES', None))
+
+
+def hospital_database(hospital_id):
+    """
+    :return: The alias of the database holding a hospital's data.
+    """
+    if hospital_id in (None, ''):
+        return DEFAULT_DB_ALIAS
+    return getattr(settings, 'HOSPITAL_DATABASES', {}).get(int(hospital_id),
+                                                          DEFAULT_DB_ALIAS)
+
+
+def databases():
+    """
+    :return: The aliases of every database holding hospital data, default
+             first.
+    """
+    aliases = set(getattr(settings, 'HOSPITAL_DATABASES', {}).values())
+    aliases.discard(DEFAULT_DB_ALIAS)
+    return [DEFAULT_DB_ALIAS] + sorted(aliases)
+
+
+def current_database():
+    """
+    :return: The alias queries on this thread are routed to.
+    """
+    return getattr(_state, 'database', None) or DEFAULT_DB_ALIAS
+
+
+def set_current_database(alias):
+    """
+    Routes this thread's queries to a database until changed; None
+    restores the default.
+    """
+    _state.database = alias
+
+
+@contextmanager
+def use_database(alias):
+    """
+    Routes this thread's queries to the given database inside the block.
+    """
+    previous = getattr(_state, 'database', None)
+    _state.database = alias
+    try:
+        yield alias
+    finally:
+        _state.database = previous
+
+
+def atomic(savepoint=True):
+    """
+    transaction.atomic() on the current database. Hospital data is written
+    there, so a bare transaction.atomic(), which opens its transaction on
+    'default', would leave those writes in autocommit.
+    """
+    return transaction.atomic(using=current_database(), savepoint=savepoint)
+
+
+def on_commit(function):
+    """
+    Calls a function once the transaction open on the current database
+    commits, or at once outside a transaction.
+    """
+    transaction.on_commit(function, using=current_database())
+
+
+def is_global(model):
+    return model._meta.label_lower in GLOBAL_MODELS
+
+
+def fan_out(function, aliases=None):
+    """
+    Calls a function once per database, with that database current,
+    running the calls concurrently on the query thread pool.
+    :return: A dict of alias to the function's result.
+    """
+    from . import concurrency
+    aliases = databases() if aliases is None else aliases
+
+    def on(alias):
+        def call():
+            with use_database(alias):
+                return function()
+        return call
+
+    return dict(zip(aliases, concurrency.gather(*[on(alias) for alias in aliases])))
+
+
+class HospitalRouter(object):
+    """
+    Routes global models to the default database, queries about a saved
+    object to that object's database, and everything else to the current
+    database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not enabled():
+            return None
+        if is_global(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        # Global instances say nothing about where related rows live.
+        if instance is not None and instance._state.db and not is_global(type(instance)):
+            return instance._state.db
+        return current_database()
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not enabled():
+            return None
+        return obj1._state.db == obj2._state.db or \
+            is_global(type(obj1)) or is_global(type(obj2))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Every database has the full schema.
+        return None
+
+
+def mirror_hospital(sender, instance, using, raw=False, **kwargs):
+    """
+    Copies a hospital saved in the default database into every other one.
+    """
+    if raw or using != DEFAULT_DB_ALIAS:
+        return
+    fields = {field.attname: getattr(instance, field.attname)
+              for field in sender._meta.concrete_fields if not field.primary_key}
+    for alias in databases()[1:]:
+        sender._default_manager.using(alias).update_or_create(pk=instance.pk,
+                                                              defaults=fields)
+
+
+def unmirror_hospital(sender, instance, using, **kwargs):
+    if using != DEFAULT_DB_ALIAS:
+        return
+    for alias in databases()[1:]:
+        sender._default_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+def remember_database(sender, request, user, **kwargs):
+    """
+    Stores the logged-in user's database in the session, for
+    HospitalDatabaseMiddleware.
+    """
+    if enabled():
+        request.session[SESSION_KEY] = user._state.db
+
+
+def exists_anywhere(model, **filters):
+    """
+    :return: Whether any database has a row matching the filters.
+    """
+    return any(fan_out(lambda: model._default_manager.filter(**filters).exists())
+               .values())
+
+
+class ShardedCommand(BaseCommand):
+    """
+    A management command run once per hospital database in turn, with that
+    database current, or only for the one named by --database.
+    Commands that run forever set all_databases = False, and then serve
+    the default database unless told otherwise.
+    """
+    all_databases = True
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument('--database', default=None,
+                            help='The hospital database to work on.')
+        return parser
+
+    def execute(self, *args, **options):
+        alias = options.get('database')
+        if alias is not None and alias not in databases():
+            raise CommandError('Unknown hospital database: {0}'.format(alias))
+        if alias is not None or not self.all_databases:
+            aliases = [alias or DEFAULT_DB_ALIAS]
+        else:
+            aliases = databases()
+        for alias in aliases:
+            if len(aliases) > 1:
+                self.stdout.write('Database {0}:'.format(alias))
+            with use_database(alias):
+                super().execute(*args, **options)
@@ -0,0 +1,125 @@
+"""
+Revalidation of a doctor's bookings when their shifts change.
+
+Saving a DoctorInformation whose visit days or shift times may have
+changed revalidates the future appointments of its doctor. The bookings
+are loaded in one query as (id, start, end) intervals, ordered by start,
+and the doctor's shifts over the same span are expanded and merged into
+sorted, non-overlapping intervals. A single sweep over both lists then
+finds every appointment not contained in a shift, so the cost is linear
+in the number of bookings and days, with no query per appointment.
+
+Appointments found outside the shifts are flagged with the time the
+change was detected (Appointment.outside_shift_since), which queues them
+on the doctor's schedule page for rescheduling, and appointments back
+inside the shifts are unflagged: one UPDATE each, for only the rows whose
+state changed. Moving or cancelling a flagged appointment through the
+appointment form replaces or deletes it, which takes it off the queue.
+Recurring series are not revalidated.
+"""
+from django.utils import timezone
+from datetime import timedelta
+from .availability import shift_intervals
+from .models import Appointment, User
+
+# The DoctorInformation fields that define a doctor's shifts.
+SHIFT_FIELDS = frozenset(['visit_days', 'two_shift', 'first_shift_start',
+                          'first_shift_end', 'second_shift_start',
+                          'second_shift_end'])
+
+
+def merge(intervals):
+    """
+    :param intervals: (start, end) intervals sorted by start.
+    :return: The intervals with overlapping and touching ones joined.
+    """
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def shift_cover(doctor_information, start, end):
+    """
+    :return: The merged intervals the doctor is on shift in, for the shifts
+             starting between the day before `start` and the day of `end`,
+             so shifts running past midnight into `start` are included.
+    """
+    day = timezone.localtime(start).date() - timedelta(days=1)
+    last_day = timezone.localtime(end).date()
+    intervals = []
+    while day <= last_day:
+        intervals.extend(shift_intervals(doctor_information, day))
+        day += timedelta(days=1)
+    return merge(sorted(intervals))
+
+
+def outside_shifts(bookings, cover):
+    """
+    :param bookings: (id, start, end) tuples sorted by start.
+    :param cover: Sorted, non-overlapping (start, end) shift intervals.
+    :return: The ids of the bookings not contained in any shift interval.
+    """
+    outside = []
+    index = 0
+    for pk, start, end in bookings:
+        # The only interval that can contain a booking is the last one
+        # starting at or before it.
+        while index + 1 < len(cover) and cover[index + 1][0] <= start:
+            index += 1
+        if not cover or not (cover[index][0] <= start and end <= cover[index][1]):
+            outside.append(pk)
+    return outside
+
+
+def revalidate(doctor, now=None):
+    """
+    Flags the doctor's future appointments that are outside their shifts,
+    and unflags the ones that are not.
+    :return: The ids of the appointments outside the shifts.
+    """
+    now = now or timezone.now()
+    bookings = []
+    flagged = set()
+    for pk, date, duration, since in (
+            Appointment.objects.filter(doctor=doctor, date__gte=now)
+                               .order_by('date')
+                               .values_list('pk', 'date', 'duration',
+                                            'outside_shift_since')):
+        bookings.append((pk, date, date + timedelta(minutes=duration)))
+        if since is not None:
+            flagged.add(pk)
+    outside = []
+    if bookings and doctor.doctor_information is not None:
+        cover = shift_cover(doctor.doctor_information, bookings[0][1],
+                            max(end for _, _, end in bookings))
+        outside = outside_shifts(bookings, cover)
+    newly_outside = set(outside) - flagged
+    back_inside = flagged - set(outside)
+    if newly_outside:
+        Appointment.objects.filter(pk__in=newly_outside) \
+                           .update(outside_shift_since=now)
+    if back_inside:
+        Appointment.objects.filter(pk__in=back_inside) \
+                           .update(outside_shift_since=None)
+    return outside
+
+
+def revalidate_shifts(sender, instance, created=False, raw=False,
+                      update_fields=None, **kwargs):
+    """
+    Revalidates the appointments of the doctors a DoctorInformation belongs
+    to after it is saved with possibly changed shifts.
+    """
+    if raw or created:
+        return
+    if update_fields is not None and not SHIFT_FIELDS.intersection(update_fields):
+        return
+    doctors = User.objects.filter(doctor_information=instance,
+                                  groups__name='Doctor')
+    for doctor in doctors:
+        doctor.doctor_information = instance
+        revalidate(doctor)
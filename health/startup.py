@@ -0,0 +1,128 @@
+"""
+Warm-up work done once per worker at WSGI boot, so the first requests a new
+worker serves do not pay for cold caches. Called from mediTech.wsgi when
+settings.WARM_STARTUP is on; it is deliberately not run from
+HealthConfig.ready(), which also runs for management commands.
+"""
+from django.apps import apps
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+from django.urls import get_resolver
+import logging
+import os
+import time
+from . import geo
+from .models import role_group
+
+logger = logging.getLogger(__name__)
+
+ROLE_GROUPS = ('Patient', 'Doctor')
+
+
+def warm_role_groups():
+    """
+    Resolves the role groups into the per-process role_group() cache.
+    :return: The number of groups resolved.
+    """
+    found = 0
+    for name in ROLE_GROUPS:
+        try:
+            role_group(name)
+            found += 1
+        except Group.DoesNotExist:
+            logger.warning('Role group %s does not exist.', name)
+    return found
+
+
+def warm_content_types():
+    """
+    Loads the content types of every installed model into ContentType's
+    cache, which the audit log helpers consult on every write.
+    :return: The number of content types cached.
+    """
+    return len(ContentType.objects.get_for_models(*apps.get_models()))
+
+
+def template_names(engine):
+    """
+    :return: The names of all .html templates the engine can find in its
+             directories and the installed apps' template directories.
+    """
+    directories = list(engine.dirs)
+    if engine.app_dirs or any('app_directories' in str(loader)
+                              for loader in engine.loaders):
+        directories += [os.path.join(config.path, 'templates')
+                        for config in apps.get_app_configs()]
+    names = set()
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                if filename.endswith('.html'):
+                    path = os.path.join(root, filename)
+                    names.add(os.path.relpath(path, directory))
+    return sorted(names)
+
+
+def warm_templates():
+    """
+    Compiles every template, so with the cached loader no request has to
+    parse one.
+    :return: The number of templates compiled.
+    """
+    compiled = 0
+    for backend in engines.all():
+        engine = getattr(backend, 'engine', None)
+        if engine is None:
+            continue
+        for name in template_names(engine):
+            try:
+                engine.get_template(name)
+                compiled += 1
+            except (TemplateDoesNotExist, TemplateSyntaxError):
+                logger.warning('Could not precompile template %s.', name)
+    return compiled
+
+
+def warm_hospital_index():
+    """
+    Builds the nearest-hospital k-d tree.
+    :return: The number of hospitals indexed.
+    """
+    return len(geo.hospital_index())
+
+
+def warm_urls():
+    """
+    Populates the URL resolver's reverse lookup tables.
+    """
+    get_resolver()._populate()
+
+
+def warm_up():
+    """
+    Runs every warm-up step and logs how long each took. Database
+    connections opened here are closed afterwards, so a pre-forking server
+    does not share them between workers.
+    """
+    steps = (
+        ('role groups', warm_role_groups),
+        ('content types', warm_content_types),
+        ('templates', warm_templates),
+        ('url resolver', warm_urls),
+        ('hospital index', warm_hospital_index),
+    )
+    try:
+        for label, step in steps:
+            started = time.perf_counter()
+            try:
+                result = step()
+            except Exception:
+                logger.exception('Warming %s failed.', label)
+                continue
+            logger.info('Warmed %s in %.1f ms%s.', label,
+                        (time.perf_counter() - started) * 1000,
+                        '' if result is None else ' ({0})'.format(result))
+    finally:
+        connections.close_all()
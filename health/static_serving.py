@@ -0,0 +1,140 @@
+"""
+A WSGI wrapper that serves collected static files from STATIC_ROOT with
+the precompressed variants written by health.staticfiles.
+
+The file index is built once when the wrapper is created, so a request
+costs a dictionary lookup rather than filesystem probing. The best encoding
+the client accepts (brotli, then gzip, then identity) is chosen per
+request. Fingerprinted files get far-future immutable caching headers;
+everything else is cached briefly and revalidated with Last-Modified.
+"""
+from email.utils import formatdate, parsedate_to_datetime
+import mimetypes
+import os
+import re
+from wsgiref.util import FileWrapper
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'public, max-age=60'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# ManifestStaticFilesStorage inserts a 12 hex digit hash before the extension.
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+
+class StaticFile(object):
+
+    def __init__(self, path, variants):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.mtime = int(os.path.getmtime(path))
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.content_type = (mimetypes.guess_type(path)[0]
+                             or 'application/octet-stream')
+        if self.content_type.startswith('text/') or \
+                self.content_type in ('application/javascript', 'image/svg+xml'):
+            self.content_type += '; charset=utf-8'
+        self.immutable = bool(HASHED_NAME.search(path))
+        # encoding -> (path, size), best encoding first.
+        self.variants = [(encoding, variants[suffix], os.path.getsize(variants[suffix]))
+                         for encoding, suffix in ENCODINGS if suffix in variants]
+
+    def choose(self, accept_encoding):
+        """
+        :return: A tuple of (path, size, encoding or None) for the smallest
+                 variant the client accepts.
+        """
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, path, size in self.variants:
+            if encoding in accepted:
+                return path, size, encoding
+        return self.path, self.size, None
+
+
+def accepted_encodings(header):
+    """
+    :param header: An Accept-Encoding header value.
+    :return: The set of content codings the client accepts with q > 0.
+    """
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                pass
+        if quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def build_index(root):
+    """
+    :return: A dict mapping each file's URL path relative to root to its
+             StaticFile.
+    """
+    index = {}
+    for directory, _, files in os.walk(root):
+        names = set(files)
+        for name in files:
+            if name.endswith(('.gz', '.br')) and name[:-3] in names:
+                continue
+            path = os.path.join(directory, name)
+            variants = {suffix: path + suffix for _, suffix in ENCODINGS
+                        if name + suffix in names}
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            index[relative] = StaticFile(path, variants)
+    return index
+
+
+class PrecompressedStaticFiles(object):
+    """
+    Wraps a WSGI application, answering requests under `prefix` from the
+    files in `root` and passing everything else through.
+    """
+
+    def __init__(self, application, root, prefix):
+        self.application = application
+        self.prefix = '/' + prefix.strip('/') + '/'
+        self.files = build_index(root) if os.path.isdir(root) else {}
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            return self.application(environ, start_response)
+        static_file = self.files.get(path[len(self.prefix):])
+        if static_file is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.application(environ, start_response)
+        return self.serve(static_file, environ, start_response)
+
+    def serve(self, static_file, environ, start_response):
+        headers = [
+            ('Cache-Control', IMMUTABLE_CACHE_CONTROL if static_file.immutable
+             else DEFAULT_CACHE_CONTROL),
+            ('Last-Modified', static_file.last_modified),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if since:
+            try:
+                if parsedate_to_datetime(since).timestamp() >= static_file.mtime:
+                    start_response('304 Not Modified', headers)
+                    return []
+            except (TypeError, ValueError):
+                pass
+        path, size, encoding = static_file.choose(
+            environ.get('HTTP_ACCEPT_ENCODING', ''))
+        headers += [
+            ('Content-Type', static_file.content_type),
+            ('Content-Length', str(size)),
+        ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        f = open(path, 'rb')
+        file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+        return file_wrapper(f, 64 * 1024)
@@ -0,0 +1,96 @@
+"""
+The static asset build step: `collectstatic` with
+CompressedManifestStaticFilesStorage fingerprints every asset into its
+filename (ManifestStaticFilesStorage) and writes .gz and, when the optional
+brotli package is installed, .br variants next to each compressible file,
+ready for health.static_serving to hand out without compressing per request.
+"""
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+import gzip
+import io
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.js', '.map', '.json', '.svg', '.txt', '.html', '.xml',
+    '.eot', '.ttf', '.otf',
+}
+# A variant is only kept if it saves at least this fraction of the size.
+MINIMUM_SAVING = 0.05
+
+
+def gzip_bytes(data):
+    """
+    :return: The data gzipped at the highest level with a zero timestamp,
+             so rebuilding unchanged assets produces identical files.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def compress_file(path):
+    """
+    Writes precompressed variants of one file.
+    :return: The list of variant paths written.
+    """
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    encoders = [('.gz', gzip_bytes)]
+    if brotli is not None:
+        encoders.append(('.br', lambda raw: brotli.compress(raw, quality=11)))
+    written = []
+    for suffix, encode in encoders:
+        encoded = encode(data)
+        if len(encoded) <= len(data) * (1 - MINIMUM_SAVING):
+            with open(path + suffix, 'wb') as f:
+                f.write(encoded)
+            written.append(path + suffix)
+        elif os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage that also precompresses every collected
+    file, both under its original and its fingerprinted name.
+    """
+
+    def url_converter(self, name, hashed_files, template=None):
+        """
+        Leaves references to files that are not shipped (such as the
+        glyphicon fonts flatly.css points at) as they are instead of
+        failing the whole build.
+        """
+        converter = super().url_converter(name, hashed_files, template)
+
+        def tolerant_converter(matchobj):
+            try:
+                return converter(matchobj)
+            except (ValueError, SuspiciousFileOperation):
+                return matchobj.group(0)
+        return tolerant_converter
+
+    def post_process(self, paths, dry_run=False, **options):
+        collected = set()
+        for name, hashed_name, processed in super().post_process(
+                paths, dry_run=dry_run, **options):
+            yield name, hashed_name, processed
+            if not isinstance(processed, Exception):
+                collected.add(name)
+                if hashed_name:
+                    collected.add(hashed_name)
+        if dry_run:
+            return
+        for name in sorted(collected):
+            if self.exists(name):
+                compress_file(self.path(name))
@@ -0,0 +1,107 @@
+from django import template
+from django.contrib.admin.templatetags import admin_list
+from django.db.models import Max, Min
+from django.urls import get_script_prefix, get_urlconf, reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from functools import lru_cache
+import copy
+import datetime
+
+register = template.Library()
+
+# Reversed in place of a real primary key to find where the key goes.
+_PK_PLACEHOLDER = 2147483647
+
+
+@lru_cache(maxsize=None)
+def _split_url(name, script_prefix, urlconf):
+    return reverse(name, args=[_PK_PLACEHOLDER], urlconf=urlconf) \
+        .split(str(_PK_PLACEHOLDER), 1)
+
+
+@register.filter
+def pk_url(pk, name):
+    """
+    The equivalent of {% url name pk %} for URLs whose only argument is an
+    integer primary key. The URL is reversed once per name and the key is
+    spliced in afterwards, which keeps per-row links cheap in long tables.
+    """
+    prefix, suffix = _split_url(name, get_script_prefix(), get_urlconf())
+    return '{0}{1}{2}'.format(prefix, int(pk), suffix)
+
+
+@register.filter
+def user_link(user):
+    """
+    Renders a link to the user's medical information page.
+    A filter instead of an {% include %} of a template, since it is used for
+    every row of the schedule tables.
+    """
+    return format_html('<a href="{0}">{1}</a>',
+                       pk_url(user.pk, 'medical_information'),
+                       user.get_full_name())
+
+
+@register.filter
+def isoformat(value):
+    """
+    The ISO 8601 form of a datetime, as {{ value|date:"c" }} would render
+    it in UTC, without the date filter's per-call formatting machinery.
+    """
+    return value.isoformat()
+
+
+class _PeriodRange(object):
+    """
+    Stands in for a changelist's queryset in the admin's date_hierarchy
+    tag. Instead of SELECT DISTINCT over every matching row, the periods
+    offered are all those between the first and last date, which an index
+    on the date field answers with two lookups. Periods without rows may
+    be listed.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.bounds = {}
+
+    def aggregate(self, first, last):
+        # Each bound is fetched separately through ORDER BY ... LIMIT 1,
+        # which every backend serves from the index; MIN() and MAX() in one
+        # query are not optimised by all of them.
+        field_name = first.source_expressions[0].name
+        if field_name not in self.bounds:
+            values = self.queryset.values_list(field_name, flat=True)
+            self.bounds[field_name] = {
+                'first': values.order_by(field_name).first(),
+                'last': values.order_by('-' + field_name).first(),
+            }
+        return self.bounds[field_name]
+
+    def dates(self, field_name, kind):
+        bounds = self.aggregate(first=Min(field_name), last=Max(field_name))
+        if bounds['first'] is None:
+            return []
+        first, last = bounds['first'], bounds['last']
+        if isinstance(first, datetime.datetime) and timezone.is_aware(first):
+            first, last = timezone.localtime(first), timezone.localtime(last)
+        first, last = first.date(), last.date()
+        if kind == 'year':
+            return [datetime.date(year, 1, 1)
+                    for year in range(first.year, last.year + 1)]
+        if kind == 'month':
+            return [datetime.date(month // 12, month % 12 + 1, 1)
+                    for month in range(first.year * 12 + first.month - 1,
+                                       last.year * 12 + last.month)]
+        return [first + datetime.timedelta(days=day)
+                for day in range((last - first).days + 1)]
+
+
+@register.inclusion_tag('admin/date_hierarchy.html')
+def date_range_hierarchy(cl):
+    """
+    The admin's {% date_hierarchy %} for large tables; see _PeriodRange.
+    """
+    cl = copy.copy(cl)
+    cl.queryset = _PeriodRange(cl.queryset)
+    return admin_list.date_hierarchy(cl)
@@ -1,3 +1,1022 @@
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.admin.models import ADDITION, LogEntry
+from django.contrib.auth.models import AnonymousUser, Group
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connections, transaction
+from django.http import HttpResponse, QueryDict
+from django.template.loader import render_to_string
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+import asyncio
+import json
+import threading
+from . import (archive, availability, booking, bulk, clinical, concurrency,
+               encryption, events, geo, insurers, ratelimit, recurrence,
+               sharding, timeline, user_snapshot, utilization, views)
+from .models import (Appointment, AppointmentSeries, ArchivedAppointment,
+                     ClinicalCode, DoctorDailyUtilization, DoctorInformation,
+                     Hospital, Insurance, Insurer, MedicalInformation, Policy,
+                     User, WaitlistEntry)
 
-# Create your tests here.
+HOSPITAL_ID = 1
+HOSPITAL_DATABASE = 'hospital'
+
+
+def next_monday(hour, weeks=1):
+    """
+    :return: A local datetime on a Monday at least `weeks` weeks ahead.
+    """
+    today = timezone.localtime().replace(hour=hour, minute=0, second=0,
+                                         microsecond=0)
+    return today + timedelta(days=7 * weeks - today.weekday())
+
+
+def make_user(username, group, **fields):
+    """
+    Creates a user in the current hospital database and adds it to a role
+    group, creating the group if needed.
+    """
+    user = User.objects.create_user(username, email=username, password='password',
+                                    first_name=username[0].upper(), last_name='Test',
+                                    phone_number='5555555555', **fields)
+    group, _ = Group.objects.get_or_create(name=group)
+    user.groups.add(group)
+    return user
+
+
+@override_settings(HOSPITAL_DATABASES={HOSPITAL_ID: HOSPITAL_DATABASE})
+class ShardingTransactionTests(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.hospital = Hospital.objects.create(
+            pk=HOSPITAL_ID, name='North', address='1 Road', city='Town',
+            state='CT', zipcode='06470')
+
+    def test_hospital_is_mirrored(self):
+        self.assertTrue(Hospital.objects.using(HOSPITAL_DATABASE)
+                        .filter(pk=HOSPITAL_ID).exists())
+
+    def test_atomic_rolls_back_writes_to_the_hospital_database(self):
+        with sharding.use_database(HOSPITAL_DATABASE):
+            with self.assertRaises(RuntimeError):
+                with sharding.atomic():
+                    make_user('rolled-back@example.com', 'Patient')
+                    raise RuntimeError
+            self.assertFalse(User.objects.filter(username='rolled-back@example.com').exists())
+        self.assertFalse(User.objects.using(HOSPITAL_DATABASE)
+                         .filter(username='rolled-back@example.com').exists())
+
+    def test_booking_rollback_on_the_hospital_database(self):
+        date = timezone.now() + timedelta(days=1)
+        with sharding.use_database(HOSPITAL_DATABASE):
+            doctor = make_user('doctor@example.com', 'Doctor', hospital=self.hospital)
+            patient = make_user('patient@example.com', 'Patient', hospital=self.hospital)
+            with sharding.atomic():
+                appointment, message = booking.book(doctor, patient, date, 30)
+                self.assertIsNone(message)
+                transaction.set_rollback(True, using=sharding.current_database())
+            self.assertFalse(Appointment.objects.exists())
+        self.assertEqual(appointment._state.db, HOSPITAL_DATABASE)
+        self.assertFalse(User.objects.filter(username='doctor@example.com').exists())
+
+    def test_signup_rejects_an_unknown_hospital(self):
+        for hospital in ('North', '-1', str(HOSPITAL_ID + 1)):
+            response = self.client.post('/signup/', {'hospital': hospital})
+            self.assertContains(response, 'Invalid hospital.')
+
+
+@override_settings(HOSPITAL_DATABASES={HOSPITAL_ID: HOSPITAL_DATABASE})
+class ConcurrentQueryTests(TransactionTestCase):
+    # gather() only uses the pool outside a transaction.
+    multi_db = True
+
+    def test_gather_closes_pool_connections(self):
+        with sharding.use_database(HOSPITAL_DATABASE):
+            for username in ('a@example.com', 'b@example.com'):
+                make_user(username, 'Patient')
+        wrapper = type(connections[HOSPITAL_DATABASE])
+        close = wrapper.close
+        closed = []
+
+        def closing(connection):
+            closed.append((threading.get_ident(), connection.alias))
+            close(connection)
+
+        def usernames():
+            return threading.get_ident(), tuple(
+                User.objects.order_by('username').values_list('username', flat=True))
+
+        with mock.patch.object(wrapper, 'close', closing), \
+                sharding.use_database(HOSPITAL_DATABASE):
+            results = concurrency.gather(*[usernames] * 4)
+        self.assertEqual({names for _, names in results},
+                         {('a@example.com', 'b@example.com')})
+        pool_threads = {thread for thread, _ in results[1:]}
+        self.assertNotIn(threading.get_ident(), pool_threads)
+        # CONN_MAX_AGE is 0, so every task closes what it opened.
+        self.assertLessEqual({(thread, HOSPITAL_DATABASE) for thread in pool_threads},
+                             set(closed))
+
+    def test_gather_runs_in_turn_inside_a_transaction(self):
+        def thread():
+            return threading.get_ident()
+
+        with transaction.atomic():
+            results = concurrency.gather(thread, thread)
+        self.assertEqual(results, [threading.get_ident()] * 2)
+
+
+@override_settings(HOSPITAL_DATABASES={HOSPITAL_ID: HOSPITAL_DATABASE})
+class CrossShardKeyTests(TestCase):
+    """
+    Ids repeat across hospital databases, so nothing keyed by a user or an
+    appointment may mix up rows with the same id in different databases.
+    """
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        hospital = Hospital.objects.create(
+            pk=HOSPITAL_ID, name='North', address='1 Road', city='Town',
+            state='CT', zipcode='06470')
+        self.default_doctor = make_user('alice@example.com', 'Doctor', id=7)
+        self.default_patient = make_user('carol@example.com', 'Patient', id=8)
+        with sharding.use_database(HOSPITAL_DATABASE):
+            self.hospital_doctor = make_user('bob@example.com', 'Doctor', id=7,
+                                             hospital=hospital)
+            self.hospital_patient = make_user('dave@example.com', 'Patient', id=8,
+                                              hospital=hospital)
+
+    def request_for(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return request
+
+    def test_event_topics(self):
+        date = timezone.now() + timedelta(days=1)
+        default = Appointment.objects.create(doctor=self.default_doctor,
+                                             patient=self.default_patient,
+                                             date=date, duration=30)
+        with sharding.use_database(HOSPITAL_DATABASE):
+            hospital = Appointment.objects.create(doctor=self.hospital_doctor,
+                                                  patient=self.hospital_patient,
+                                                  date=date, duration=30)
+            watched = events.watched_topics(self.hospital_doctor, QueryDict())
+            watched_by_admin = events.watched_topics(
+                make_user('admin@example.com', 'Doctor', is_superuser=True),
+                QueryDict('doctor=7'))
+        self.assertFalse(events.topics_for(default) & events.topics_for(hospital))
+        self.assertTrue(watched & events.topics_for(hospital))
+        self.assertFalse(watched & events.topics_for(default))
+        self.assertTrue(watched_by_admin & events.topics_for(hospital))
+        self.assertFalse(watched_by_admin & events.topics_for(default))
+
+    def test_snapshot_versions(self):
+        hospital_version = user_snapshot.current_version(7, HOSPITAL_DATABASE)
+        self.assertNotEqual(user_snapshot.current_version(7, 'default'),
+                            hospital_version)
+        self.default_doctor.save()
+        self.assertEqual(user_snapshot.current_version(7, HOSPITAL_DATABASE),
+                         hospital_version)
+
+    def test_navbar_fragment(self):
+        render_to_string('navbar.html', request=self.request_for(self.default_doctor))
+        with sharding.use_database(HOSPITAL_DATABASE):
+            navbar = render_to_string('navbar.html',
+                                      request=self.request_for(self.hospital_doctor))
+        self.assertIn('B Test', navbar)
+        self.assertNotIn('A Test', navbar)
+
+    def test_rate_limit_buckets(self):
+        default = dict(ratelimit.request_identities(
+            self.request_for(self.default_doctor), None))
+        hospital = dict(ratelimit.request_identities(
+            self.request_for(self.hospital_doctor), None))
+        self.assertNotEqual(default['user'], hospital['user'])
+
+
+class UserSnapshotTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('patient@example.com', 'Patient')
+        self.group = Group.objects.create(name='Volunteer')
+
+    def assertInvalidates(self, change):
+        version = user_snapshot.current_version(self.user.pk)
+        change()
+        self.assertNotEqual(user_snapshot.current_version(self.user.pk), version)
+
+    def test_adding_from_the_group_side(self):
+        self.assertInvalidates(lambda: self.group.user_set.add(self.user))
+        self.assertInvalidates(lambda: self.group.user_set.remove(self.user))
+
+    def test_deleting_a_group(self):
+        self.group.user_set.add(self.user)
+        self.assertInvalidates(self.group.delete)
+
+
+class UtilizationSignalTests(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            'admin@example.com', 'admin@example.com', 'password',
+            phone_number='5555555555')
+        self.doctor = make_user('doctor@example.com', 'Doctor')
+        self.patient = make_user('patient@example.com', 'Patient')
+        self.date = (timezone.now() + timedelta(days=2)).replace(
+            hour=10, minute=0, second=0, microsecond=0)
+        self.client.force_login(self.admin)
+
+    def summary(self):
+        # Rows emptied by cancellations read the same as missing rows.
+        return sorted(DoctorDailyUtilization.objects
+                      .exclude(appointment_count=0)
+                      .values_list('doctor_id', 'day', 'booked_minutes',
+                                   'appointment_count'))
+
+    def assertMatchesRebuild(self):
+        incremental = self.summary()
+        utilization.rebuild()
+        self.assertEqual(incremental, self.summary())
+
+    def book(self, offset=0, duration=30):
+        with sharding.atomic():
+            appointment, message = booking.book(
+                self.doctor, self.patient,
+                self.date + timedelta(hours=offset), duration)
+        self.assertIsNone(message)
+        return appointment
+
+    def admin_form(self, date, duration, version=1):
+        local = timezone.localtime(date)
+        return {'date_0': local.strftime('%Y-%m-%d'),
+                'date_1': local.strftime('%H:%M:%S'),
+                'duration': duration, 'patient': self.patient.pk,
+                'doctor': self.doctor.pk, 'version': version}
+
+    def test_admin_add_change_and_delete(self):
+        response = self.client.post('/admin/health/appointment/add/',
+                                    self.admin_form(self.date, 30))
+        self.assertEqual(response.status_code, 302)
+        self.assertMatchesRebuild()
+        appointment = Appointment.objects.get()
+        response = self.client.post(
+            '/admin/health/appointment/{0}/change/'.format(appointment.pk),
+            self.admin_form(self.date + timedelta(days=1), 45,
+                            appointment.version))
+        self.assertEqual(response.status_code, 302)
+        self.assertMatchesRebuild()
+        response = self.client.post(
+            '/admin/health/appointment/{0}/delete/'.format(appointment.pk),
+            {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Appointment.objects.exists())
+        self.assertMatchesRebuild()
+
+    def test_deleting_a_patient_cascades(self):
+        self.book()
+        self.book(offset=1)
+        self.patient.delete()
+        self.assertMatchesRebuild()
+
+    def test_deleting_a_doctor_cascades(self):
+        self.book()
+        self.doctor.delete()
+        self.assertEqual(self.summary(), [])
+        self.assertMatchesRebuild()
+
+    def test_bulk_cancel(self):
+        for offset in range(3):
+            self.book(offset=offset)
+        request = RequestFactory().post('/')
+        request.user = self.doctor
+        cancelled = bulk.cancel_appointments(
+            request, self.doctor, self.date, self.date + timedelta(days=1))
+        self.assertEqual(cancelled, 3)
+        self.assertMatchesRebuild()
+
+    def test_archive_keeps_archived_appointments(self):
+        self.book()
+        self.book(offset=1, duration=60)
+        before = self.summary()
+        archive.archive_appointments(before=self.date + timedelta(days=1))
+        self.assertFalse(Appointment.objects.exists())
+        self.assertEqual(before, self.summary())
+        self.assertMatchesRebuild()
+
+
+class AdmissionTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def post(self, view, **data):
+        request = self.factory.post('/', data, REMOTE_ADDR='10.0.0.1')
+        request.user = AnonymousUser()
+        return view(request)
+
+    def test_bucket_refills_at_its_rate(self):
+        key = ratelimit.bucket_key('test', 'ip', '10.0.0.1')
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=100), 0)
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=100), 0)
+        self.assertAlmostEqual(ratelimit.take_token(key, 2, 10, now=100), 5)
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=105), 0)
+
+    @override_settings(RATE_LIMITS={'test-rate': {'user': (1, 60)}})
+    def test_account_is_limited_across_case(self):
+        view = ratelimit.limit('test-rate', account_field='email')(
+            lambda request: HttpResponse())
+        self.assertEqual(self.post(view, email='A@example.com').status_code, 200)
+        response = self.post(view, email='a@example.com')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(self.post(view, email='b@example.com').status_code, 200)
+        request = self.factory.get('/')
+        request.user = AnonymousUser()
+        self.assertEqual(view(request).status_code, 200)
+
+    @override_settings(CONCURRENCY_LIMITS={'test-busy': 1})
+    def test_busy_view_turns_requests_away(self):
+        inner = []
+
+        @ratelimit.limit('test-busy', json=True)
+        def view(request):
+            if not inner:
+                # A second request arriving while this one holds the slot.
+                inner.append(self.post(view))
+            return HttpResponse()
+
+        self.assertEqual(self.post(view).status_code, 200)
+        self.assertEqual(inner[0].status_code, 429)
+        self.assertEqual(inner[0]['Retry-After'], str(ratelimit.BUSY_RETRY_SECONDS))
+        self.assertIn('error', json.loads(inner[0].content.decode()))
+        # The slot was given back.
+        self.assertEqual(self.post(view).status_code, 200)
+
+    @override_settings(RATE_LIMIT_PROXY_COUNT=1)
+    def test_client_ip_behind_a_proxy(self):
+        request = self.factory.get('/', REMOTE_ADDR='10.0.0.1',
+                                   HTTP_X_FORWARDED_FOR='1.1.1.1, 2.2.2.2')
+        self.assertEqual(ratelimit.client_ip(request), '2.2.2.2')
+
+
+class PastScheduleTests(TestCase):
+
+    def setUp(self):
+        self.doctor = make_user('doctor@example.com', 'Doctor')
+        self.patient = make_user('patient@example.com', 'Patient')
+        now = timezone.now()
+        self.dates = [now - timedelta(days=days) for days in (1, 2, 3, 4)]
+        for date in self.dates:
+            Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                       date=date, duration=30)
+        archive.archive_appointments(before=now - timedelta(days=2, hours=12))
+
+    def test_limit_merges_the_live_table_and_the_archive(self):
+        self.assertEqual([a.date for a in self.patient.past_schedule(limit=3)],
+                         self.dates[:3])
+        self.assertEqual(len(list(self.patient.past_schedule())), 4)
+
+    def test_schedule_lists_the_most_recent(self):
+        self.client.force_login(self.patient)
+        with mock.patch('health.views.PAST_APPOINTMENTS', 2):
+            response = self.client.get('/schedule/')
+        self.assertEqual([a.date for a in response.context['schedule_past']],
+                         self.dates[:2])
+        self.assertContains(response, 'Most recent past appointments')
+
+
+class BulkRescheduleTests(TestCase):
+
+    def setUp(self):
+        self.doctor = make_user('doctor@example.com', 'Doctor')
+        self.other_doctor = make_user('other@example.com', 'Doctor')
+        self.patients = [make_user('patient{0}@example.com'.format(n), 'Patient')
+                         for n in range(2)]
+        self.date = next_monday(9)
+        self.request = RequestFactory().post('/')
+        self.request.user = self.doctor
+        with sharding.atomic():
+            for n, patient in enumerate(self.patients):
+                booking.book(self.doctor, patient, self.date + timedelta(hours=n), 30)
+
+    def reschedule(self, delta):
+        return bulk.reschedule_appointments(self.request, self.doctor, self.date,
+                                            self.date + timedelta(days=1), delta)
+
+    def test_moves_every_appointment_and_locks_everyone_involved(self):
+        with mock.patch('health.booking.lock_people',
+                        wraps=booking.lock_people) as lock_people:
+            self.assertEqual(self.reschedule(timedelta(minutes=30)), (2, None))
+        lock_people.assert_called_once_with(self.doctor, *self.patients)
+        self.assertEqual(
+            list(Appointment.objects.order_by('date').values_list('date', 'version')),
+            [(self.date + timedelta(minutes=30), 2),
+             (self.date + timedelta(hours=1, minutes=30), 2)])
+
+    def test_refuses_to_overlap_a_patients_other_booking(self):
+        with sharding.atomic():
+            booking.book(self.other_doctor, self.patients[1],
+                         self.date + timedelta(hours=2), 30)
+        moved, message = self.reschedule(timedelta(hours=1))
+        self.assertIsNone(moved)
+        self.assertIn('overlap', message)
+        self.assertEqual(Appointment.objects.filter(
+            doctor=self.doctor, date=self.date).count(), 1)
+
+
+class ApiEtagTests(TestCase):
+
+    def setUp(self):
+        self.doctor = make_user('doctor@example.com', 'Doctor')
+        self.patient = make_user('patient@example.com', 'Patient')
+        with sharding.atomic():
+            self.appointment, _ = booking.book(
+                self.doctor, self.patient,
+                timezone.now() + timedelta(days=1), 30)
+        self.client.force_login(self.patient)
+
+    def revalidates(self, url):
+        etag = self.client.get(url)['ETag']
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304, etag
+
+    def test_renaming_the_doctor_changes_appointment_tags(self):
+        for url in ('/api/v1/appointments/',
+                    '/api/v1/appointments/{0}/'.format(self.appointment.pk)):
+            unchanged, etag = self.revalidates(url)
+            self.assertTrue(unchanged)
+            self.doctor.last_name = 'Renamed'
+            self.doctor.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Renamed', response.content.decode())
+
+    def test_group_changes_bump_the_version(self):
+        unchanged, etag = self.revalidates('/api/v1/users/me/')
+        self.assertTrue(unchanged)
+        version = User.objects.get(pk=self.patient.pk).version
+        nurses = Group.objects.create(name='Nurse')
+        self.patient.groups.add(nurses)
+        self.assertEqual(User.objects.get(pk=self.patient.pk).version, version + 1)
+        response = self.client.get('/api/v1/users/me/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        nurses.user_set.remove(self.patient)
+        response = self.client.get('/api/v1/users/me/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Nurse', response.content.decode())
+
+    def put(self, url, body, etag):
+        return self.client.put(url, json.dumps(body), content_type='application/json',
+                               HTTP_IF_MATCH=etag)
+
+    def test_put_changes_the_appointment_in_place(self):
+        url = '/api/v1/appointments/{0}/'.format(self.appointment.pk)
+        etag = self.client.get(url + '?fields=id')['ETag']
+        date = timezone.localtime(self.appointment.date) + timedelta(hours=1)
+        body = {'date': date.strftime('%Y-%m-%dT%H:%M:%S'), 'duration': 45,
+                'doctor': self.doctor.pk, 'patient': self.patient.pk}
+        response = self.put(url, body, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], self.appointment.pk)
+        self.assertEqual(response.json()['version'], self.appointment.version + 1)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.put(url, dict(body, duration=60), etag).status_code, 412)
+        self.assertEqual(Appointment.objects.get().duration, 45)
+
+    def test_put_profile_with_the_tag_of_a_sparse_read(self):
+        url = '/api/v1/users/me/'
+        etag = self.client.get(url + '?fields=email')['ETag']
+        body = {'first_name': 'Pat', 'last_name': 'Test', 'email': 'patient@example.com',
+                'phone_number': '5555555555', 'month': 1, 'day': 2, 'year': 1990,
+                'company': 'Aetna', 'policy': 'AB-123', 'sex': 'Female'}
+        self.assertEqual(self.put(url, body, etag).status_code, 200)
+        self.assertEqual(User.objects.get(pk=self.patient.pk).first_name, 'Pat')
+        self.assertEqual(self.put(url, dict(body, first_name='Stale'), etag).status_code,
+                         412)
+        self.assertEqual(User.objects.get(pk=self.patient.pk).first_name, 'Pat')
+
+
+class InsurerTests(TestCase):
+
+    def insured(self, username, company, number):
+        insurance = Insurance.objects.create(company=company, policy_number=number)
+        return make_user(username, 'Patient',
+                         medical_information=MedicalInformation.objects.create(
+                             sex='Female', insurance=insurance))
+
+    def test_spellings_share_an_insurer_and_a_policy_but_not_a_row(self):
+        first = self.insured('first@example.com', 'Aetna', 'AB-123')
+        second = self.insured('second@example.com', 'aetna, Inc.', 'ab 123')
+        self.assertEqual(Insurer.objects.count(), 1)
+        self.assertEqual(Policy.objects.count(), 1)
+        self.assertNotEqual(first.medical_information.insurance_id,
+                            second.medical_information.insurance_id)
+        self.assertEqual(first.medical_information.insurance.policy_id,
+                         second.medical_information.insurance.policy_id)
+        self.assertEqual(list(insurers.patients_with_policy('AETNA inc', 'ab123')),
+                         [first, second])
+        self.assertEqual(list(insurers.patients_by_insurer(insurers.find_insurer('aetna'))),
+                         [first, second])
+
+    def test_editing_or_deleting_a_policy_leaves_other_patients_alone(self):
+        first = self.insured('first@example.com', 'Aetna', 'AB-123')
+        second = self.insured('second@example.com', 'Aetna', 'AB-123')
+        insurance = first.medical_information.insurance
+        insurance.policy_number = 'CD-456'
+        insurance.save()
+        self.assertEqual(list(insurers.patients_with_policy('Aetna', 'AB-123')), [second])
+        self.assertEqual(list(insurers.patients_with_policy('Aetna', 'CD-456')), [first])
+        insurance.delete()
+        self.assertEqual(Insurance.objects.get().policy_number, 'AB-123')
+        self.assertTrue(User.objects.filter(pk=second.pk).exists())
+
+    def test_index_key_is_required_once_numbers_are_encrypted(self):
+        with self.settings(PHI_INDEX_KEY=None, PHI_MASTER_KEY=None):
+            self.assertEqual(len(insurers.policy_hash('AB-123')), 64)
+        with self.settings(PHI_INDEX_KEY=None):
+            with self.assertRaises(ImproperlyConfigured):
+                insurers.policy_hash('AB-123')
+
+    def test_policies_are_unique(self):
+        insurer = insurers.get_insurer('Aetna')
+        for insurer in (insurer, None):
+            Policy.objects.create(insurer=insurer, policy_hash='0' * 64)
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Policy.objects.create(insurer=insurer, policy_hash='0' * 64)
+
+    def test_normalize_backfills_and_dedupes_rows_without_a_policy(self):
+        first = self.insured('first@example.com', 'Cigna Corp', 'X-1')
+        second = self.insured('second@example.com', 'CIGNA', 'x 1')
+        third = self.insured('third@example.com', None, 'X-1')
+        Insurance.objects.update(policy=None)
+        Policy.objects.all().delete()
+        Insurer.objects.all().delete()
+        self.assertEqual(insurers.normalize_insurance(batch_size=1), 3)
+        self.assertEqual(Insurer.objects.get().normalized_name, 'cigna')
+        self.assertEqual(Policy.objects.count(), 2)
+        self.assertEqual(list(insurers.patients_with_policy('cigna', 'x1')),
+                         [first, second])
+        self.assertEqual(list(insurers.patients_with_policy('', 'x1')), [third])
+
+    def test_rehash_moves_rows_to_the_new_policies(self):
+        patient = self.insured('first@example.com', 'Aetna', 'AB-123')
+        old = Policy.objects.get()
+        with self.settings(PHI_INDEX_KEY='cmVoYXNoZWQgaW5kZXgga2V5IGZvciB0ZXN0cw=='):
+            self.assertEqual(insurers.normalize_insurance(rehash=True), 1)
+            self.assertEqual(list(insurers.patients_with_policy('Aetna', 'AB-123')),
+                             [patient])
+        self.assertFalse(Policy.objects.filter(pk=old.pk).exists())
+
+
+class EncryptionTests(TestCase):
+
+    def setUp(self):
+        encryption.clear_key_cache()
+        self.addCleanup(encryption.clear_key_cache)
+
+    def stored(self, pk, name='medications'):
+        return MedicalInformation.objects.values_list(name, flat=True).get(pk=pk)
+
+    def test_round_trip(self):
+        information = MedicalInformation.objects.create(
+            sex='Female', medications='Aspirin', allergies=None)
+        self.assertTrue(self.stored(information.pk).startswith('phi1$'))
+        self.assertNotIn('Aspirin', self.stored(information.pk))
+        loaded = MedicalInformation.objects.get(pk=information.pk)
+        self.assertEqual(loaded.medications, 'Aspirin')
+        self.assertIsNone(loaded.allergies)
+
+    def test_rotating_the_master_key(self):
+        information = MedicalInformation.objects.create(sex='Female',
+                                                        medications='Aspirin')
+        old_key = encryption.key_id(self.stored(information.pk))
+        with self.settings(PHI_MASTER_KEY='test-rotated'):
+            self.assertEqual(encryption.reencrypt(MedicalInformation), 1)
+            self.assertEqual(encryption.reencrypt(MedicalInformation), 0)
+        new_key = encryption.key_id(self.stored(information.pk))
+        self.assertNotEqual(old_key, new_key)
+        encryption.clear_key_cache()
+        keys = dict(settings.PHI_MASTER_KEYS)
+        del keys['test']
+        with self.settings(PHI_MASTER_KEYS=keys):
+            self.assertEqual(MedicalInformation.objects.get(
+                pk=information.pk).medications, 'Aspirin')
+
+    def test_scrubbing_the_audit_log(self):
+        admin = make_user('admin@example.com', 'Admin')
+        information = MedicalInformation.objects.create(sex='Female',
+                                                        medications='Aspirin')
+        content_type = ContentType.objects.get_for_model(MedicalInformation)
+        for object_id in (information.pk, information.pk + 1):
+            LogEntry.objects.create(
+                user=admin, content_type=content_type, object_id=str(object_id),
+                object_repr='Medications: Aspirin', action_flag=ADDITION)
+        self.assertEqual(encryption.scrub_audit_log(MedicalInformation, batch_size=1), 2)
+        self.assertEqual(list(LogEntry.objects.order_by('pk')
+                              .values_list('object_repr', flat=True)), [
+            repr(information),
+            'MedicalInformation object ({0})'.format(information.pk + 1)])
+        self.assertEqual(encryption.scrub_audit_log(MedicalInformation), 0)
+
+    def test_plaintext_that_looks_encrypted(self):
+        information = MedicalInformation.objects.create(sex='Female',
+                                                        medications='Aspirin')
+        stored = 'phi1${0}$not encrypted'.format(
+            encryption.key_id(self.stored(information.pk)))
+        # Written as it was before encryption, bypassing the field.
+        MedicalInformation.objects.filter(pk=information.pk).update(
+            medications=encryption.Ciphertext(stored))
+        with self.assertLogs('health.encryption', 'WARNING'):
+            self.assertEqual(MedicalInformation.objects.get(
+                pk=information.pk).medications, stored)
+            self.assertEqual(encryption.reencrypt(MedicalInformation), 1)
+        self.assertNotEqual(self.stored(information.pk), stored)
+        self.assertEqual(MedicalInformation.objects.get(pk=information.pk).medications,
+                         stored)
+
+    def test_revoked_keys_fail_the_system_check(self):
+        def ids(revoked):
+            with mock.patch.object(encryption, 'REVOKED_KEY_FINGERPRINTS', {
+                    encryption.key_fingerprint(key) for key in revoked}):
+                return sorted(message.id for message in
+                              encryption.check_revoked_keys(None))
+
+        keys = settings.PHI_MASTER_KEYS
+        self.assertEqual(ids([]), [])
+        self.assertEqual(ids([keys['test']]), ['health.E001'])
+        self.assertEqual(ids([keys['test-rotated']]), ['health.W001'])
+        self.assertEqual(ids([settings.PHI_INDEX_KEY]), ['health.E002'])
+
+    def test_saving_updates_clinical_codes(self):
+        information = MedicalInformation.objects.create(sex='Female',
+                                                        allergies='Penicillin')
+        information.allergies = 'Peanuts'
+        information.save(update_fields=['sex'])
+        self.assertEqual([str(code) for code in information.codes.all()], ['Penicillin'])
+        information.save()
+        self.assertEqual([str(code) for code in information.codes.all()], ['Peanuts'])
+
+    def test_clinical_codes_are_hashed_and_encrypted(self):
+        information = MedicalInformation.objects.create(sex='Female',
+                                                        allergies='Penicillin')
+        patient = make_user('patient@example.com', 'Patient',
+                            medical_information=information)
+        code_hash, display = ClinicalCode.objects.values_list('code_hash', 'display').get()
+        self.assertNotIn('penicillin', code_hash.lower())
+        self.assertNotIn('Penicillin', display)
+        self.assertEqual(str(ClinicalCode.objects.get()), 'Penicillin')
+        self.assertEqual(list(clinical.patients_with('allergy', 'penicillin allergy')),
+                         [patient])
+        with self.settings(PHI_INDEX_KEY='cmVoYXNoZWQgaW5kZXgga2V5IGZvciB0ZXN0cw=='):
+            self.assertEqual(clinical.rehash_codes(), 1)
+            self.assertEqual(list(clinical.patients_with('allergy', 'Penicillin')),
+                             [patient])
+
+
+class HospitalIndexTests(TestCase):
+
+    def setUp(self):
+        geo.clear_hospital_index()
+        self.addCleanup(geo.clear_hospital_index)
+
+    def hospital(self, name, latitude, longitude):
+        return Hospital(name=name, address='1 Road', city='Town', state='CT',
+                        zipcode='06470', latitude=latitude, longitude=longitude)
+
+    def test_changes_in_another_process_rebuild_the_index(self):
+        self.hospital('North', 41.3, -73.1).save()
+        index = geo.hospital_index()
+        self.assertEqual(len(index), 1)
+        self.assertIs(geo.hospital_index(), index)
+        # Another worker saving a hospital only reaches this one through
+        # the cached version.
+        Hospital.objects.bulk_create([self.hospital('South', 41.0, -73.5)])
+        self.assertIs(geo.hospital_index(), index)
+        cache.delete(geo.INDEX_VERSION_KEY)
+        self.assertEqual([nearby.hospital.name for nearby in
+                          geo.nearest_hospitals(41.0, -73.5, limit=2)],
+                         ['South', 'North'])
+
+
+class AvailabilityTests(TestCase):
+
+    def setUp(self):
+        self.patient = make_user('patient@example.com', 'Patient')
+
+    def doctor(self, username, **shifts):
+        information = DoctorInformation.objects.create(
+            specialisation='Cardiology', two_shift='No', **shifts)
+        return make_user(username, 'Doctor', doctor_information=information)
+
+    def test_overnight_shift_from_the_day_before(self):
+        doctor = self.doctor('doctor@example.com', visit_days='Sunday',
+                             first_shift_start='10PM', first_shift_end='6AM')
+        start = next_monday(2)
+        slots = availability.find_earliest_slots(start, start + timedelta(days=1),
+                                                 30, limit=2)
+        self.assertEqual([(slot.start, slot.doctor) for slot in slots],
+                         [(start, doctor), (start + timedelta(minutes=15), doctor)])
+
+    def test_series_exceptions_are_prefetched(self):
+        doctor = self.doctor('doctor@example.com', visit_days='Monday',
+                             first_shift_start='9AM', first_shift_end='5PM')
+        other = self.doctor('other@example.com', visit_days='Monday',
+                            first_shift_start='9AM', first_shift_end='5PM')
+        monday = next_monday(10)
+        for person in (doctor, other):
+            series = AppointmentSeries.objects.create(
+                patient=self.patient, doctor=person, start=monday,
+                duration=30, frequency='Daily')
+            recurrence.skip_occurrence(series, monday + timedelta(days=1))
+            recurrence.move_occurrence(series, monday, monday + timedelta(hours=2))
+        with self.assertNumQueries(3):
+            busy = availability.booked_periods([doctor.pk, other.pk], monday,
+                                               monday + timedelta(days=1, hours=12))
+        self.assertEqual(busy[doctor.pk], [
+            (monday + timedelta(hours=2), monday + timedelta(hours=2, minutes=30))])
+
+    def test_rejects_a_duration_that_is_not_positive(self):
+        self.client.force_login(self.patient)
+        for duration in ('0', '-30'):
+            response = self.client.get('/availability/', {'duration': duration})
+            self.assertEqual(response.status_code, 400)
+
+
+class RecurrenceTests(TestCase):
+
+    def setUp(self):
+        self.doctor = make_user('doctor@example.com', 'Doctor')
+        self.patient = make_user('patient@example.com', 'Patient')
+        self.monday = next_monday(10)
+
+    def series(self, **fields):
+        return AppointmentSeries.objects.create(
+            patient=self.patient, doctor=self.doctor, start=self.monday,
+            duration=30, **fields)
+
+    def dates(self, series, start, end):
+        return [occurrence.date for occurrence in
+                recurrence.occurrences(series, start, end)]
+
+    def test_weekly_series_stops_after_count(self):
+        series = self.series(frequency='Weekly', weekdays='0,2', count=5)
+        days = [0, 2, 7, 9, 14]
+        self.assertEqual(self.dates(series, self.monday, self.monday + timedelta(weeks=8)),
+                         [self.monday + timedelta(days=day) for day in days])
+
+    def test_window_far_into_a_series(self):
+        series = self.series(frequency='Daily', interval=2)
+        start = self.monday + timedelta(days=1000)
+        self.assertEqual(self.dates(series, start, start + timedelta(days=4)),
+                         [start, start + timedelta(days=2), start + timedelta(days=4)])
+
+    def test_skipped_and_moved_occurrences(self):
+        series = self.series(frequency='Daily', until=self.monday + timedelta(days=3))
+        recurrence.skip_occurrence(series, self.monday + timedelta(days=1))
+        recurrence.move_occurrence(series, self.monday,
+                                   self.monday + timedelta(days=2, hours=2), 45)
+        occurrences = list(recurrence.occurrences(
+            series, self.monday, self.monday + timedelta(days=10)))
+        self.assertEqual([(o.date, o.duration) for o in occurrences], [
+            (self.monday + timedelta(days=2), 30),
+            (self.monday + timedelta(days=2, hours=2), 45),
+            (self.monday + timedelta(days=3), 30),
+        ])
+        self.assertFalse(self.patient.is_free(self.monday + timedelta(days=2, hours=2), 15))
+        self.assertTrue(self.patient.is_free(self.monday, 30))
+
+    def test_series_form_rejects_a_bad_duration(self):
+        for duration in (None, 'half an hour', '0'):
+            body = QueryDict(mutable=True)
+            body.update({'date': timezone.localtime(self.monday).strftime('%Y-%m-%dT%H:%M'),
+                         'frequency': 'Daily', 'doctor': self.doctor.pk})
+            if duration is not None:
+                body['duration'] = duration
+            series, message = views.handle_series_form(None, body, self.patient)
+            self.assertIsNone(series)
+            self.assertTrue(message)
+        self.assertFalse(AppointmentSeries.objects.exists())
+
+    def test_skip_only_dates_the_series_occurs_on(self):
+        series = self.series(frequency='Weekly', weekdays='0')
+        self.client.force_login(self.patient)
+        url = '/series/{0}/skip/'.format(series.pk)
+        self.client.post(url, {'date': (self.monday + timedelta(days=1)).isoformat()})
+        self.assertFalse(series.exceptions.exists())
+        self.client.post(url, {'date': (self.monday + timedelta(weeks=1)).isoformat()})
+        self.assertEqual(list(series.exceptions.values_list('original_date', 'new_date')),
+                         [(self.monday + timedelta(weeks=1), None)])
+
+    def test_move_an_occurrence_to_a_free_time(self):
+        series = self.series(frequency='Daily')
+        Appointment.objects.create(patient=make_user('other@example.com', 'Patient'),
+                                   doctor=self.doctor, duration=30,
+                                   date=self.monday + timedelta(hours=2))
+        self.client.force_login(self.patient)
+        url = '/series/{0}/move/'.format(series.pk)
+        data = {'date': self.monday.isoformat(),
+                'new_date': (self.monday + timedelta(hours=2)).isoformat()}
+        self.assertContains(self.client.post(url, data), booking.DOCTOR_BUSY)
+        self.assertFalse(series.exceptions.exists())
+        # Overlapping the occurrence's own time does not clash with itself.
+        data['new_date'] = (self.monday + timedelta(minutes=15)).isoformat()
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual([o.date for o in series.occurrences(
+            self.monday, self.monday + timedelta(hours=12))],
+            [self.monday + timedelta(minutes=15)])
+
+
+class TimelineTests(TestCase):
+
+    def test_pages_cover_every_item_once_in_order(self):
+        doctor = make_user('doctor@example.com', 'Doctor')
+        patient = make_user('patient@example.com', 'Patient')
+        start = timezone.now() - timedelta(days=30)
+        for day in range(7):
+            Appointment.objects.create(patient=patient, doctor=doctor, duration=30,
+                                       date=start + timedelta(days=day))
+        # An archived appointment at the same time as a live one.
+        for day in (3, 3, 10):
+            ArchivedAppointment.objects.create(
+                original_id=1000 + ArchivedAppointment.objects.count(),
+                patient=patient, doctor=doctor, duration=30,
+                date=start + timedelta(days=day),
+                month=(start + timedelta(days=day)).date().replace(day=1))
+        everything, cursor = timeline.timeline(patient, page_size=100)
+        self.assertIsNone(cursor)
+        self.assertEqual(len(everything), 10)
+        pages = []
+        position = None
+        while True:
+            items, cursor = timeline.timeline(patient, position, page_size=3)
+            pages.append(items)
+            if cursor is None:
+                break
+            position = timeline.decode_cursor(cursor)
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 1])
+        self.assertEqual([item for page in pages for item in page], everything)
+        self.assertEqual(everything, sorted(everything, key=timeline._key, reverse=True))
+
+    def test_malformed_cursors_are_rejected(self):
+        for cursor in ('', 'not base64!', timeline.encode_cursor(
+                (timezone.now(), 'appointment', 1))[:-4]):
+            self.assertIsNone(timeline.decode_cursor(cursor))
+
+
+class ShiftRevalidationTests(TestCase):
+
+    def test_changing_shifts_flags_and_unflags_appointments(self):
+        information = DoctorInformation.objects.create(
+            specialisation='Cardiology', visit_days='Monday,Tuesday',
+            two_shift='No', first_shift_start='9AM', first_shift_end='5PM')
+        doctor = make_user('doctor@example.com', 'Doctor',
+                           doctor_information=information)
+        patient = make_user('patient@example.com', 'Patient')
+        morning = Appointment.objects.create(patient=patient, doctor=doctor,
+                                             date=next_monday(10), duration=30)
+        evening = Appointment.objects.create(patient=patient, doctor=doctor,
+                                             date=next_monday(16), duration=30)
+
+        def flagged():
+            return set(Appointment.objects.filter(outside_shift_since__isnull=False)
+                       .values_list('pk', flat=True))
+
+        information.first_shift_end = '3PM'
+        information.save()
+        self.assertEqual(flagged(), {evening.pk})
+        information.visit_days = 'Tuesday'
+        information.save()
+        self.assertEqual(flagged(), {morning.pk, evening.pk})
+        information.visit_days = 'Monday,Tuesday'
+        information.first_shift_end = '5PM'
+        information.save()
+        self.assertEqual(flagged(), set())
+
+
+class WaitlistBackfillTests(TestCase):
+
+    def setUp(self):
+        self.hospital = Hospital.objects.create(
+            name='North', address='1 Road', city='Town', state='CT',
+            zipcode='06470')
+        self.doctor = make_user(
+            'doctor@example.com', 'Doctor', hospital=self.hospital,
+            doctor_information=DoctorInformation.objects.create(
+                specialisation='Cardiology'))
+        self.patient = make_user('patient@example.com', 'Patient')
+        self.date = next_monday(10)
+        with sharding.atomic():
+            self.appointment, _ = booking.book(self.doctor, self.patient,
+                                               self.date, 60)
+
+    def wait(self, username, duration, window_end, **fields):
+        entry = WaitlistEntry.objects.create(
+            patient=make_user(username, 'Patient'), duration=duration,
+            window_start=self.date - timedelta(days=1), window_end=window_end,
+            **fields)
+        # Entries are offered oldest first; keep their ages distinct.
+        WaitlistEntry.objects.filter(pk=entry.pk).update(
+            created_at=timezone.now() - timedelta(minutes=100 - entry.pk))
+        return entry
+
+    def cancel(self):
+        client = self.client
+        client.force_login(self.patient)
+        response = client.post('/delete_appointment/{0}/'.format(self.appointment.pk))
+        self.assertEqual(response.status_code, 302)
+
+    def test_cancelled_slot_goes_to_the_oldest_entry_that_fits(self):
+        too_long = self.wait('long@example.com', 90, self.date + timedelta(days=1),
+                             doctor=self.doctor)
+        ends_early = self.wait('early@example.com', 30, self.date + timedelta(minutes=15),
+                               doctor=self.doctor)
+        by_specialisation = self.wait('any@example.com', 30, self.date + timedelta(days=1),
+                                      specialisation='Cardiology', hospital=self.hospital)
+        later = self.wait('later@example.com', 30, self.date + timedelta(days=1),
+                          doctor=self.doctor)
+        self.cancel()
+        booked = Appointment.objects.get()
+        self.assertEqual((booked.patient, booked.doctor, booked.date, booked.duration),
+                         (by_specialisation.patient, self.doctor, self.date, 30))
+        fulfilled = WaitlistEntry.objects.filter(fulfilled_at__isnull=False)
+        self.assertEqual([entry.pk for entry in fulfilled], [by_specialisation.pk])
+        self.assertEqual(fulfilled[0].appointment, booked)
+        self.assertFalse(WaitlistEntry.objects.filter(
+            pk__in=[too_long.pk, ends_early.pk, later.pk],
+            fulfilled_at__isnull=False).exists())
+
+    def test_entries_ending_too_early_are_not_offered(self):
+        self.wait('early@example.com', 30, self.date + timedelta(minutes=15),
+                  doctor=self.doctor)
+        fits = self.wait('fits@example.com', 30, self.date + timedelta(minutes=30),
+                         doctor=self.doctor)
+        # The entry that cannot take the slot does not use up the only offer.
+        with mock.patch('health.waitlist.MAX_OFFERS', 1):
+            self.cancel()
+        self.assertEqual(Appointment.objects.get().patient, fits.patient)
+
+    def test_nobody_waiting(self):
+        self.wait('other@example.com', 30, self.date + timedelta(days=1),
+                  specialisation='Dermatology')
+        self.cancel()
+        self.assertFalse(Appointment.objects.exists())
+
+
+class EventStreamTests(SimpleTestCase):
+
+    def test_event_row_matches_the_schedule_table(self):
+        appointment = Appointment(
+            pk=5, date=timezone.now(), duration=30,
+            patient=User(pk=1, first_name='Pat', last_name='Ient'),
+            doctor=User(pk=2, first_name='Doc', last_name='Tor'))
+        row = events._payload('added', appointment, appointment.pk)['row']
+        table = render_to_string('health/appointment_table.html',
+                                 {'schedule': [appointment], 'editable': True})
+        self.assertIn('data-appointment="5"', row)
+        self.assertIn(' '.join(row.split()), ' '.join(table.split()))
+
+    def test_poll_sends_published_events_and_ends(self):
+        broker = events.LocalBroker()
+        cursor = broker.cursor()
+        broker.publish({'doctor:1'}, 'appointment', {'id': 1})
+        broker.publish({'doctor:2'}, 'appointment', {'id': 2})
+        body = ''.join(events.poll({'doctor:1'}, cursor, broker))
+        self.assertIn('"id": 1', body)
+        self.assertNotIn('"id": 2', body)
+        self.assertTrue(body.endswith('id: {0}\n\n'.format(broker.cursor())))
+
+    def test_poll_resets_unknown_cursors(self):
+        body = ''.join(events.poll(None, 'elsewhere:1', events.LocalBroker()))
+        self.assertIn('event: reset', body)
+
+    def test_stream_waits_on_the_event_loop(self):
+        broker = events.LocalBroker()
+
+        async def read():
+            chunks = events.stream({'doctor:1'}, broker.cursor(), broker,
+                                   seconds=5, heartbeat=5)
+            await chunks.__anext__()
+            loop = asyncio.get_event_loop()
+            # Published from another thread, as a request would.
+            loop.call_later(0.05, lambda: loop.run_in_executor(
+                None, broker.publish, {'doctor:1'}, 'appointment', {'id': 3}))
+            chunk = await asyncio.wait_for(chunks.__anext__(), 2)
+            await chunks.aclose()
+            return chunk
+
+        loop = asyncio.new_event_loop()
+        try:
+            chunk = loop.run_until_complete(read())
+        finally:
+            loop.close()
+        self.assertIn(b'"id": 3', chunk)
+        self.assertFalse(broker.waiters)
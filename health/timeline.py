@@ -0,0 +1,126 @@
+"""
+A patient's history as one timeline, newest first: their appointments,
+live and archived, and the audit log's record of changes to their
+account and medical information.
+
+Each source is read as a keyset-paginated stream ordered by (time, id)
+on an index, and the streams are merged lazily with heapq.merge. A page
+of n items reads at most n + 1 rows from each stream, one query per
+stream, however long the history is. Pages are continued with a cursor
+holding the (time, source, id) of the last item shown, which every stream
+resumes from.
+"""
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import dateparse
+from collections import namedtuple
+import base64
+import binascii
+import heapq
+import json
+from .models import Appointment, ArchivedAppointment, MedicalInformation, User
+
+DEFAULT_PAGE_SIZE = 25
+
+# Sources in the order items with the same time are listed.
+APPOINTMENT = 'appointment'
+ARCHIVED = 'archived'
+CHANGE = 'change'
+SOURCES = (APPOINTMENT, ARCHIVED, CHANGE)
+
+Item = namedtuple('Item', ['time', 'source', 'pk', 'object'])
+
+
+def _key(item):
+    return item.time, -SOURCES.index(item.source), item.pk
+
+
+def _before(queryset, field, position, source):
+    """
+    Narrows a queryset ordered by (field, pk) descending to the rows after
+    a cursor position in timeline order.
+    """
+    if position is None:
+        return queryset
+    time, cursor_source, pk = position
+    earlier = Q(**{field + '__lt': time})
+    rank, cursor_rank = SOURCES.index(source), SOURCES.index(cursor_source)
+    if rank > cursor_rank:
+        # Later sources come after the cursor's at the same time.
+        return queryset.filter(earlier | Q(**{field: time}))
+    if rank == cursor_rank:
+        return queryset.filter(earlier | Q(**{field: time, 'pk__lt': pk}))
+    return queryset.filter(earlier)
+
+
+def stream(queryset, field, source, position, chunk_size):
+    """
+    Yields a source's items after `position`, newest first, reading
+    chunk_size rows per query and only as many chunks as are consumed.
+    """
+    queryset = queryset.order_by('-' + field, '-pk')
+    while True:
+        chunk = list(_before(queryset, field, position, source)[:chunk_size])
+        for obj in chunk:
+            yield Item(getattr(obj, field), source, obj.pk, obj)
+        if len(chunk) < chunk_size:
+            return
+        position = (getattr(chunk[-1], field), source, chunk[-1].pk)
+
+
+def change_entries(patient):
+    """
+    :return: The audit log entries about the patient's account and
+             medical information.
+    """
+    about = Q(content_type=ContentType.objects.get_for_model(User),
+              object_id=str(patient.pk))
+    if patient.medical_information_id:
+        about |= Q(content_type=ContentType.objects.get_for_model(MedicalInformation),
+                   object_id=str(patient.medical_information_id))
+    return LogEntry.objects.filter(about).select_related('user')
+
+
+def timeline(patient, position=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    :param position: The (time, source, id) of the last item already shown.
+    :return: A list of up to page_size Items, newest first, and the cursor
+             for the next page, or None if this is the last.
+    """
+    chunk_size = page_size + 1
+    streams = [
+        stream(Appointment.objects.filter(patient=patient)
+               .select_related('doctor'), 'date', APPOINTMENT, position, chunk_size),
+        stream(ArchivedAppointment.objects.filter(patient=patient)
+               .select_related('doctor'), 'date', ARCHIVED, position, chunk_size),
+        stream(change_entries(patient), 'action_time', CHANGE, position, chunk_size),
+    ]
+    items = []
+    for item in heapq.merge(*streams, key=_key, reverse=True):
+        if len(items) == page_size:
+            last = items[-1]
+            return items, encode_cursor((last.time, last.source, last.pk))
+        items.append(item)
+    return items, None
+
+
+def encode_cursor(position):
+    time, source, pk = position
+    raw = json.dumps([time.isoformat(), source, pk])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :return: The (time, source, id) a cursor holds, or None if it is
+             malformed.
+    """
+    try:
+        time, source, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        time = dateparse.parse_datetime(time)
+    except (binascii.Error, TypeError, ValueError, UnicodeError):
+        return None
+    if time is None or source not in SOURCES or not isinstance(pk, int):
+        return None
+    return time, source, pk
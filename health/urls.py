@@ -1,7 +1,7 @@
 
 from django.contrib import admin
 from django.urls import path,include
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.home, name='home'),
@@ -9,10 +9,25 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('signup/', views.signup, name='signup'),
     path('schedule/', views.schedule, name='schedule'),
+    path('schedule/events/', views.schedule_events, name='schedule_events'),
     path('add_appointment/', views.add_appointment_form, name='add_appointment'),
-    path('edit_appointment/<int:id>/', views.appointment_form, name='edit_appointment'),
-    path('delete_appointment/<int:id>/', views.delete_appointment, name='delete_appointment'),
+    path('edit_appointment/<int:appointment_id>/', views.appointment_form, name='edit_appointment'),
+    path('delete_appointment/<int:appointment_id>/', views.delete_appointment, name='delete_appointment'),
+    path('bulk_appointments/', views.bulk_appointments, name='bulk_appointments'),
+    path('series/<int:series_id>/skip/', views.skip_occurrence, name='skip_occurrence'),
+    path('series/<int:series_id>/move/', views.move_occurrence, name='move_occurrence'),
+    path('waitlist/', views.join_waitlist, name='join_waitlist'),
+    path('waitlist/<int:entry_id>/leave/', views.leave_waitlist, name='leave_waitlist'),
     path('users/<int:user_id>', views.medical_information, name='medical_information'),
+    path('users/<int:user_id>/timeline/', views.patient_timeline, name='patient_timeline'),
     path('user/me/', views.my_medical_information, name='my_medical_information'),
     path('users/',views.users,name='users'),
+    path('availability/', views.available_slots, name='available_slots'),
+    path('hospitals/nearest/', views.nearest_hospitals, name='nearest_hospitals'),
+    path('utilization/', views.utilization_dashboard, name='utilization'),
+    path('insurance/', views.insurance_lookup, name='insurance_lookup'),
+    path('api/v1/appointments/', api.appointments, name='api_appointments'),
+    path('api/v1/appointments/<int:appointment_id>/', api.appointment, name='api_appointment'),
+    path('api/v1/users/me/', api.user_profile, name='api_me'),
+    path('api/v1/users/<int:user_id>/', api.user_profile, name='api_user'),
 ]
@@ -0,0 +1,160 @@
+"""
+A small, versioned snapshot of the logged-in user kept in the session.
+
+With USER_SNAPSHOT_ENABLED, UserSnapshotMiddleware builds request.user from
+the snapshot instead of loading the User row and its groups on every
+request. The snapshot holds the user's scalar fields, profile ids and role
+names. Any other field is deferred and loaded on first access.
+
+Each user has a version token in the cache, keyed by the user's database
+as well as their id, since ids repeat across hospital databases. The
+signal receivers below drop the token whenever the user, its groups or its
+profiles change, or one of its groups is renamed or deleted, which
+invalidates every snapshot taken before the change. The cache must be
+shared between workers (memcached, redis, database) for invalidation to
+reach all of them; the default local-memory cache is only suitable for a
+single process.
+"""
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db.models.base import DEFERRED
+import uuid
+from . import sharding
+from .models import DoctorInformation, Hospital, MedicalInformation, User
+
+SNAPSHOT_SESSION_KEY = '_user_snapshot'
+# Bump when the snapshot layout changes, to discard old session data.
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_FIELDS = (
+    'id', 'username', 'email', 'first_name', 'last_name', 'is_superuser',
+    'is_staff', 'is_active', 'hospital_id', 'medical_information_id',
+    'doctor_information_id', 'emergency_contact_id',
+)
+
+
+def _version_key(user_id, database=None):
+    return 'user-snapshot-version:{0}:{1}'.format(
+        database or sharding.current_database(), user_id)
+
+
+def current_version(user_id, database=None):
+    """
+    :param database: The user's database; by default the current one.
+    :return: The user's current version token, creating one if the cache
+             has none.
+    """
+    key = _version_key(user_id, database)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def invalidate(*user_ids, database=None):
+    """
+    Discards the version tokens of the given users, so their snapshots are
+    rebuilt on their next request.
+    :param database: The users' database; by default the current one.
+    """
+    cache.delete_many([_version_key(user_id, database) for user_id in user_ids])
+
+
+def take(user, session):
+    """
+    Stores a snapshot of an authenticated user in the session.
+    """
+    session[SNAPSHOT_SESSION_KEY] = {
+        'format': SNAPSHOT_FORMAT,
+        'version': current_version(user.pk, user._state.db),
+        'auth_hash': session.get(HASH_SESSION_KEY),
+        'fields': {name: getattr(user, name) for name in SNAPSHOT_FIELDS},
+        'roles': sorted(user.role_names()),
+    }
+
+
+def restore(session):
+    """
+    :return: A User built from the session's snapshot without touching the
+             database, or None if there is no valid snapshot.
+    """
+    snapshot = session.get(SNAPSHOT_SESSION_KEY)
+    if not snapshot or snapshot.get('format') != SNAPSHOT_FORMAT:
+        return None
+    fields = snapshot['fields']
+    if str(fields['id']) != str(session.get(SESSION_KEY)):
+        return None
+    if snapshot['auth_hash'] != session.get(HASH_SESSION_KEY):
+        return None
+    if snapshot['version'] != current_version(fields['id']):
+        return None
+    names = [field.attname for field in User._meta.concrete_fields]
+    # The session's database is current (see health.sharding).
+    user = User.from_db(sharding.current_database(), names,
+                        [fields.get(name, DEFERRED) for name in names])
+    user._role_names = set(snapshot['roles'])
+    return user
+
+
+def user_changed(sender, instance, using, **kwargs):
+    invalidate(instance.pk, database=using)
+
+
+def groups_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate(instance.pk, database=using)
+    elif pk_set:
+        invalidate(*pk_set, database=using)
+    else:
+        # A group was cleared; its former members are unknown here.
+        invalidate(*User.objects.using(using).values_list('pk', flat=True),
+                   database=using)
+
+
+def group_changed(sender, instance, using, **kwargs):
+    invalidate(*instance.user_set.using(using).values_list('pk', flat=True),
+               database=using)
+
+
+def group_deleting(sender, instance, using, **kwargs):
+    # Deleting a group removes its memberships without m2m_changed, and
+    # they are gone by post_delete.
+    instance._snapshot_members = list(
+        instance.user_set.using(using).values_list('pk', flat=True))
+
+
+def group_deleted(sender, instance, using, **kwargs):
+    invalidate(*getattr(instance, '_snapshot_members', ()), database=using)
+
+
+def profile_changed(sender, instance, using, **kwargs):
+    lookup = {
+        DoctorInformation: 'doctor_information',
+        MedicalInformation: 'medical_information',
+        Hospital: 'hospital',
+    }[sender]
+    invalidate(*User.objects.using(using).filter(**{lookup: instance.pk})
+                                         .values_list('pk', flat=True),
+               database=using)
+
+
+def connect_signals():
+    """
+    Connects the receivers that invalidate snapshots. Called from
+    HealthConfig.ready().
+    """
+    from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                          pre_delete)
+    post_save.connect(user_changed, sender=User)
+    post_delete.connect(user_changed, sender=User)
+    # Sent for changes from either side, user.groups or group.user_set.
+    m2m_changed.connect(groups_changed, sender=User.groups.through)
+    post_save.connect(group_changed, sender=Group)
+    pre_delete.connect(group_deleting, sender=Group)
+    post_delete.connect(group_deleted, sender=Group)
+    for model in (DoctorInformation, MedicalInformation, Hospital):
+        post_save.connect(profile_changed, sender=model)
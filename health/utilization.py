@@ -0,0 +1,251 @@
+"""
+Maintenance and reporting for the DoctorDailyUtilization summary table.
+
+Appointment signals report every saved, moved or deleted appointment here,
+including admin edits and cascades from deleted users, and the affected
+(doctor, day) rows are adjusted with F() increments. Set-based updates send
+no signals and report themselves with record_many(). Dashboards then read
+one row per doctor per day instead of aggregating raw appointments.
+Archiving pauses reporting, so the summary keeps covering history that has
+left the live table. Recurring series occurrences are not stored and are
+not counted.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from django.db import IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from datetime import timedelta
+from . import sharding
+from .availability import shift_intervals
+from .models import Appointment, ArchivedAppointment, DoctorDailyUtilization
+
+# Fields whose changes move an appointment within the summary.
+TRACKED_FIELDS = frozenset(['doctor', 'doctor_id', 'date', 'duration'])
+
+_state = threading.local()
+
+
+def _apply(doctor_id, day, minutes, count):
+    """
+    Adds minutes and count to one summary row, creating it if needed.
+    """
+    rows = DoctorDailyUtilization.objects.filter(doctor_id=doctor_id, day=day)
+    if rows.update(booked_minutes=F('booked_minutes') + minutes,
+                   appointment_count=F('appointment_count') + count):
+        return
+    if count <= 0:
+        # Nothing to remove from; the row went with a deleted doctor.
+        return
+    try:
+        with sharding.atomic():
+            DoctorDailyUtilization.objects.create(
+                doctor_id=doctor_id, day=day, booked_minutes=minutes,
+                appointment_count=count)
+    except IntegrityError:
+        # Another request created the row first.
+        rows.update(booked_minutes=F('booked_minutes') + minutes,
+                    appointment_count=F('appointment_count') + count)
+
+
+def _collect(changes, appointments, sign):
+    for appointment in appointments:
+        key = (appointment.doctor_id,
+               timezone.localtime(appointment.date).date())
+        changes[key][0] += sign * appointment.duration
+        changes[key][1] += sign
+
+
+def _flush(changes):
+    with sharding.atomic():
+        for (doctor_id, day), (minutes, count) in changes.items():
+            if minutes or count:
+                _apply(doctor_id, day, minutes, count)
+
+
+def record_many(appointments, sign=1):
+    """
+    Adds (sign=1) or removes (sign=-1) appointments from the summary,
+    issuing one update per affected doctor and day.
+    """
+    if getattr(_state, 'paused', False):
+        return
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        _collect(pending, appointments, sign)
+        return
+    changes = defaultdict(lambda: [0, 0])
+    _collect(changes, appointments, sign)
+    _flush(changes)
+
+
+def record(appointment, sign=1):
+    """
+    Adds (sign=1) or removes (sign=-1) a single appointment from the summary.
+    """
+    record_many([appointment], sign)
+
+
+@contextmanager
+def batched():
+    """
+    Collects the changes reported inside the block and applies them at its
+    end, with one update per affected doctor and day. Used around set-based
+    deletes, which report every appointment through post_delete.
+    """
+    if getattr(_state, 'pending', None) is not None:
+        yield
+        return
+    _state.pending = defaultdict(lambda: [0, 0])
+    try:
+        yield
+        changes = _state.pending
+    finally:
+        _state.pending = None
+    _flush(changes)
+
+
+@contextmanager
+def paused():
+    """
+    Ignores the changes reported inside the block. Used by the archive,
+    whose moves leave the summary unchanged.
+    """
+    previous = getattr(_state, 'paused', False)
+    _state.paused = True
+    try:
+        yield
+    finally:
+        _state.paused = previous
+
+
+def remember_appointment(sender, instance, raw=False, update_fields=None,
+                         **kwargs):
+    """
+    pre_save handler keeping the stored doctor, date and duration of an
+    appointment, so post_save can move it within the summary.
+    """
+    instance._utilization_before = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and not TRACKED_FIELDS & set(update_fields):
+        return
+    instance._utilization_before = (
+        Appointment.objects.using(kwargs.get('using'))
+                           .filter(pk=instance.pk)
+                           .only('doctor_id', 'date', 'duration')
+                           .first())
+
+
+def appointment_saved(sender, instance, created=False, raw=False, **kwargs):
+    """
+    post_save handler adding a new appointment to the summary, or moving a
+    changed one from its old doctor and day to the new ones.
+    """
+    if raw:
+        return
+    before = getattr(instance, '_utilization_before', None)
+    instance._utilization_before = None
+    if created:
+        record(instance)
+    elif before is not None and (
+            (before.doctor_id, before.date, before.duration) !=
+            (instance.doctor_id, instance.date, instance.duration)):
+        record(before, -1)
+        record(instance)
+
+
+def appointment_deleted(sender, instance, **kwargs):
+    """
+    post_delete handler removing a deleted appointment from the summary.
+    """
+    record(instance, -1)
+
+
+def rebuild(start=None, end=None):
+    """
+    Recomputes the summary from the live and archived appointments, for
+    the days in [start, end] or for all days.
+    :return: The number of summary rows written.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for model in (Appointment, ArchivedAppointment):
+        rows = model.objects.annotate(day=TruncDate('date'))
+        if start:
+            rows = rows.filter(day__gte=start)
+        if end:
+            rows = rows.filter(day__lte=end)
+        for row in (rows.values('doctor_id', 'day')
+                        .annotate(minutes=Sum('duration'), count=Count('id'))
+                        .order_by()):
+            totals[(row['doctor_id'], row['day'])][0] += row['minutes']
+            totals[(row['doctor_id'], row['day'])][1] += row['count']
+    with sharding.atomic():
+        existing = DoctorDailyUtilization.objects.all()
+        if start:
+            existing = existing.filter(day__gte=start)
+        if end:
+            existing = existing.filter(day__lte=end)
+        existing.delete()
+        DoctorDailyUtilization.objects.bulk_create([
+            DoctorDailyUtilization(doctor_id=doctor_id, day=day,
+                                   booked_minutes=minutes,
+                                   appointment_count=count)
+            for (doctor_id, day), (minutes, count) in totals.items()
+        ], batch_size=1000)
+    return len(totals)
+
+
+def shift_minutes(doctor_information, day):
+    """
+    :return: The minutes the doctor is scheduled to work on the day.
+    """
+    if doctor_information is None:
+        return 0
+    return sum((end - start) // timedelta(minutes=1)
+               for start, end in shift_intervals(doctor_information, day))
+
+
+def report(doctors, start, end):
+    """
+    Builds a utilization report from the summary table alone.
+    :param doctors: The doctors to report on, with doctor_information loaded.
+    :param start: The first day of the report.
+    :param end: The last day of the report.
+    :return: A list with one dict per doctor holding its per-day rows and
+             its totals over the range.
+    """
+    doctors = list(doctors)
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    booked = {(row.doctor_id, row.day): row
+              for row in DoctorDailyUtilization.objects.filter(
+                  doctor__in=doctors, day__range=[start, end])}
+    result = []
+    for doctor in doctors:
+        # Shifts only depend on the weekday, so each is computed once.
+        by_weekday = {}
+        rows = []
+        for day in days:
+            if day.weekday() not in by_weekday:
+                by_weekday[day.weekday()] = shift_minutes(
+                    doctor.doctor_information, day)
+            summary = booked.get((doctor.pk, day))
+            rows.append({
+                'day': day,
+                'shift_minutes': by_weekday[day.weekday()],
+                'booked_minutes': summary.booked_minutes if summary else 0,
+                'appointments': summary.appointment_count if summary else 0,
+            })
+        shift_total = sum(row['shift_minutes'] for row in rows)
+        booked_total = sum(row['booked_minutes'] for row in rows)
+        result.append({
+            'doctor': doctor,
+            'days': rows,
+            'shift_minutes': shift_total,
+            'booked_minutes': booked_total,
+            'utilization': (100.0 * booked_total / shift_total
+                            if shift_total else None),
+        })
+    return result
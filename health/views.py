@@ -1,21 +1,45 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import dateparse
 from django.core.exceptions import PermissionDenied
-from django.contrib.admin.models import LogEntry
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import HttpResponse
-from django.db.models import Max
+from django.http import HttpResponse, JsonResponse
+from django.db.models import F
+from django.contrib.auth.models import Group
+from django.utils import timezone
 from . import form_utilities
-from .form_utilities import *
+from .form_utilities import addition, change, deletion
+from . import availability
+from . import booking
+from . import bulk
 from . import checks
-from .models import *
+from . import concurrency
+from . import encryption
+from . import events
+from . import geo
+from . import insurers
+from . import ratelimit
+from . import recurrence
+from . import sharding
+from . import timeline
+from . import utilization
+from . import waitlist
+from .models import (Appointment, AppointmentSeries, DoctorInformation,
+                     Hospital, Insurance, Insurer, MAX_APPOINTMENT_MINUTES,
+                     MedicalInformation, User, WaitlistEntry, role_group)
 import datetime
-import json
-import time
 
+# How far ahead a new recurring series is checked for conflicts.
+SERIES_CONFLICT_DAYS = 90
 
+# How many past appointments the schedule page lists.
+PAST_APPOINTMENTS = 50
 
+# The groups listed in the user directory, and their sections.
+DIRECTORY_GROUPS = {'Doctor': 'doctors', 'Nurse': 'nurses', 'Patient': 'patients'}
+
+
+@ratelimit.limit('login', account_field='email')
 def login_view(request):
     """
     Presents a simple form for logging in a user.
@@ -85,12 +109,20 @@ def signup(request):
     :param request:
     :return:
     """
-    context = full_signup_context(None)
+    context = full_signup_context(None, zipcode=request.GET.get('zipcode'))
     context['is_signup'] = True
     if request.POST:
-        user, message = handle_user_form(request, request.POST)
+        hospital_key = request.POST.get('hospital')
+        if hospital_key and not (hospital_key.isdigit() and
+                                 Hospital.objects.filter(pk=hospital_key).exists()):
+            user, message = None, "Invalid hospital."
+        else:
+            # New users are created in their hospital's database.
+            with sharding.use_database(sharding.hospital_database(hospital_key)):
+                user, message = handle_user_form(request, request.POST)
+                if user:
+                    addition(request, user)
         if user:
-            addition(request, user)
             if request.user.is_authenticated:
                 return redirect('signup')
             else:
@@ -101,10 +133,11 @@ def signup(request):
     return render(request, 'health/signup.html', context)
 
 
-def full_signup_context(user):
+def full_signup_context(user, zipcode=None):
     """
     Returns a dictionary containing valid years, months, days, hospitals,
-    and groups in the database.
+    and groups in the database. Hospitals are listed as (hospital, distance)
+    pairs, nearest to `zipcode` first when it is given.
     """
     return {
         "year_range": reversed(range(1900, datetime.date.today().year + 1)),
@@ -115,7 +148,8 @@ def full_signup_context(user):
             "Sep", "Oct", "Nov", "Dec"
         ],
         "years" : range(1,100),
-        "hospitals": Hospital.objects.all(),
+        "hospitals": geo.hospital_choices(zipcode),
+        "zipcode": zipcode or "",
         "groups": Group.objects.all(),
         "sexes": MedicalInformation.SEX_CHOICES,
         "specialisation" : DoctorInformation.SPECIALISATION,
@@ -161,13 +195,18 @@ def medical_information(request, user_id):
     /users/<user_id>/
     :return:
     """
-    requested_user = get_object_or_404(User, pk=user_id)
+    requested_user = get_object_or_404(
+        User.objects.select_related('medical_information__insurance'), pk=user_id)
     is_editing_own_medical_information = requested_user == request.user
     if not is_editing_own_medical_information and not\
             request.user.can_edit_user(requested_user):
         raise PermissionDenied
+    # The health information on the page is decrypted in one batch.
+    medical = requested_user.medical_information
+    encryption.decrypt_all([medical, medical and medical.insurance])
 
-    context = full_signup_context(requested_user)
+    context = full_signup_context(requested_user,
+                                  zipcode=request.GET.get('zipcode'))
 
     if request.POST:
         user, message = handle_user_form(request, request.POST, user=requested_user)
@@ -185,6 +224,33 @@ def medical_information(request, user_id):
     return render(request, 'health/medical_information.html', context)
 
 
+@login_required(login_url = "login")
+def patient_timeline(request, user_id):
+    """
+    Renders a page of a patient's history, newest first: appointments and
+    changes to their account and medical information. Visible to those who
+    may edit the patient. Older pages are reached with the `before` cursor.
+    """
+    patient = get_object_or_404(User, pk=user_id)
+    if patient != request.user and not request.user.can_edit_user(patient):
+        raise PermissionDenied
+    position = None
+    if request.GET.get('before'):
+        position = timeline.decode_cursor(request.GET['before'])
+        if position is None:
+            return HttpResponse("Invalid cursor.", status=400)
+    items, next_cursor = timeline.timeline(patient, position)
+    context = {
+        "navbar": "medical_information",
+        "user": request.user,
+        "requested_user": patient,
+        "items": items,
+        "next_cursor": next_cursor,
+        "is_first_page": position is None,
+    }
+    return render(request, 'health/timeline.html', context)
+
+
 def handle_user_form(request, body, user=None):
     """
     Creates a user and validates all of the fields, in turn.
@@ -202,7 +268,7 @@ def handle_user_form(request, body, user=None):
 
     email = body.get("email")
     group = body.get("group")
-    patient_group = Group.objects.get(name='Patient')
+    patient_group = role_group('Patient')
     group = Group.objects.get(pk=int(group)) if group else patient_group
     is_patient = group == patient_group
     is_doctor = not is_patient
@@ -281,7 +347,7 @@ def handle_user_form(request, body, user=None):
                 additional_info=additional_info, insurance=insurance,
                 medical_conditions=medical_conditions
             )
-            addition(request, user.medical_information)
+            addition(request, medical_information)
             user.medical_information = medical_information
 
         if is_doctor and user.doctor_information is not None:
@@ -313,7 +379,8 @@ def handle_user_form(request, body, user=None):
         change(request, user, 'Changed fields.')
         return user, None
     else:
-        if User.objects.filter(email=email).exists():
+        # Logins look the email up in every hospital database.
+        if sharding.exists_anywhere(User, email=email):
             return None, "A user with that email already exists."
         insurance = Insurance.objects.create(policy_number=policy,
             company=company)
@@ -332,7 +399,7 @@ def handle_user_form(request, body, user=None):
         )
         user = User.objects.create_user(email, email=email,
             password=password, date_of_birth=date, phone_number=phone,
-            first_name=first_name, last_name=last_name,
+            first_name=first_name, last_name=last_name, hospital=hospital,
             medical_information=medical_information,doctor_information=doctor_information)
         if user is None:
             return None, "We could not create that user. Please try again."
@@ -344,26 +411,57 @@ def handle_user_form(request, body, user=None):
         group.user_set.add(user)
         return user, None
 
-def users(request):
+def hospital_directory(hospital=None):
+    """
+    Lists the doctors, nurses and patients of one hospital, or of every
+    hospital in the current database.
+    :return: A list of dicts with the `hospital` and its `doctors`,
+             `nurses` and `patients`.
+    """
+    people = User.objects.filter(groups__name__in=DIRECTORY_GROUPS) \
+        .select_related('hospital').order_by('last_name', 'first_name') \
+        .annotate(role=F('groups__name'))
+    if hospital is not None:
+        people = people.filter(hospital=hospital)
+    sections = {}
+    for person in people:
+        section = sections.setdefault(person.hospital_id, {
+            'hospital': person.hospital,
+            'doctors': [], 'nurses': [], 'patients': [],
+        })
+        section[DIRECTORY_GROUPS[person.role]].append(person)
+    return list(sections.values())
+
 
-    hospital = request.user.hospital()
-    doctors = hospital.users_in_group('Doctor')
-    patients = hospital.users_in_group('Patient')
+@login_required(login_url = "login")
+def users(request):
+    """
+    Lists the users of the logged-in user's hospital. Administrators see
+    every hospital, read from all hospital databases in parallel.
+    """
+    if request.user.is_superuser:
+        directory = [section
+                     for sections in sharding.fan_out(hospital_directory).values()
+                     for section in sections]
+        directory.sort(key=lambda section: section['hospital'].name
+                       if section['hospital'] else '')
+    else:
+        directory = hospital_directory(request.user.hospital)
     context = {
         'navbar': 'users',
-        'doctors': doctors,
-        'nurses': nurses,
-        'patients': patients
+        'directory': directory,
     }
     return render(request, 'health/users.html', context)
 
 
-def handle_appointment_form(request, body, user, appointment=None):
+def handle_appointment_form(request, body, user, appointment=None, version=None):
     """
     Validates the provided fields for an appointment request and creates one
-    if all fields are valid.
+    if all fields are valid, or changes `appointment` in place.
     :param body: The HTTP form body containing the fields.
     :param user: The user intending to create the appointment.
+    :param version: The version of `appointment` the change was made from,
+                    to refuse it if the appointment has changed since.
     :return: A tuple containing either a valid appointment or failure message.
     """
     date_string = body.get("date")
@@ -383,53 +481,130 @@ def handle_appointment_form(request, body, user, appointment=None):
     is_change = appointment is not None
 
     changed = []
-    if is_change:
-        if appointment.date != parsed:
-            changed.append('date')
-        if appointment.patient != patient:
-            changed.append('patient')
-        if appointment.duration != duration:
-            changed.append('duration')
-        if appointment.doctor != doctor:
-            changed.append('doctor')
-        appointment.delete()
-    if not doctor.is_free(parsed, duration):
-        return None, "The doctor is not free at that time." +\
-                     " Please specify a different time."
-
-    if not patient.is_free(parsed, duration):
-        return None, "The patient is not free at that time." +\
-                     " Please specify a different time."
-    appointment = Appointment.objects.create(date=parsed, duration=duration,
-                                             doctor=doctor, patient=patient)
+    previous = appointment
+    with sharding.atomic():
+        if is_change:
+            if appointment.date != parsed:
+                changed.append('date')
+            if appointment.patient != patient:
+                changed.append('patient')
+            if appointment.duration != duration:
+                changed.append('duration')
+            if appointment.doctor != doctor:
+                changed.append('doctor')
+            appointment, message = booking.move(appointment, doctor, patient,
+                                                parsed, duration, version)
+        else:
+            appointment, message = booking.book(doctor, patient, parsed, duration)
+        if message:
+            return None, message
 
     if is_change:
         change(request, appointment, changed)
+        if (previous.date, previous.doctor_id) != (parsed, doctor.pk):
+            waitlist.backfill(request, previous)
     else:
         addition(request, appointment)
     if not appointment:
         return None, "We could not create the appointment. Please try again."
     return appointment, None
 
+def handle_series_form(request, body, user):
+    """
+    Validates the provided fields for a recurring appointment and creates
+    the series if all fields are valid. Occurrences are checked for
+    conflicts up to SERIES_CONFLICT_DAYS ahead; later ones are protected by
+    the series-aware is_free checks made when other appointments are booked.
+    :param body: The HTTP form body containing the fields.
+    :param user: The user intending to create the series.
+    :return: A tuple containing either a valid series or failure message.
+    """
+    try:
+        parsed = dateparse.parse_datetime(body.get("date"))
+        if not parsed:
+            return None, "Invalid date or time."
+        parsed = timezone.make_aware(parsed, timezone.get_current_timezone())
+    except:
+        return None, "Invalid date or time."
+    frequency = body.get("frequency")
+    if frequency not in AppointmentSeries.FREQUENCIES:
+        return None, "Invalid repeat frequency."
+    try:
+        interval = int(body.get("interval") or 1)
+        count = int(body.get("count")) if body.get("count") else None
+    except ValueError:
+        return None, "Invalid repeat interval or count."
+    until = None
+    if body.get("until"):
+        until_date = dateparse.parse_date(body.get("until"))
+        if not until_date:
+            return None, "Invalid end date."
+        until = timezone.make_aware(
+            datetime.datetime.combine(until_date, datetime.time.max),
+            timezone.get_current_timezone())
+    if interval < 1 or (count is not None and count < 1):
+        return None, "Invalid repeat interval or count."
+    try:
+        duration = int(body.get("duration"))
+    except (TypeError, ValueError):
+        return None, "Invalid duration."
+    if not 0 < duration <= MAX_APPOINTMENT_MINUTES:
+        return None, booking.INVALID_DURATION
+    doctor = User.objects.get(pk=int(body.get("doctor", user.pk)))
+    patient = User.objects.get(pk=int(body.get("patient", user.pk)))
+    weekdays = ",".join(body.getlist("weekdays"))
+
+    series = AppointmentSeries(patient=patient, doctor=doctor, start=parsed,
+                               duration=duration, frequency=frequency,
+                               interval=interval, weekdays=weekdays,
+                               count=count, until=until)
+    horizon = parsed + datetime.timedelta(days=SERIES_CONFLICT_DAYS)
+    for occurrence in recurrence.rule_dates(series, parsed, horizon):
+        if not doctor.is_free(occurrence, duration):
+            return None, "The doctor is not free on {0}.".format(
+                timezone.localtime(occurrence).strftime("%b %d %Y %H:%M"))
+        if not patient.is_free(occurrence, duration):
+            return None, "The patient is not free on {0}.".format(
+                timezone.localtime(occurrence).strftime("%b %d %Y %H:%M"))
+    series.save()
+    addition(request, series)
+    return series, None
+
 @login_required(login_url = "login")
+@ratelimit.limit('booking')
 def appointment_form(request, appointment_id):
     appointment = None
     if appointment_id:
         appointment = get_object_or_404(Appointment, pk=appointment_id)
     if request.POST:
+        if not appointment and request.POST.get("frequency"):
+            series, message = handle_series_form(
+                request, request.POST, request.user
+            )
+            return schedule(request, error=message)
         appointment, message = handle_appointment_form(
             request, request.POST,
             request.user, appointment=appointment
         )
+        if request.is_ajax():
+            # The schedule page updates its table from the event stream.
+            if message:
+                return JsonResponse({'error': message}, status=400)
+            return JsonResponse({'id': appointment.pk})
         return schedule(request, error=message)
-    hospital = request.user.hospital
+    doctors, patients = concurrency.gather(
+        lambda: list(User.objects.filter(groups__name='Doctor')),
+        lambda: list(User.objects.filter(groups__name='Patient')),
+    )
     context = {
         "user": request.user,
         'appointment': appointment,
         #"doctors": hospital.users_in_group('Doctor'),
         #"patients": hospital.users_in_group('Patient')
-        "doctors": User.objects.filter(groups__name='Doctor'),
-        "patients": User.objects.filter(groups__name='Patient'),
+        "doctors": doctors,
+        "patients": patients,
+        "frequencies": AppointmentSeries.FREQUENCIES,
+        "visit_days": DoctorInformation.VISIT_DAYS,
     }
     return render(request, 'health/edit_appointment.html', context)
 
@@ -441,34 +616,273 @@ def schedule(request, error=None):
     Also shows a table of the existing appointments for the logged-in user.
     """
     now = timezone.now()
-    hospital = request.user.hospital
+    user = request.user
+    # Taken before the queries, so the page's event stream replays any
+    # change committed while it loads.
+    events_cursor = events.get_broker().cursor()
+    # The lists are independent, so their queries run concurrently.
+    doctors, schedule_future, schedule_past, series, waiting, conflicts = concurrency.gather(
+        lambda: list(User.objects.filter(groups__name='Doctor')),
+        lambda: list(user.schedule().filter(date__gte=now)
+                         .select_related('patient', 'doctor').order_by('date')),
+        # One more than is shown, to tell whether there are older ones.
+        lambda: list(user.past_schedule(now, limit=PAST_APPOINTMENTS + 1)),
+        lambda: list(user.series().exclude(until__lt=now)
+                         .select_related('patient', 'doctor').order_by('start')),
+        lambda: list(user.waitlist_entries
+                         .filter(fulfilled_at__isnull=True, window_end__gte=now)
+                         .select_related('doctor', 'hospital')
+                         .order_by('window_start')),
+        # Appointments left outside their doctor's shifts, to reschedule.
+        lambda: list(user.schedule().filter(date__gte=now,
+                                         outside_shift_since__isnull=False)
+                         .select_related('patient', 'doctor').order_by('date'))
+            if user.is_doctor() or user.is_superuser else [],
+    )
     context = {
         "navbar": "schedule",
         "user": request.user,
         #"doctors": hospital.users_in_group('Doctor'),
         #"patients": hospital.users_in_group('Patient'),
-        "doctors": User.objects.filter(groups__name='Doctor'),
-        "patients": User.objects.filter(groups__name='Patient'),
-        "schedule_future": request.user.schedule()
-                                       .filter(date__gte=now)
-                                       .order_by('date'),
-        "schedule_past": request.user.schedule()
-                                     .filter(date__lt=now)
-                                     .order_by('-date')
+        "doctors": doctors,
+        "schedule_future": schedule_future,
+        "schedule_past": schedule_past[:PAST_APPOINTMENTS],
+        "schedule_past_truncated": len(schedule_past) > PAST_APPOINTMENTS,
+        "series": series,
+        "waitlist": waiting,
+        "conflicts": conflicts,
+        "specialisations": DoctorInformation.SPECIALISATION,
+        "events_cursor": events_cursor,
     }
     if error:
         context['error_message'] = error
     return render(request, 'health/schedule.html', context)
 
+@login_required(login_url = "login")
+def schedule_events(request):
+    """
+    Streams changes to the appointments on the user's schedule as
+    Server-Sent Events, starting after the Last-Event-ID the browser
+    reconnects with or, on first connect, the `since` cursor the schedule
+    page was rendered with. Only health.asgi keeps the stream open.
+    """
+    cursor = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('since')
+    return events.EventStreamResponse(
+        events.watched_topics(request.user, request.GET), cursor)
+
 @login_required(login_url = "login")
 def add_appointment_form(request):
     return appointment_form(request, None)
 
 @login_required(login_url = "login")
 def delete_appointment(request, appointment_id):
-    a = get_object_or_404(Appointment, pk=appointment_id)
-    a.delete()
-    return redirect(request,'health/schedule.html')
+    a = get_object_or_404(request.user.schedule(), pk=appointment_id)
+    deletion(request, a)
+    with sharding.atomic():
+        events.appointment_changed(a, 'removed')
+        a.delete()
+    waitlist.backfill(request, a)
+    if request.is_ajax():
+        return HttpResponse(status=204)
+    return redirect('schedule')
+
+@login_required(login_url = "login")
+def bulk_appointments(request):
+    """
+    Cancels or shifts all of a doctor's appointments in a time range.
+    Doctors may act on their own schedule; admins on any doctor's.
+    Expects `action` ("cancel" or "reschedule"), `doctor`, `start` and
+    `end`, and for reschedules the `shift` in minutes.
+    """
+    body = request.POST
+    if not body:
+        return redirect('schedule')
+    doctor = get_object_or_404(User, pk=int(body.get("doctor", request.user.pk)))
+    if doctor != request.user and not request.user.is_superuser:
+        raise PermissionDenied
+    start = dateparse.parse_datetime(body.get("start", ""))
+    end = dateparse.parse_datetime(body.get("end", ""))
+    if not start or not end or end <= start:
+        return schedule(request, error="Invalid date range.")
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(start, tz)
+    end = timezone.make_aware(end, tz)
+    action = body.get("action")
+    if action == "cancel":
+        bulk.cancel_appointments(request, doctor, start, end)
+    elif action == "reschedule":
+        try:
+            shift = datetime.timedelta(minutes=int(body.get("shift")))
+        except (TypeError, ValueError):
+            return schedule(request, error="Invalid shift.")
+        count, message = bulk.reschedule_appointments(request, doctor,
+                                                      start, end, shift)
+        if message:
+            return schedule(request, error=message)
+    else:
+        return schedule(request, error="Unknown action.")
+    return redirect('schedule')
+
+
+def parse_occurrence_date(series, value):
+    """
+    :return: The posted original date of one of the series' occurrences,
+             or None if the value is not a date the series occurs on.
+    """
+    try:
+        date = dateparse.parse_datetime(value or "")
+    except ValueError:
+        return None
+    if date is None:
+        return None
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.get_current_timezone())
+    return date if recurrence.is_occurrence(series, date) else None
+
+
+@login_required(login_url = "login")
+def skip_occurrence(request, series_id):
+    """
+    Skips a single occurrence of a recurring series, given its original
+    date in the POST body.
+    """
+    series = get_object_or_404(request.user.series(), pk=series_id)
+    if request.POST:
+        original_date = parse_occurrence_date(series, request.POST.get("date"))
+        if not original_date:
+            return schedule(request, error="That is not an occurrence of the series.")
+        recurrence.skip_occurrence(series, original_date)
+        change(request, series, 'Skipped occurrence on {0}.'.format(original_date))
+    return redirect('schedule')
+
+
+@login_required(login_url = "login")
+@ratelimit.limit('booking')
+def move_occurrence(request, series_id):
+    """
+    Moves a single occurrence of a recurring series, given its original
+    date, the new date and optionally a new duration in the POST body.
+    """
+    series = get_object_or_404(request.user.series(), pk=series_id)
+    if request.POST:
+        original_date = parse_occurrence_date(series, request.POST.get("date"))
+        if not original_date:
+            return schedule(request, error="That is not an occurrence of the series.")
+        try:
+            new_date = dateparse.parse_datetime(request.POST.get("new_date", ""))
+            duration = int(request.POST["duration"]) if request.POST.get("duration") else None
+        except ValueError:
+            new_date = None
+        if not new_date:
+            return schedule(request, error="Invalid date or time.")
+        if timezone.is_naive(new_date):
+            new_date = timezone.make_aware(new_date, timezone.get_current_timezone())
+        with sharding.atomic():
+            exception, message = booking.move_occurrence(series, original_date,
+                                                         new_date, duration)
+        if message:
+            return schedule(request, error=message)
+        change(request, series, 'Moved occurrence on {0} to {1}.'.format(
+            original_date, exception.new_date))
+    return redirect('schedule')
+
+
+@login_required(login_url = "login")
+def available_slots(request):
+    """
+    Returns the earliest open appointment slots across all matching doctors
+    as JSON. Accepts the GET parameters `specialisation`, `hospital`
+    (defaults to the user's hospital), `start` and `end` (dates; default
+    to the coming week), `duration` (minutes, default 30) and `limit`
+    (default 5).
+    """
+    params = request.GET
+    now = timezone.now()
+    start, end = now, now + datetime.timedelta(days=7)
+    tz = timezone.get_current_timezone()
+    try:
+        if params.get("start"):
+            start = max(now, timezone.make_aware(datetime.datetime.combine(
+                dateparse.parse_date(params["start"]), datetime.time.min), tz))
+        if params.get("end"):
+            end = timezone.make_aware(datetime.datetime.combine(
+                dateparse.parse_date(params["end"]), datetime.time.max), tz)
+        duration = int(params.get("duration", 30))
+        limit = min(int(params.get("limit", 5)), 100)
+        hospital = int(params["hospital"]) if params.get("hospital") \
+            else request.user.hospital_id
+        if duration <= 0:
+            raise ValueError(duration)
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "Invalid search parameters."}, status=400)
+    slots = availability.find_earliest_slots(
+        start, end, duration, specialisation=params.get("specialisation"),
+        hospital=hospital, limit=limit
+    )
+    return JsonResponse({"slots": [{
+        "start": slot.start.isoformat(),
+        "end": slot.end.isoformat(),
+        "doctor": slot.doctor.pk,
+        "doctor_name": slot.doctor.get_full_name(),
+    } for slot in slots]})
+
+
+@login_required(login_url = "login")
+@user_passes_test(checks.admin_check, login_url = "login")
+def utilization_dashboard(request):
+    """
+    Renders booked versus shift minutes per doctor per day, read from the
+    utilization summary. Accepts `start` and `end` dates as GET parameters
+    and defaults to the current week.
+    """
+    today = timezone.localtime().date()
+    start = dateparse.parse_date(request.GET.get("start", "")) or \
+        today - datetime.timedelta(days=today.weekday())
+    end = dateparse.parse_date(request.GET.get("end", "")) or \
+        start + datetime.timedelta(days=6)
+    end = min(end, start + datetime.timedelta(days=62))
+    doctors = (User.objects.filter(groups__name='Doctor')
+                           .select_related('doctor_information')
+                           .order_by('last_name', 'first_name'))
+    context = {
+        "navbar": "utilization",
+        "user": request.user,
+        "start": start,
+        "end": end,
+        "report": utilization.report(doctors, start, end),
+    }
+    return render(request, 'health/utilization.html', context)
+
+
+@login_required(login_url = "login")
+@user_passes_test(checks.admin_check, login_url = "login")
+def insurance_lookup(request):
+    """
+    Lists the patients on a policy, given `company` and `policy` as GET
+    parameters, or the patients insured by a company, given only `company`.
+    """
+    company = request.GET.get("company", "").strip()
+    policy = request.GET.get("policy", "").strip()
+    insurer = insurers.find_insurer(company)
+    patients = None
+    if policy:
+        patients = insurers.patients_with_policy(company, policy)
+    elif insurer is not None:
+        patients = insurers.patients_by_insurer(insurer)
+    if patients is not None:
+        patients = list(patients.select_related('medical_information__insurance')
+                        [:insurers.REPORT_LIMIT])
+    context = {
+        "navbar": "insurance",
+        "user": request.user,
+        "company": company,
+        "policy": policy,
+        "insurer": insurer,
+        "insurers": Insurer.objects.order_by('name'),
+        "patients": patients,
+        "limit": insurers.REPORT_LIMIT,
+    }
+    return render(request, 'health/insurance.html', context)
 
 
 @login_required(login_url = '/login/')
@@ -478,3 +892,84 @@ def home(request):
         'user': request.user,
     }
     return render(request, 'health/home.html', context)
+
+
+def nearest_hospitals(request):
+    """
+    Returns the hospitals nearest to a zipcode (`zipcode`) or a location
+    (`latitude` and `longitude`) as JSON, nearest first. `limit` caps the
+    number returned (default 10, at most 100).
+    :param request: The Django request.
+    :return: A JsonResponse with a "hospitals" list, or a 400 response.
+    """
+    params = request.GET
+    try:
+        limit = min(int(params.get("limit", 10)), 100)
+        if params.get("zipcode"):
+            nearby = geo.nearest_hospitals_to_zipcode(params["zipcode"], limit)
+            if nearby is None:
+                return JsonResponse({"error": "Unknown zipcode."}, status=400)
+        else:
+            nearby = geo.nearest_hospitals(float(params["latitude"]),
+                                           float(params["longitude"]), limit)
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "Invalid search parameters."}, status=400)
+    return JsonResponse({"hospitals": [{
+        "id": n.hospital.pk,
+        "name": n.hospital.name,
+        "address": n.hospital.address,
+        "city": n.hospital.city,
+        "state": n.hospital.state,
+        "zipcode": n.hospital.zipcode,
+        "distance_km": round(n.distance_km, 2),
+    } for n in nearby]})
+
+
+@login_required(login_url = "login")
+def join_waitlist(request):
+    """
+    Puts the logged-in user on the waitlist for an earlier appointment with
+    a `doctor`, or with any doctor of a `specialisation` (at the user's
+    hospital, if they have one), starting between `window_start` and
+    `window_end` and ending by `window_end`, for `duration` minutes.
+    """
+    body = request.POST
+    if not body:
+        return redirect('schedule')
+    tz = timezone.get_current_timezone()
+    window_start = dateparse.parse_datetime(body.get("window_start", ""))
+    window_end = dateparse.parse_datetime(body.get("window_end", ""))
+    if not window_start or not window_end or window_end <= window_start:
+        return schedule(request, error="Invalid waitlist window.")
+    try:
+        duration = int(body.get("duration"))
+    except (TypeError, ValueError):
+        return schedule(request, error="Invalid duration.")
+    if not 0 < duration <= MAX_APPOINTMENT_MINUTES:
+        return schedule(request, error="Invalid duration.")
+    if window_end - window_start < datetime.timedelta(minutes=duration):
+        return schedule(request, error="The waitlist window is shorter than the appointment.")
+    doctor = None
+    specialisation = None
+    if body.get("doctor"):
+        doctor = get_object_or_404(User, pk=int(body["doctor"]), groups__name='Doctor')
+    elif body.get("specialisation") in DoctorInformation.SPECIALISATION:
+        specialisation = body["specialisation"]
+    else:
+        return schedule(request, error="Choose a doctor or a specialisation.")
+    entry = WaitlistEntry.objects.create(
+        patient=request.user, doctor=doctor, specialisation=specialisation,
+        hospital=request.user.hospital if specialisation else None,
+        window_start=timezone.make_aware(window_start, tz),
+        window_end=timezone.make_aware(window_end, tz), duration=duration)
+    addition(request, entry)
+    return redirect('schedule')
+
+
+@login_required(login_url = "login")
+def leave_waitlist(request, entry_id):
+    entry = get_object_or_404(request.user.waitlist_entries, pk=entry_id)
+    if request.POST:
+        deletion(request, entry)
+        entry.delete()
+    return redirect('schedule')
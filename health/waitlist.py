@@ -0,0 +1,116 @@
+"""
+The cancellation waitlist.
+
+When an appointment is cancelled or moved, the freed slot is offered to
+the patients waiting for that doctor, or for any doctor of the doctor's
+specialisation at the doctor's hospital, whose requested duration fits in
+the slot and, from the slot's start, in their window. Candidates are found with the
+(doctor, latest_start) and (specialisation, latest_start) indexes, which
+only reach entries whose window can still fit their appointment at the
+slot's start, and are offered the slot oldest entry first. Each offer books through health.booking, so it cannot
+double-book the doctor or the patient.
+"""
+from django.db.models import Q
+from django.utils import timezone
+import functools
+import heapq
+import operator
+from . import booking, sharding
+from .form_utilities import addition, change
+from .models import WaitlistEntry
+
+# How many waiting patients a slot is offered to before it is left empty.
+MAX_OFFERS = 20
+
+
+def _for_doctor(doctor):
+    """
+    :return: The conditions, each served by an index, for entries waiting
+             for the doctor or for any doctor of their specialisation.
+    """
+    conditions = [Q(doctor=doctor)]
+    information = doctor.doctor_information
+    if information is not None and information.specialisation:
+        conditions.append(
+            (Q(hospital__isnull=True) | Q(hospital_id=doctor.hospital_id)) &
+            Q(doctor__isnull=True, specialisation=information.specialisation))
+    return conditions
+
+
+def candidates(doctor, date, duration, exclude_patient=None):
+    """
+    :return: An iterator over the unfulfilled entries that could take a
+             `duration` minute slot with the doctor at `date`, oldest first.
+    """
+    # An entry's appointment ends inside its window when started no later
+    # than latest_start, so every condition is checked before the slice.
+    fits = WaitlistEntry.objects.filter(
+        fulfilled_at__isnull=True, latest_start__gte=date,
+        window_start__lte=date, duration__gt=0, duration__lte=duration
+    ).select_related('patient').order_by('created_at')
+    if exclude_patient is not None:
+        fits = fits.exclude(patient=exclude_patient)
+    waiting = [fits.filter(matches)[:MAX_OFFERS] for matches in _for_doctor(doctor)]
+    return heapq.merge(*waiting, key=lambda entry: entry.created_at)
+
+
+def backfill(request, freed):
+    """
+    Offers the slot of a cancelled or moved appointment to the waitlist and
+    books the first waiting patient who is free.
+    :param freed: The appointment that no longer holds the slot.
+    :return: The new appointment, or None if nobody took the slot.
+    """
+    if freed.date <= timezone.now():
+        return None
+    offers = candidates(freed.doctor, freed.date, freed.duration,
+                        exclude_patient=freed.patient_id)
+    for offered, entry in enumerate(offers):
+        if offered == MAX_OFFERS:
+            return None
+        with sharding.atomic():
+            # Another cancellation may have fulfilled the entry meanwhile.
+            entry = WaitlistEntry.objects.select_for_update() \
+                .filter(pk=entry.pk, fulfilled_at__isnull=True) \
+                .select_related('patient').first()
+            if entry is None:
+                continue
+            appointment, message = booking.book(freed.doctor, entry.patient,
+                                                freed.date, entry.duration)
+            if message == booking.DOCTOR_BUSY:
+                # The slot has been taken by a regular booking.
+                return None
+            if appointment is None:
+                continue
+            entry.appointment = appointment
+            entry.fulfilled_at = timezone.now()
+            entry.save(update_fields=['appointment', 'fulfilled_at'])
+        addition(request, appointment)
+        change(request, entry, 'Booked from the waitlist.')
+        return appointment
+    return None
+
+
+def backfill_many(request, freed):
+    """
+    Offers the slots of several cancelled or moved appointments of one
+    doctor to the waitlist, earliest first, after checking with one query
+    that anybody is waiting for the doctor then.
+    :return: The new appointments.
+    """
+    now = timezone.now()
+    freed = sorted((a for a in freed if a.date > now), key=lambda a: a.date)
+    if not freed:
+        return []
+    waiting = WaitlistEntry.objects.filter(
+        fulfilled_at__isnull=True, latest_start__gte=freed[0].date,
+        window_start__lte=freed[-1].date)
+    matches = functools.reduce(operator.or_, _for_doctor(freed[0].doctor))
+    if not waiting.filter(matches).exists():
+        return []
+    booked = []
+    for appointment in freed:
+        new = backfill(request, appointment)
+        if new is not None:
+            booked.append(new)
+    return booked
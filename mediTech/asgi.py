@@ -0,0 +1,18 @@
+"""
+ASGI config for mediTech project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``, serving the WSGI application (with its static file
+handling and warm-up) through health.asgi.WsgiToAsgi. Run it with any
+ASGI server, for example:
+
+    uvicorn mediTech.asgi:application --workers 4
+"""
+
+from django.conf import settings
+
+from health.asgi import DEFAULT_THREADS, WsgiToAsgi
+from mediTech.wsgi import application as wsgi_application
+
+application = WsgiToAsgi(wsgi_application,
+                         threads=getattr(settings, 'ASGI_THREADS', DEFAULT_THREADS))
@@ -43,9 +43,11 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'health.middleware.HospitalDatabaseMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'health.middleware.UserSnapshotMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -56,13 +58,24 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': ['mediTech/templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'health.context_processors.user_version',
+            ],
+            # Compiled templates are cached in production; in development
+            # they are re-read so edits show up immediately.
+            'loaders': [
+                'django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader',
+            ] if DEBUG else [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
             ],
         },
     },
@@ -85,6 +98,25 @@ DATABASES = {
     }
 }
 
+# Hospital sharding (see health.sharding): maps hospital ids to the aliases
+# of the databases holding their users and appointments. Hospitals not
+# listed stay in 'default'. To try it locally with SQLite, add for example
+#
+#     DATABASES['hospital_a'] = {
+#         'ENGINE': 'django.db.backends.sqlite3',
+#         'NAME': os.path.join(BASE_DIR, 'hospital_a.sqlite3'),
+#     }
+#     HOSPITAL_DATABASES = {1: 'hospital_a'}
+#
+# then run `manage.py migrate --database=hospital_a` and
+# `manage.py sync_hospital_databases`.
+
+HOSPITAL_DATABASES = {}
+
+DATABASE_ROUTERS = ['health.sharding.HospitalRouter']
+
+AUTHENTICATION_BACKENDS = ['health.backends.HospitalModelBackend']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -131,3 +163,130 @@ STATICFILES_DIRS = [
 STATIC_ROOT=os.path.join(BASE_DIR,'static')
 
 STATIC_URL = '/static/'
+
+# Outside development, `collectstatic` fingerprints every asset and writes
+# gzip (and brotli, when installed) variants, which the WSGI application
+# serves with far-future cache headers (see health.static_serving).
+
+if not DEBUG:
+    STATICFILES_STORAGE = 'health.staticfiles.CompressedManifestStaticFilesStorage'
+
+SERVE_PRECOMPRESSED_STATIC = not DEBUG
+
+# Appointments that started more than this many days ago are moved to the
+# archive by `manage.py archive_appointments`.
+
+APPOINTMENT_ARCHIVE_DAYS = 365
+
+# Serve request.user from a versioned snapshot in the session instead of
+# loading the user and its groups on every request. Snapshot invalidation
+# goes through the cache, so enable this only with a cache shared by all
+# workers.
+
+USER_SNAPSHOT_ENABLED = False
+
+# Resolve role groups and content types, compile templates and populate the
+# URL resolver when a WSGI worker boots (see health.startup).
+
+WARM_STARTUP = True
+
+# `manage.py run_reminders` emails patients this long before each
+# appointment, through the class named by REMINDER_SENDER. In development
+# the emails are written to files under EMAIL_FILE_PATH rather than sent;
+# `python -m smtpd -n -c DebuggingServer localhost:1025` with the SMTP
+# backend and EMAIL_PORT = 1025 is a local SMTP alternative.
+
+REMINDER_LEAD_MINUTES = 24 * 60
+
+REMINDER_SENDER = 'health.reminders.EmailSender'
+
+if DEBUG:
+    EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
+    EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'sent_emails')
+
+DEFAULT_FROM_EMAIL = 'reminders@meditech.local'
+
+# Schedule pages follow appointment changes over Server-Sent Events (see
+# health.events). The default broker only reaches streams served by the
+# same process; run several worker processes only with a shared broker.
+# Served through mediTech.asgi, streams wait on the event loop and are
+# closed after EVENT_STREAM_SECONDS, when the browser reconnects where it
+# left off. WSGI servers only send the events already published, and the
+# browser polls every few seconds.
+
+EVENT_BROKER = 'health.events.LocalBroker'
+
+EVENT_STREAM_SECONDS = 300
+
+EVENT_HEARTBEAT_SECONDS = 15
+
+# `manage.py purge_audit` deletes audit log entries older than the number of
+# days given for their content type ('app_label.model'; None keeps them
+# forever), archiving them under AUDIT_ARCHIVE_DIR first.
+
+AUDIT_RETENTION = {
+    'health.appointment': 2 * 365,
+    'health.appointmentseries': 2 * 365,
+    'health.waitlistentry': 365,
+    'default': 6 * 365,
+}
+
+AUDIT_ARCHIVE_DIR = os.path.join(BASE_DIR, 'audit_archive')
+
+# Admission control for logging in and booking (see health.ratelimit).
+# RATE_LIMITS are token buckets of (requests, seconds) per client IP and per
+# account, kept in the default cache; CONCURRENCY_LIMITS caps the requests
+# each process runs at once and turns the rest away with a 429. Set
+# RATE_LIMIT_PROXY_COUNT to the number of reverse proxies in front of the
+# application so clients are told apart by X-Forwarded-For.
+
+RATE_LIMITS = {
+    'login': {'ip': (20, 60), 'user': (5, 60)},
+    'booking': {'ip': (60, 60), 'user': (20, 60)},
+}
+
+CONCURRENCY_LIMITS = {
+    'login': 4,
+    'booking': 8,
+}
+
+RATE_LIMIT_PROXY_COUNT = 0
+
+# Patient health information is encrypted in the database with data keys
+# wrapped by the master key PHI_MASTER_KEY, one of PHI_MASTER_KEYS (ids to
+# base64-encoded 32-byte keys; see health.encryption). To change master key,
+# add the new one, point PHI_MASTER_KEY at it, run `manage.py encrypt_phi`,
+# then remove the old one. Requires the cryptography package.
+#
+# The keys are read from the environment, never from this file:
+#   PHI_MASTER_KEYS="2026:<base64 key>,2025:<base64 key>"
+#   PHI_MASTER_KEY=2026
+# Without PHI_MASTER_KEY, values are stored in plaintext. Keys that have
+# been published are refused by a system check (health.encryption).
+PHI_MASTER_KEYS = dict(
+    item.strip().split(':', 1)
+    for item in os.environ.get('PHI_MASTER_KEYS', '').split(',') if item.strip())
+
+PHI_MASTER_KEY = os.environ.get('PHI_MASTER_KEY') or None
+
+# Base64-encoded key the blind index of policy numbers and clinical codes is
+# computed with (see health.encryption), from the environment too. It is
+# required once PHI_MASTER_KEY is set. Setting or changing it means running
+# `manage.py normalize_insurers --rehash` and `manage.py rehash_clinical_codes`.
+PHI_INDEX_KEY = os.environ.get('PHI_INDEX_KEY') or None
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'health.startup': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
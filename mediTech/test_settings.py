@@ -0,0 +1,32 @@
+"""
+Settings for the test suite, which runs on SQLite rather than the
+PostgreSQL server of settings.py:
+
+    python manage.py test --settings=mediTech.test_settings
+
+The 'hospital' database lets tests route a hospital to a database of its
+own (see health.sharding).
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'test_default.sqlite3'),  # noqa: F405
+    },
+    'hospital': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'test_hospital.sqlite3'),  # noqa: F405
+    },
+}
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# Fixed keys, for the test databases only.
+PHI_MASTER_KEYS = {
+    'test': 'aNY2S2lxSE6T3Mt2M9Xc0+ZOk1Mbhg6DgA2NAtf6Y9g=',
+    'test-rotated': '5Hzbq7X3uC1Ldg7AgdVq0b3Q3ki3xBQqmMi1mNBIvS8=',
+}
+PHI_MASTER_KEY = 'test'
+PHI_INDEX_KEY = 'tqDF9ur8QmyzR2kQ1q9n2DZ+P9uyeoJ8Lmt5dbgq2y0='
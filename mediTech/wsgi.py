@@ -7,6 +7,11 @@ For more information on this file, see
 https://docs.djangoproject.com/en/2.1/howto/deployment/wsgi/
 """
 
+import time
+
+started = time.perf_counter()
+
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +19,21 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mediTech.settings')
 
 application = get_wsgi_application()
+
+booted = time.perf_counter()
+
+from django.conf import settings
+
+if getattr(settings, 'SERVE_PRECOMPRESSED_STATIC', False):
+    from health.static_serving import PrecompressedStaticFiles
+    application = PrecompressedStaticFiles(
+        application, settings.STATIC_ROOT, settings.STATIC_URL)
+
+if getattr(settings, 'WARM_STARTUP', True):
+    from health.startup import warm_up
+    warm_up()
+
+logging.getLogger('health.startup').info(
+    'Worker %d ready: imports and setup %.1f ms, warm-up %.1f ms.',
+    os.getpid(), (booted - started) * 1000,
+    (time.perf_counter() - booted) * 1000)